@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class BalancerConfig(AppConfig):
     name = 'app.balancer'
+
+    def ready(self):
+        from . import signals
@@ -1,7 +1,10 @@
+import heapq
 import itertools
 import random
+from functools import lru_cache
 from typing import List
 
+from app.balancer.blacklist import conflict_bitsets, without_conflicts
 from app.ladder.models import Match, Player
 
 
@@ -9,7 +12,105 @@ role_names = ['carry', 'mid', 'offlane', 'pos4', 'pos5']
 role_permutations = list(itertools.permutations(role_names, 5))
 
 
-def balance_teams(players, mmr_exponent=3):
+def side_randomizer(seed=None):
+    # random generator used to assign team sides (Radiant or Dire);
+    # with a seed, same players always get the same answers
+    return random if seed is None else random.Random(seed)
+
+
+@lru_cache(maxsize=None)
+def team_splits(players_num):
+    """
+    All ways to split players into two teams. Every split is given once,
+    as a bitmask of the first team: bit i is set if player i plays in it.
+
+    With even amount of players first team always has player 0
+    (otherwise we'd get every split twice, with teams swapped).
+    Splits go in the same order as itertools.combinations() gives first teams.
+    """
+    team_players = players_num // 2
+
+    return tuple(
+        sum(1 << i for i in team)
+        for team in itertools.combinations(range(players_num), team_players)
+        if players_num % 2 or team[0] == 0
+    )
+
+
+@lru_cache(maxsize=None)
+def team_members(mask):
+    # indices of players in a team, in ascending order
+    return tuple(i for i in range(mask.bit_length()) if mask >> i & 1)
+
+
+def has_one_of(mask, players):
+    # team has exactly one of two players (both given as a bitmask)
+    return mask & players not in (0, players)
+
+
+def ranked(answers, key, limit=None):
+    """
+    Yields answers in order of key, equal answers keep their original order.
+    Answers are taken from a heap one by one, so we only pay for what is consumed.
+
+    :param limit: max amount of answers to give; only the best of them are kept in a bounded heap
+    """
+    if limit is not None:
+        yield from heapq.nsmallest(limit, answers, key=key)
+        return
+
+    heap = [(key(answer), i) for i, answer in enumerate(answers)]
+    heapq.heapify(heap)
+    while heap:
+        yield answers[heapq.heappop(heap)[1]]
+
+
+def pareto_order(role_scores, mmr_diffs, weights, limit=None):
+    """
+    Picks answers that can't get better role comfort without getting bigger
+    MMR difference (and the other way around) and ranks them by weighted score.
+
+    :param role_scores: role comfort of answers, bigger is better
+    :param mmr_diffs: MMR differences of answers, smaller is better
+    :param weights: weights of role comfort and MMR difference
+    :param limit: return only this amount of best answers
+    :return: indices of answers
+    """
+    # one sweep over answers sorted by role comfort: answer is on the front
+    # if it has the smallest difference among answers with the same comfort
+    # and smaller difference than every answer with better comfort
+    order = sorted(range(len(role_scores)), key=lambda i: (-role_scores[i], mmr_diffs[i]))
+
+    front = []
+    better_min = group_role = group_min = None
+    for i in order:
+        if role_scores[i] != group_role:
+            if group_min is not None and (better_min is None or group_min < better_min):
+                better_min = group_min
+            group_role, group_min = role_scores[i], mmr_diffs[i]
+
+        if mmr_diffs[i] == group_min and (better_min is None or mmr_diffs[i] < better_min):
+            front.append(i)
+
+    if not front:
+        return []
+
+    # both criteria are scaled to the range they have on the front;
+    # instead of dividing by ranges we multiply by the other one, so scores stay exact
+    role_weight, mmr_weight = weights
+    best_role = max(role_scores[i] for i in front)
+    best_diff = min(mmr_diffs[i] for i in front)
+    role_range = best_role - min(role_scores[i] for i in front) or 1
+    mmr_range = max(mmr_diffs[i] for i in front) - best_diff or 1
+
+    def score(i):
+        return role_weight * (best_role - role_scores[i]) * mmr_range + \
+               mmr_weight * (mmr_diffs[i] - best_diff) * role_range
+
+    return list(ranked(front, key=score, limit=limit))
+
+
+def balance_teams(players, mmr_exponent=3, seed=None, limit=None, blacklist=()):
     """
     Takes a list of 10 players and produces
     a list of suitable teams pairs.
@@ -31,48 +132,51 @@ def balance_teams(players, mmr_exponent=3):
                     ('Mikel',      2400),
                 ]
 
+    :param seed: seed for random team sides, makes answers reproducible
+    :param limit: return only this amount of best answers
+    :param blacklist: pairs of players names that shouldn't play in the same team
     :return: a list of team pairs with some meta data
     """
+    rnd = side_randomizer(seed)
 
     team_players = len(players) // 2
 
     # sort players by mmr
     players.sort(key=lambda x: -x[1])
 
-    # get all possible teams
-    teams = list(itertools.combinations(players, team_players))
-
     # calc avg MMR for each team
     # --------------------------
     # Taking MMR exponent will make difference between high mmr players
     # to have more impact than same difference between low mmr players
     # (good for balancing).
-    teams = [
-        {
+    def team(mask):
+        team = tuple(players[i] for i in team_members(mask))
+        return {
             'players': team,
             'mmr': sum(player[1] for player in team) // team_players,
             'mmr_exp': sum(player[1] ** mmr_exponent for player in team) // team_players
         }
-        for team in teams
+
+    # discard answers that place top 2 or lowest 2 players in the same team;
+    # second team of a split has everyone who is not in the first one
+    everyone = (1 << len(players)) - 1
+    top_players = 0b11
+    low_players = 0b11 << (len(players) - 2)
+    splits = [
+        mask for mask in team_splits(len(players))
+            if has_one_of(mask, top_players) and has_one_of(mask, low_players)
     ]
 
-    # combine teams into pairs against each other
-    half = len(teams) // 2
-    answers = zip(teams[:half], list(reversed(teams[half:])))
+    # blacklisted players go to different teams
+    conflicts = conflict_bitsets([player[0] for player in players], blacklist)
+    splits = without_conflicts(splits, everyone, conflicts)
 
-    # discard answers that place top 2 or lowest 2 players in the same team
-    top_players = players[:2]
-    low_players = players[-2:]
-    answers = [
-        x for x in answers
-            if len(set(x[0]['players']).intersection(top_players)) == 1 and
-               len(set(x[0]['players']).intersection(low_players)) == 1
-    ]
+    answers = [(team(mask), team(everyone ^ mask)) for mask in splits]
 
     # calc mmr differences for each pair of teams
     answers = [
         {
-            'teams': random.sample(answer, len(answer)),  # assign team side randomly (Radiant or Dire)
+            'teams': rnd.sample(answer, len(answer)),  # assign team side randomly (Radiant or Dire)
             'mmr_diff': abs(answer[0]['mmr'] - answer[1]['mmr']),
             'mmr_diff_exp': abs(answer[0]['mmr_exp'] - answer[1]['mmr_exp'])
         }
@@ -80,55 +184,55 @@ def balance_teams(players, mmr_exponent=3):
     ]
 
     # sort answers by mmr difference
-    answers.sort(key=lambda x: x['mmr_diff_exp'])
+    answers = list(ranked(answers, key=lambda x: x['mmr_diff_exp'], limit=limit))
 
     return answers
 
 
-def role_balance_teams(players: List[Player], mmr_exponent=3):
-    def intersection(team, players):
-        return len(set(team['players']).intersection(players))
-
-    def both_teams_have(answer, players, amount):
-        return intersection(answer[0], players) >= amount and \
-               intersection(answer[1], players) >= amount
-
-    def assign_best_roles(team):
-        top2_mmr = team['players'][1].ladder_mmr
-
-        role_score_max = 0
-        best_roles = None
-        for roles in role_permutations:
-            role_score = 0
-            important_roles_mmr = []
-            for i, player in enumerate(team['players']):
-                role_score += getattr(player.roles, roles[i])
-                # remember mmrs of carry nad mid players to later check if they are okay
-                if roles[i] in ['carry', 'mid']:
-                    important_roles_mmr.append(player.ladder_mmr)
-
-            team_ok = all(top2_mmr - x < 1500 for x in important_roles_mmr)
-            if role_score > role_score_max and team_ok:
-                role_score_max = role_score
-                best_roles = roles
-
-        # sort players according to their roles
-        sorted_players = []
-        role_score = []
-        for r in role_names:
-            ind = best_roles.index(r)  # index of player for given role
-            player = team['players'][ind]
-            score = getattr(player.roles, r)
-
-            sorted_players.append(player)
-            role_score.append(score)
-
-        team.update({
-            'players': sorted_players,
-            'role_score': role_score,
-            'role_score_sum': role_score_max,
-        })
-
+# picks the most comfortable roles for players of the team;
+# carry and mid can't be given to players much weaker than team's top 2
+def assign_best_roles(team):
+    top2_mmr = team['players'][1].ladder_mmr
+
+    role_score_max = 0
+    best_roles = None
+    for roles in role_permutations:
+        role_score = 0
+        important_roles_mmr = []
+        for i, player in enumerate(team['players']):
+            role_score += getattr(player.roles, roles[i])
+            # remember mmrs of carry nad mid players to later check if they are okay
+            if roles[i] in ['carry', 'mid']:
+                important_roles_mmr.append(player.ladder_mmr)
+
+        team_ok = all(top2_mmr - x < 1500 for x in important_roles_mmr)
+        if role_score > role_score_max and team_ok:
+            role_score_max = role_score
+            best_roles = roles
+
+    # sort players according to their roles
+    sorted_players = []
+    role_score = []
+    for r in role_names:
+        ind = best_roles.index(r)  # index of player for given role
+        player = team['players'][ind]
+        score = getattr(player.roles, r)
+
+        sorted_players.append(player)
+        role_score.append(score)
+
+    team.update({
+        'players': sorted_players,
+        'role_score': role_score,
+        'role_score_sum': role_score_max,
+    })
+
+
+def role_balance_teams(players: List[Player], mmr_exponent=3, seed=None, limit=None, blacklist=(), pareto=None):
+    """
+    :param pareto: weights of role comfort and MMR difference to rank answers on pareto front with;
+                   if None, answers with best roles within MMR difference threshold go first
+    """
     def discard_unbalanced_answers(answers, diff_attempts):
         if not diff_attempts:
             return answers
@@ -141,48 +245,48 @@ def role_balance_teams(players: List[Player], mmr_exponent=3):
 
         return new
 
+    rnd = side_randomizer(seed)
+
     team_players = 5
 
     # sort players by mmr
     players.sort(key=lambda x: -x.ladder_mmr)
 
-    # get all possible teams
-    teams = list(itertools.combinations(players, team_players))
-
     # calc avg MMR for each team
     # --------------------------
     # Taking MMR exponent will make difference between high mmr players
     # to have more impact than same difference between low mmr players
     # (good for balancing).
-    teams = [
-        {
+    def team(mask):
+        team = tuple(players[i] for i in team_members(mask))
+        team = {
             'players': team,
             'mmr': sum(player.ladder_mmr for player in team) // team_players,
             'mmr_exp': sum(player.ladder_mmr ** mmr_exponent for player in team) // team_players
         }
-        for team in teams
+        assign_best_roles(team)
+        return team
+
+    # discard answers that place top 2 or lowest 2 players on same team;
+    # second team of a split has everyone who is not in the first one
+    everyone = (1 << len(players)) - 1
+    top_players = 0b11
+    low_players = 0b11 << (len(players) - 2)
+    splits = [
+        mask for mask in team_splits(len(players))
+            if has_one_of(mask, top_players) and has_one_of(mask, low_players)
     ]
 
-    for team in teams:
-        assign_best_roles(team)
+    # blacklisted players go to different teams
+    conflicts = conflict_bitsets([player.name for player in players], blacklist)
+    splits = without_conflicts(splits, everyone, conflicts)
 
-    # combine teams into pairs against each other
-    half = len(teams) // 2
-    answers = zip(teams[:half], list(reversed(teams[half:])))
-
-    # discard answers that place top 2 or lowest 2 players on same team
-    top_players = players[:2]
-    low_players = players[-2:]
-    answers = [
-        x for x in answers
-            if both_teams_have(x, top_players, 1) and
-               both_teams_have(x, low_players, 1)
-    ]
+    answers = [(team(mask), team(everyone ^ mask)) for mask in splits]
 
     # calc mmr differences for each pair of teams
     answers = [
         {
-            'teams': random.sample(answer, len(answer)),  # assign team side randomly (Radiant or Dire)
+            'teams': rnd.sample(answer, len(answer)),  # assign team side randomly (Radiant or Dire)
             'mmr_diff': abs(answer[0]['mmr'] - answer[1]['mmr']),
             'mmr_diff_exp': abs(answer[0]['mmr_exp'] - answer[1]['mmr_exp']),
             'role_score_sum': answer[0]['role_score_sum'] + answer[1]['role_score_sum'],
@@ -190,13 +294,17 @@ def role_balance_teams(players: List[Player], mmr_exponent=3):
         for answer in answers
     ]
 
-
-
-    # discard answers that have too unbalanced teams
-    answers = discard_unbalanced_answers(answers, diff_attempts=[200, 300, 400])
-
-    # sort answers by mmr difference
-    answers.sort(key=lambda x: (-x['role_score_sum'], x['mmr_diff_exp']))
+    if pareto:
+        order = pareto_order(
+            [x['role_score_sum'] for x in answers], [x['mmr_diff_exp'] for x in answers], pareto, limit
+        )
+        answers = [answers[i] for i in order]
+    else:
+        # discard answers that have too unbalanced teams
+        answers = discard_unbalanced_answers(answers, diff_attempts=[200, 300, 400])
+
+        # sort answers by mmr difference
+        answers = list(ranked(answers, key=lambda x: (-x['role_score_sum'], x['mmr_diff_exp']), limit=limit))
 
     for answer in answers:
         for team in answer['teams']:
@@ -0,0 +1,89 @@
+"""
+Blacklist graph: who doesn't want to play with whom.
+
+Player.blacklist is one-sided, but for balancing it doesn't matter who
+blacklisted whom, so conflicts go both ways.
+"""
+from collections import defaultdict
+
+from app.ladder.models import Player
+
+
+class ConflictGraph:
+    def __init__(self, pairs=()):
+        self.conflicts = defaultdict(set)
+        for a, b in pairs:
+            if a != b:
+                self.conflicts[a].add(b)
+                self.conflicts[b].add(a)
+
+    @staticmethod
+    def load(players=None, field='id'):
+        """
+        Loads blacklist with one query.
+
+        :param players: only conflicts between these players are loaded (values of field);
+                        all of them if None
+        :param field: what identifies players in the graph, e.g. 'id', 'name' or 'dota_id'
+        """
+        pairs = Player.blacklist.through.objects.all()
+        if players is not None:
+            pairs = pairs.filter(**{
+                'from_player__%s__in' % field: players,
+                'to_player__%s__in' % field: players,
+            })
+
+        return ConflictGraph(pairs.values_list('from_player__%s' % field, 'to_player__%s' % field))
+
+    def pairs(self):
+        # every conflict once
+        return sorted((a, b) for a in self.conflicts for b in self.conflicts[a] if a < b)
+
+    def conflicts_with(self, player, others):
+        return self.conflicts.get(player, set()).intersection(others)
+
+
+def conflict_bitsets(players, blacklist):
+    """
+    Turns blacklist into bitsets: bit j of bitsets[i] is set
+    if players i and j don't want to play in the same team.
+
+    :param players: players identifiers (e.g. names) in the order they are balanced
+    :param blacklist: pairs of players identifiers
+    """
+    index = {player: i for i, player in enumerate(players)}
+
+    bitsets = [0] * len(players)
+    for a, b in blacklist:
+        if a in index and b in index and a != b:
+            bitsets[index[a]] |= 1 << index[b]
+            bitsets[index[b]] |= 1 << index[a]
+
+    return bitsets
+
+
+def conflict_free(mask, everyone, bitsets):
+    """
+    Checks that nobody plays in the same team with a player he has conflict with.
+
+    :param mask: bitmask of the first team
+    :param everyone: bitmask of all players
+    """
+    other = everyone ^ mask
+    return not any(
+        bitset & (mask if mask >> i & 1 else other)
+        for i, bitset in enumerate(bitsets) if bitset
+    )
+
+
+def without_conflicts(masks, everyone, bitsets):
+    """
+    Drops splits that put blacklisted players in the same team.
+    If every split has a conflict, blacklist is ignored: a game is still better than no game.
+
+    :param masks: bitmasks of first teams
+    """
+    if not any(bitsets):
+        return masks
+
+    return [mask for mask in masks if conflict_free(mask, everyone, bitsets)] or masks
@@ -0,0 +1,172 @@
+"""
+Branch-and-bound version of balancer.balance_teams() for lobbies bigger than 10 players.
+
+Exhaustive search looks at every possible team, that's C(16, 8) = 12870 teams
+for 16 players and 184756 teams for 20. Here team is built player by player
+(same order as itertools.combinations() gives) and a branch is dropped as soon
+as MMR sums tell it can't beat the worst of the best answers found so far.
+"""
+import heapq
+
+from app.balancer import balancer
+from app.balancer.balancer import side_randomizer
+from app.balancer.blacklist import conflict_bitsets, conflict_free
+
+
+def mmr_bounds(exps, start, count, prefix):
+    """
+    Min and max sum of MMR exponents we can get by picking
+    `count` more players from players[start:].
+    Players go by MMR (desc), so the best ones are right after `start`
+    and the worst ones are at the end of the list.
+    """
+    n = len(exps)
+    low = prefix[n] - prefix[n - count]
+    high = prefix[start + count] - prefix[start]
+
+    return low, high
+
+
+def balance_teams(players, mmr_exponent=3, seed=None, limit=None, blacklist=()):
+    """
+    Same as balancer.balance_teams(), but prunes teams that can't get into top answers.
+    Gives the same answers as exhaustive search, only team sides can differ
+    as they are drawn just for the answers we return.
+
+    :param players: a list of players (name and MMR for each).
+    :param seed: seed for random team sides, makes answers reproducible
+    :param limit: return only this amount of best answers
+    :param blacklist: pairs of players names that shouldn't play in the same team
+    :return: a list of team pairs with some meta data
+    """
+    # teams have different sizes with odd amount of players,
+    # leave this case to exhaustive search
+    if len(players) % 2:
+        return balancer.balance_teams(list(players), mmr_exponent, seed, limit, blacklist)
+
+    if limit is not None and limit <= 0:
+        return []
+
+    rnd = side_randomizer(seed)
+
+    players = sorted(players, key=lambda x: -x[1])
+
+    players_num = len(players)
+    team_players = players_num // 2
+
+    mmrs_exp = [player[1] ** mmr_exponent for player in players]
+    total = sum(mmrs_exp)
+
+    prefix = [0]
+    for mmr_exp in mmrs_exp:
+        prefix.append(prefix[-1] + mmr_exp)
+
+    # bounds are only valid when MMR exponents go in the same order as MMRs
+    can_prune = limit is not None and \
+        all(a >= b for a, b in zip(mmrs_exp, mmrs_exp[1:]))
+
+    top_players = {0, 1}
+    low_players = {players_num - 2, players_num - 1}
+
+    # blacklisted players go to different teams
+    everyone = (1 << players_num) - 1
+    conflicts = conflict_bitsets([player[0] for player in players], blacklist)
+
+    # best answers so far: (-mmr_diff_exp, -num, first team, second team);
+    # num is a number of answer in exhaustive search order, it breaks ties same as a stable sort does
+    best = []
+    num = 0
+
+    def worst_diff():
+        return -best[0][0] if limit is not None and len(best) >= limit else None
+
+    def visit(team, mask):
+        nonlocal num
+
+        # discard answers that place top 2 or lowest 2 players in the same team
+        members = set(team)
+        if len(members & top_players) != 1 or len(members & low_players) != 1:
+            return
+
+        # first team is already checked while it's built, here we check the second one
+        if not conflict_free(mask, everyone, conflicts):
+            return
+
+        opponents = tuple(i for i in range(players_num) if i not in members)
+
+        # same sums as in balancer.py, so floats give exactly the same results
+        team_mmr_exp = sum(mmrs_exp[i] for i in team) // team_players
+        opponents_mmr_exp = sum(mmrs_exp[i] for i in opponents) // team_players
+        mmr_diff_exp = abs(team_mmr_exp - opponents_mmr_exp)
+
+        answer = (-mmr_diff_exp, -num, tuple(team), opponents)
+        num += 1
+
+        if limit is None or len(best) < limit:
+            heapq.heappush(best, answer)
+        elif answer > best[0]:
+            heapq.heapreplace(best, answer)
+
+    def search(start, team, mask, team_sum):
+        left = team_players - len(team)
+        if not left:
+            visit(team, mask)
+            return
+
+        for i in range(start, players_num - left + 1):
+            # second best player always plays against the best one
+            if i == 1:
+                continue
+
+            # player i doesn't want to play with someone who is already in the team
+            if conflicts[i] & mask:
+                continue
+
+            new_sum = team_sum + mmrs_exp[i]
+
+            worst = worst_diff()
+            if can_prune and worst is not None:
+                low, high = mmr_bounds(mmrs_exp, i + 1, left - 1, prefix)
+                low = 2 * (new_sum + low) - total
+                high = 2 * (new_sum + high) - total
+                raw_diff = 0 if low <= 0 <= high else min(abs(low), abs(high))
+
+                # avg MMR is a floor division, so mmr_diff_exp > raw_diff / team_players - 1;
+                # if even that is bigger than our worst answer then no team in this branch fits
+                if raw_diff > team_players * (worst + 1):
+                    continue
+
+            team.append(i)
+            search(i + 1, team, mask | 1 << i, new_sum)
+            team.pop()
+
+    # best player is always in the first team of a pair
+    search(1, [0], 1, mmrs_exp[0])
+
+    # everything conflicts, blacklist is ignored (same as in other engines)
+    if not best and any(conflicts):
+        return balance_teams(players, mmr_exponent, seed, limit)
+
+    def team(indices):
+        team_players_list = tuple(players[i] for i in indices)
+        return {
+            'players': team_players_list,
+            'mmr': sum(player[1] for player in team_players_list) // team_players,
+            'mmr_exp': sum(mmrs_exp[i] for i in indices) // team_players,
+        }
+
+    # assign team side randomly (Radiant or Dire), in the same order as answers were found
+    found = sorted(best, key=lambda x: -x[1])
+    answers = []
+    for neg_diff_exp, neg_num, first, second in found:
+        first, second = team(first), team(second)
+        answers.append((-neg_diff_exp, -neg_num, {
+            'teams': rnd.sample((first, second), 2),
+            'mmr_diff': abs(first['mmr'] - second['mmr']),
+            'mmr_diff_exp': -neg_diff_exp,
+        }))
+
+    # sort answers by mmr difference
+    answers.sort(key=lambda x: x[:2])
+
+    return [answer for _, _, answer in answers]
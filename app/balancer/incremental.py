@@ -0,0 +1,175 @@
+"""
+Balancing a queue that waits for its last player.
+
+When 9 players are in a queue, every team of the future balance is either
+5 of them ("full" team) or 4 of them plus the 10th player ("short" team),
+whoever he turns out to be. So we compute MMR sums and role tables for these
+teams while the queue is filling up, and when the 10th player joins
+we only add his MMR and role preferences to them.
+
+Answers are exactly the same as vectorized.role_balance_teams() gives for all 10 players.
+"""
+import itertools
+
+import numpy as np
+
+from app.balancer.blacklist import conflict_bitsets
+from app.balancer.vectorized import ROLE_PERMUTATIONS, assign_best_roles, best_roles, iter_role_answers, \
+    mmr_arrays, role_scores, roles_matrix, split_matrices, top_low_splits, without_conflicts
+
+
+TEAM_PLAYERS = 5
+PLAYERS_NUM = 2 * TEAM_PLAYERS
+
+
+def subsets(players_num, size):
+    """
+    Index matrix of all teams of given size, one team per row,
+    and lookup table from team bitmask to its row.
+    """
+    teams = list(itertools.combinations(range(players_num), size))
+
+    index = np.full(1 << players_num, -1, dtype=np.intp)
+    for row, team in enumerate(teams):
+        index[sum(1 << i for i in team)] = row
+
+    return np.array(teams, dtype=np.intp), index
+
+
+def without_bit(masks, bit):
+    # removes given bit from masks, higher bits move one position down
+    low = masks & ((1 << bit) - 1)
+    return low | (masks >> (bit + 1) << bit)
+
+
+class PartialBalance:
+    def __init__(self, players, mmr_exponent=3):
+        """
+        Precomputes tables for 9 players.
+
+        :param players: a list of 9 players (Player objects or snapshots)
+        """
+        self.players = sorted(players, key=lambda x: -x.ladder_mmr)
+        self.mmr_exponent = mmr_exponent
+
+        players_num = len(self.players)
+        mmrs = [p.ladder_mmr for p in self.players]
+
+        # tables are extended by adding last player's values to sums of 4 players,
+        # float sums would depend on the order of additions
+        self.exact = isinstance(mmr_exponent, int) and all(isinstance(mmr, int) for mmr in mmrs)
+
+        mmrs, mmrs_exp = mmr_arrays(mmrs, mmr_exponent, TEAM_PLAYERS)
+        prefs = roles_matrix(self.players)
+        self.dtype = mmrs.dtype
+
+        # full teams are final, roles can be assigned right away
+        self.full_teams, self.full_index = subsets(players_num, TEAM_PLAYERS)
+        self.full_mmr = mmrs[self.full_teams].sum(axis=1)
+        self.full_mmr_exp = mmrs_exp[self.full_teams].sum(axis=1)
+        self.full_roles = assign_best_roles(self.full_teams, prefs, mmrs)
+
+        # short teams get role scores for every position last player can take in the team
+        # (team members go by MMR); his own preferences are added later
+        self.short_teams, self.short_index = subsets(players_num, TEAM_PLAYERS - 1)
+        self.short_mmr = mmrs[self.short_teams].sum(axis=1)
+        self.short_mmr_exp = mmrs_exp[self.short_teams].sum(axis=1)
+
+        blank = np.vstack([prefs, np.zeros((1, prefs.shape[1]), dtype=prefs.dtype)])
+        self.short_scores = np.stack([
+            role_scores(np.insert(self.short_teams, position, players_num, axis=1), blank)
+            for position in range(TEAM_PLAYERS)
+        ])
+
+    def fits(self, players, mmr_exponent):
+        """
+        Checks that tables were made for all these players except one.
+        """
+        players = sorted(players, key=lambda x: -x.ladder_mmr)
+        return self.exact and mmr_exponent == self.mmr_exponent and self.last_player(players) is not None
+
+    def last_player(self, players):
+        """
+        Index of the player that joined after tables were computed.
+
+        :param players: all players sorted by MMR (desc)
+        :return: None if tables don't fit these players
+        """
+        if len(players) != len(self.players) + 1:
+            return None
+
+        for i in range(len(players)):
+            if players[:i] + players[i + 1:] == self.players:
+                return i
+
+        return None
+
+
+def role_balance_teams(partial, players, mmr_exponent=3, seed=None, limit=None, blacklist=(), pareto=None):
+    """
+    Same as vectorized.role_balance_teams(), but extends precomputed tables.
+
+    :param partial: PartialBalance of all players except one
+    :return: a list of team pairs with some meta data,
+             None if partial balance was made for different players or settings
+    """
+    if not partial.fits(players, mmr_exponent):
+        return None
+
+    players = sorted(players, key=lambda x: -x.ladder_mmr)
+    last = partial.last_player(players)
+
+    mmrs, mmrs_exp = mmr_arrays([p.ladder_mmr for p in players], mmr_exponent, TEAM_PLAYERS)
+    if mmrs.dtype != partial.dtype:
+        return None  # last player's MMR changes how sums are stored
+
+    # same splits as vectorized engine has
+    everyone = (1 << PLAYERS_NUM) - 1
+    kept = top_low_splits(PLAYERS_NUM)
+    kept = without_conflicts(PLAYERS_NUM, kept, conflict_bitsets([p.name for p in players], blacklist))
+    masks = split_matrices(PLAYERS_NUM)[0][kept]
+
+    # every split has one full team and one short team, find their rows in the tables
+    last_first = (masks >> last & 1).astype(bool)
+    full = np.where(last_first, everyone ^ masks, masks)
+    short = (everyone ^ full) & ~(1 << last)
+    full = partial.full_index[without_bit(full, last)]
+    short = partial.short_index[without_bit(short, last)]
+
+    # short teams with the last player in them, players indices are shifted to make room for him
+    short_members = partial.short_teams[short]
+    position = (short_members < last).sum(axis=1)
+    short_members = short_members + (short_members >= last)
+    short_teams = np.sort(np.insert(short_members, 0, last, axis=1), axis=1)
+
+    # add last player's preferences to role scores of his position
+    prefs = roles_matrix(players)
+    last_scores = prefs[last][ROLE_PERMUTATIONS.T]
+    scores = partial.short_scores[position, short] + last_scores[position]
+    short_roles = best_roles(short_teams, scores, prefs, mmrs)
+
+    full_role_players, full_role_score, full_role_score_sum = partial.full_roles
+    full_role_players = full_role_players[full]
+    full_roles = (
+        full_role_players + (full_role_players >= last),
+        full_role_score[full],
+        full_role_score_sum[full],
+    )
+
+    full_mmr = partial.full_mmr[full] // TEAM_PLAYERS
+    full_mmr_exp = partial.full_mmr_exp[full] // TEAM_PLAYERS
+    short_mmr = (partial.short_mmr[short] + mmrs[last]) // TEAM_PLAYERS
+    short_mmr_exp = (partial.short_mmr_exp[short] + mmrs_exp[last]) // TEAM_PLAYERS
+
+    # put teams in the same layout vectorized engine has: first teams of splits, then second ones
+    def layout(full_values, short_values):
+        mask = last_first.reshape((-1,) + (1,) * (full_values.ndim - 1))
+        first = np.where(mask, short_values, full_values)
+        second = np.where(mask, full_values, short_values)
+        return np.concatenate([first, second])
+
+    team_mmr = layout(full_mmr, short_mmr)
+    team_mmr_exp = layout(full_mmr_exp, short_mmr_exp)
+    roles = tuple(layout(f, s) for f, s in zip(full_roles, short_roles))
+
+    return list(iter_role_answers(players, team_mmr, team_mmr_exp, roles, seed, limit, pareto))
@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from app.balancer.managers import BalanceResultManager
+from app.ladder.models import LadderSettings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = 'Deletes old balance results that no match or queue uses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='keep results newer than this (0 keeps all), LadderSettings.balance_retention_days by default')
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='amount of results deleted in one transaction')
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help='seconds to wait between batches, so others can use DB')
+        parser.add_argument('--vacuum', action='store_true',
+                            help='give freed space back to file system (needs incremental auto_vacuum)')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = LadderSettings.get_solo().balance_retention_days
+
+        # same as in settings, 0 keeps everything
+        if not days:
+            print('Retention is 0 days, nothing to delete')
+            return
+
+        stats = BalanceResultManager.compact(
+            timezone.now() - timedelta(days=days),
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            vacuum=options['vacuum'],
+            dry_run=options['dry_run'],
+        )
+
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        print('%s %d results and %d answers older than %d days' % (verb, stats['results'], stats['answers'], days))
+
+        if stats['bytes'] is not None:
+            print('Reclaimed %.1f KB in DB, file is %.1f KB smaller' %
+                  (stats['bytes'] / 1024, stats['file_bytes'] / 1024))
+        if options['vacuum'] and not stats['vacuumed']:
+            print('Vacuum skipped: DB is not in incremental auto_vacuum mode')
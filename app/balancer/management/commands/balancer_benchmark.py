@@ -0,0 +1,205 @@
+import json
+import os
+import random
+import timeit
+import tracemalloc
+
+from app.balancer import balancer, branch_bound, incremental, vectorized
+from app.balancer.balancer import role_names
+from app.balancer.managers import BalanceJob, BalanceResultManager
+from app.balancer.service import BalanceService
+from app.ladder.models import LadderSettings, Player, RolesPreference
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+
+# how often each role is a favourite one, supports are less popular
+FAVOURITE_ROLE_WEIGHTS = [30, 25, 20, 15, 10]
+
+
+def synthetic_players(rnd, players_num):
+    """
+    Makes unsaved players with ladder-like MMRs and role preferences:
+    MMRs are around 4000, every player has one favourite role
+    and random preference for the rest of roles.
+    Ids are negative, so blacklists of real players don't get into their balance.
+    """
+    players = []
+    for i in range(players_num):
+        mmr = int(min(8000, max(500, rnd.gauss(4000, 1000))))
+
+        favourite = rnd.choices(role_names, FAVOURITE_ROLE_WEIGHTS)[0]
+        roles = RolesPreference(**{
+            role: 5 if role == favourite else rnd.randint(1, 4)
+            for role in role_names
+        })
+
+        players.append(Player(
+            id=-(i + 1),
+            name='Player %d' % (i + 1),
+            dota_mmr=mmr,
+            ladder_mmr=mmr,
+            roles=roles,
+        ))
+
+    return players
+
+
+class Command(BaseCommand):
+    help = 'Times balancer stages on synthetic players and compares them with a stored baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=10)
+        parser.add_argument('--populations', type=int, default=5,
+                            help='amount of different synthetic lobbies to run every stage on')
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--exponent', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--baseline', default=os.path.join(settings.DATABASE_DIR, 'balancer_benchmark.json'))
+        parser.add_argument('--save-baseline', action='store_true')
+        parser.add_argument('--tolerance', type=int, default=20,
+                            help='percent of slowdown that is reported as a regression')
+
+        # exhaustive vs branch-and-bound for different lobby sizes
+        parser.add_argument('--scaling', action='store_true')
+        parser.add_argument('--min-players', type=int, default=10)
+        parser.add_argument('--max-players', type=int, default=20)
+        parser.add_argument('--exhaustive-max', type=int, default=16,
+                            help='don\'t run exhaustive search for bigger lobbies, it takes too long')
+        parser.add_argument('--limit', type=int, default=40)
+
+    def handle(self, *args, **options):
+        if options['scaling']:
+            self.scaling(options)
+            return
+
+        rnd = random.Random(options['seed'])
+        populations = [synthetic_players(rnd, options['players']) for _ in range(options['populations'])]
+
+        results = {}
+        for name, stage in self.stages(options['exponent']):
+            results[name] = {
+                'time_ms': self.measure(stage, populations, options['runs']),
+                'peak_kb': self.allocations(stage, populations),
+            }
+
+        baseline = self.load_baseline(options['baseline'])
+        self.report(results, baseline, options['tolerance'])
+
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            print('\nBaseline saved to %s' % options['baseline'])
+
+    @staticmethod
+    def stages(exponent):
+        def tuples(players):
+            return [(p.name, p.ladder_mmr) for p in players]
+
+        def custom_teams(players):
+            half = len(players) // 2
+            return [tuples(players[:half]), tuples(players[half:])]
+
+        def persist(players):
+            # everything is rolled back, benchmark doesn't leave anything in DB;
+            # cache isn't rolled back, so keys pointing to these results are deleted
+            job = BalanceResultManager.balance_job(players)
+            answers = vectorized.role_balance_teams(list(job.players), exponent)
+            with transaction.atomic():
+                result = BalanceResultManager.save_answers(job, answers)
+                transaction.set_rollback(True)
+            cache.delete_many(['balance_result_%s' % job.key, 'balance_answers_%s' % result.id])
+
+        partials = {}
+
+        def extend(players):
+            # tables are prepared once per population, so only extending them is timed
+            if id(players) not in partials:
+                partials[id(players)] = incremental.PartialBalance(players[:-1], exponent)
+            return incremental.role_balance_teams(partials[id(players)], list(players), exponent)
+
+        service = BalanceService(workers=1)
+
+        def worker(players):
+            # full balance as bots get it: sent to a worker process, answers come back pickled
+            job = BalanceJob('0' * 40, BalanceResultManager.snapshots(players), exponent, True, None,
+                             LadderSettings.NUMPY_ENGINE, (), None, False)
+            return service.submit(job).result()
+
+        return [
+            ('balancer.balance_teams', lambda p: balancer.balance_teams(tuples(p), exponent)),
+            ('balancer.role_balance_teams', lambda p: balancer.role_balance_teams(list(p), exponent)),
+            ('balancer.balance_from_teams', lambda p: balancer.balance_from_teams(custom_teams(p), exponent)),
+            ('vectorized.balance_teams', lambda p: vectorized.balance_teams(tuples(p), exponent)),
+            ('vectorized.role_balance_teams', lambda p: vectorized.role_balance_teams(list(p), exponent)),
+            ('incremental.PartialBalance', lambda p: incremental.PartialBalance(p[:-1], exponent)),
+            ('incremental.role_balance_teams', extend),
+            ('BalanceService.submit', worker),
+            ('branch_bound.balance_teams', lambda p: branch_bound.balance_teams(tuples(p), exponent, limit=40)),
+            ('BalanceResultManager.balance_job', lambda p: BalanceResultManager.balance_job(p)),
+            ('BalanceResultManager.save_answers', persist),
+        ]
+
+    @staticmethod
+    def measure(stage, populations, runs):
+        # best of several runs, average per population, in milliseconds
+        def run():
+            for players in populations:
+                stage(players)
+
+        return min(timeit.repeat(run, number=1, repeat=runs)) / len(populations) * 1000
+
+    @staticmethod
+    def allocations(stage, populations):
+        # peak memory allocated by stage, in kilobytes
+        peak = 0
+        for players in populations:
+            tracemalloc.start()
+            stage(players)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        return peak / 1024
+
+    @staticmethod
+    def load_baseline(path):
+        if not os.path.exists(path):
+            return {}
+
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def report(results, baseline, tolerance):
+        print('%-36s %10s %10s   %s' % ('stage', 'time', 'peak mem', 'vs baseline'))
+        for name, result in results.items():
+            comparison = ''
+            if name in baseline:
+                change = (result['time_ms'] / baseline[name]['time_ms'] - 1) * 100
+                comparison = '%+.0f%% time, %+.0f KB' % (change, result['peak_kb'] - baseline[name]['peak_kb'])
+                if change > tolerance:
+                    comparison += '   <-- slower'
+
+            print('%-36s %7.2f ms %7.0f KB   %s' % (name, result['time_ms'], result['peak_kb'], comparison))
+
+    def scaling(self, options):
+        rnd = random.Random(options['seed'])
+        exponent = options['exponent']
+        limit = options['limit']
+
+        def measure(func):
+            return '%.1f ms' % (min(timeit.repeat(func, number=1, repeat=options['runs'])) * 1000)
+
+        print('players   exhaustive    branch-and-bound (limit %d)' % limit)
+        for players_num in range(options['min_players'], options['max_players'] + 1, 2):
+            players = [(p.name, p.ladder_mmr) for p in synthetic_players(rnd, players_num)]
+
+            exhaustive = '-'
+            if players_num <= options['exhaustive_max']:
+                exhaustive = measure(lambda: balancer.balance_teams(list(players), exponent))
+
+            bnb = measure(lambda: branch_bound.balance_teams(list(players), exponent, limit=limit))
+
+            print('%7d   %10s    %s' % (players_num, exhaustive, bnb))
@@ -15,14 +15,15 @@ from django.core.management.base import BaseCommand
 import os
 
 from django.core.urlresolvers import reverse
-from django.db.models import Q, Count, Prefetch, Case, When, F
+from django.db.models import Q, Count, Prefetch, F
 from django.utils import timezone
 
-from app.balancer.managers import BalanceResultManager, BalanceAnswerManager
-from app.balancer.models import BalanceAnswer
+from app.balancer.managers import BalanceAnswerManager, BalanceResultManager
+from app.balancer.models import BalanceAnswer, team_member
+from app.balancer.service import BalanceServiceError, balance_service
 from app.ladder.managers import MatchManager, QueueChannelManager
 from app.ladder.models import Player, LadderSettings, LadderQueue, QueuePlayer, QueueChannel, MatchPlayer, \
-    RolesPreference, DiscordChannels, DiscordPoll, ScoreChange
+    RolesPreference, DiscordChannels, DiscordPoll, ScoreChange, PlayerSeasonStats
 
 
 class Command(BaseCommand):
@@ -75,6 +76,7 @@ class Command(BaseCommand):
 
             activate_queue_channels.start()
             deactivate_queue_channels.start()
+            compact_balances.start()
 
         @self.bot.event
         async def on_message(msg):
@@ -250,6 +252,19 @@ class Command(BaseCommand):
                 QueueChannelManager.deactivate_qchannels()
                 await self.setup_queue_messages()
 
+        @tasks.loop(minutes=1)
+        async def compact_balances():
+            dt = timezone.localtime(timezone.now(), pytz.timezone('CET'))
+
+            # at 05:00 delete balance results nobody uses
+            days = LadderSettings.get_solo().balance_retention_days
+            if dt.hour == 5 and dt.minute == 0 and days:
+                print('Compacting balance results.')
+                older_than = timezone.now() - timedelta(days=days)
+                stats = await self.bot.loop.run_in_executor(
+                    None, lambda: BalanceResultManager.compact(older_than, pause=0.1))
+                print(f'Deleted {stats["results"]} results, {stats["answers"]} answers.')
+
         """
         This task removes unnecessary messages (status and pings);
         This is done to make channel clear and also to highlight it 
@@ -462,11 +477,7 @@ class Command(BaseCommand):
         player_url = f'{host}{url}'
 
         season = LadderSettings.get_solo().current_season
-        player.matches = player.matchplayer_set \
-            .filter(match__season=season) \
-            .select_related('match')
-        wins = sum(1 if m.match.winner == m.team else 0 for m in player.matches)
-        losses = len(player.matches) - wins
+        stats = player.season_stats.filter(season=season).first() or PlayerSeasonStats()
 
         await msg.channel.send(
             f'```\n'
@@ -477,7 +488,7 @@ class Command(BaseCommand):
             f'Ladder MMR: {player.ladder_mmr}\n'
             f'Score: {player.score}\n'
             f'Rank: {player.rank_score}\n'
-            f'Games: {len(player.matches)} ({wins}-{losses})\n\n'
+            f'Games: {stats.match_count} ({stats.wins}-{stats.losses})\n\n'
             f'Vouched: {"yes" if player.vouched else "no"}\n'
             f'Roles: {Command.roles_str(player.roles)}\n\n'
             f'{player.description or ""}\n'
@@ -538,7 +549,7 @@ class Command(BaseCommand):
         print(f'Join command from {player}:\n {command}')
 
         channel = QueueChannel.objects.get(discord_id=msg.channel.id)
-        _, _, response = self.player_join_queue(player, channel)
+        _, _, response = await self.player_join_queue(player, channel)
 
         await msg.channel.send(response)
         await self.queues_show()
@@ -600,6 +611,7 @@ class Command(BaseCommand):
 
         channel = QueueChannel.objects.get(discord_id=msg.channel.id)
         queue = Command.add_player_to_queue(player, channel)
+        Command.prepare_queue_balance(queue)
 
         await msg.channel.send(
             f'By a shameless abuse of power `{msg.author.name}` '
@@ -609,7 +621,7 @@ class Command(BaseCommand):
 
         # TODO: this is a separate function
         if queue.players.count() == 10:
-            Command.balance_queue(queue)
+            await Command.balance_queue(queue)
 
             balance_str = ''
             if LadderSettings.get_solo().draft_mode == LadderSettings.AUTO_BALANCE:
@@ -728,15 +740,10 @@ class Command(BaseCommand):
             season = LadderSettings.get_solo().current_season
             qs = Player.objects \
                 .order_by('-score', '-ladder_mmr') \
-                .filter(matchplayer__match__season=season).distinct()\
+                .filter(season_stats__season=season, season_stats__match_count__gt=0) \
                 .annotate(
-                    match_count=Count('matchplayer'),
-                    wins=Count(Case(
-                        When(
-                            matchplayer__team=F('matchplayer__match__winner'), then=1)
-                    )
-                    ),
-                    losses=F('match_count') - F('wins'),
+                    wins=F('season_stats__wins'),
+                    losses=F('season_stats__losses'),
                 )
             players = qs[:limit]
             if bottom:
@@ -1119,12 +1126,16 @@ class Command(BaseCommand):
                 f'I could tell you which ones but I won\'t.')
             return
 
-        _radiant = [(p.name, p.ladder_mmr) for p in radiant]
-        _dire = [(p.name, p.ladder_mmr) for p in dire]
+        _radiant = [team_member(p) for p in radiant]
+        _dire = [team_member(p) for p in dire]
         winner = 0 if winner == 'radiant' else 1
 
         balance = BalanceAnswerManager.balance_custom([_radiant, _dire])
-        MatchManager.record_balance(balance, winner)
+        try:
+            MatchManager.record_balance(balance, winner)
+        except Player.DoesNotExist:
+            await msg.channel.send('Some of mentioned players were just deleted. Match is not recorded.')
+            return
 
         await msg.channel.send(
             f'```\n' +
@@ -1161,7 +1172,7 @@ class Command(BaseCommand):
         await self.queues_show()
         await msg.channel.send(f'`Queue #{qnumber}` has been closed.')
 
-    def player_join_queue(self, player, channel):
+    async def player_join_queue(self, player, channel):
         # check if player is banned
         if player.banned:
             response = f'`{player}`, you are banned.'
@@ -1206,20 +1217,36 @@ class Command(BaseCommand):
 
         queue = Command.add_player_to_queue(player, channel)
 
+        # try to make a game out of everyone who is waiting
+        full_queues = []
+        if queue.players.count() == 10:
+            full_queues = [queue]
+        elif LadderSettings.get_solo().matchmaking:
+            full_queues = QueueChannelManager.matchmake(channel)
+
+            # matchmaker moves players to new queues and signals delete queues left empty,
+            # so look up where player is now
+            queue = LadderQueue.objects.filter(active=True, players=player).first()
+            if not queue:
+                response = f'`{player}`, couldn\'t find your queue. Please join again.'
+                return None, False, response
+
+        Command.prepare_queue_balance(queue)
+
         response = f'`{player}` joined inhouse queue #{queue.id}.\n' + \
                    Command.queue_str(queue)
 
         # TODO: this is a separate function
-        if queue.players.count() == 10:
-            Command.balance_queue(queue)  # todo move this to QueuePlayer signal
+        for q in full_queues:
+            await Command.balance_queue(q)  # todo move this to QueuePlayer signal
 
             balance_str = ''
             if LadderSettings.get_solo().draft_mode == LadderSettings.AUTO_BALANCE:
                 balance_str = f'Proposed balance: \n' + \
-                              Command.balance_str(queue.balance)
+                              Command.balance_str(q.balance)
 
             response += f'\nQueue is full! {balance_str} \n' + \
-                        f' '.join(self.player_mention(p) for p in queue.players.all()) + \
+                        f' '.join(self.player_mention(p) for p in q.players.all()) + \
                         f'\nYou have 5 min to join the lobby.'
 
         return queue, True, response
@@ -1251,15 +1278,30 @@ class Command(BaseCommand):
         return queue
 
     @staticmethod
-    def balance_queue(queue):
-        players = list(queue.players.all())
-        result = BalanceResultManager.balance_teams(players)
+    def prepare_queue_balance(queue):
+        # queue waits for its last player, most of the balance can be done already;
+        # it's done by a worker, nobody waits for it
+        players = list(queue.players.all().select_related('roles'))
+        if len(players) == 9:
+            asyncio.ensure_future(balance_service.prepare(queue.id, players))
 
-        queue.balance = result.answers.first()
+    @staticmethod
+    async def balance_queue(queue):
+        players = list(queue.players.all().select_related('roles'))
+        try:
+            result = await balance_service.balance_teams(players, limit=1, prepared=queue.id)
+        except BalanceServiceError as e:
+            print(f'Couldn\'t balance queue #{queue.id}: {e}')
+            return
+
+        queue.balance = BalanceResultManager.answer(result, 0, save=True)
         queue.save()
 
     @staticmethod
     def balance_str(balance: BalanceAnswer, verbose=True):
+        if not balance:
+            return 'Balance is not ready yet.\n'
+
         host = os.environ.get('BASE_URL', 'localhost:8000')
         url = reverse('balancer:balancer-answer', args=(balance.id,))
         url = '%s%s' % (host, url)
@@ -1686,7 +1728,7 @@ class Command(BaseCommand):
 
         self.queue_messages[message.id] = message  # update message in cache
 
-        queue, added, response = self.player_join_queue(player, q_channel)
+        queue, added, response = await self.player_join_queue(player, q_channel)
         if queue:
             await self.queues_show()
             response = response.split('```')[0]  # take only first part of response text
@@ -1,14 +1,18 @@
 import re
 import random
+import time
 
 from django.utils import timezone
 
 from app.balancer.balancer import role_names
-from app.balancer.models import BalanceAnswer
+from app.balancer.blacklist import ConflictGraph
+from app.balancer.models import BalanceAnswer, team_ids, team_member
 from django.core.management.base import BaseCommand
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from app.balancer.managers import BalanceResultManager, BalanceAnswerManager
+from app.balancer.managers import BalanceAnswerManager, BalanceResultManager
+from app.balancer.service import BalanceServiceError, balance_service
+from app.balancer.swaps import evaluate_swaps
 from app.ladder.managers import MatchManager, PlayerManager
 from django.utils.datetime_safe import datetime
 from enum import IntEnum
@@ -26,6 +30,9 @@ from steam.client.builtins.friends import SteamFriendlist
 
 VERSION = '1.0.2'
 
+# blacklist is kept in memory and reloaded once in a while (in seconds)
+BLACKLIST_REFRESH = 5 * 60
+
 
 class LobbyState(IntEnum):
     UI = 0
@@ -116,7 +123,9 @@ class Command(BaseCommand):
         dota.staff_mode = False
         dota.game_start_time = None
         dota.server = 'EU'
-        dota.players = {}  # TODO: this isn't used atm, make use of it
+        dota.players = {}
+        dota.blacklist = None
+        dota.blacklist_time = 0
         dota.queue = None
         dota.use_queue = LadderSettings.get_solo().use_queue
         dota.sidepick = None
@@ -200,10 +209,11 @@ class Command(BaseCommand):
                 # check if all players have right to play
                 Command.kick_banned_from_lobby(dota)
                 Command.kick_banned_from_playing(dota)
-                # Command.kick_blacklisted(dota)
                 if dota.use_queue:
+                    # queue balance puts blacklisted players in different teams
                     Command.kick_not_in_queue(dota)
                 else:
+                    Command.kick_blacklisted(dota)
                     if dota.balance_answer:
                         Command.kick_unbalanced(dota)
                     if dota.voice_required:
@@ -258,6 +268,7 @@ class Command(BaseCommand):
 
         bot.staff_mode = False
         bot.players = {}
+        bot.blacklist = None  # fresh blacklist for every lobby
         bot.invited_players = []
         bot.lobby_options = {
             'game_name': Command.generate_lobby_name(bot),
@@ -300,6 +311,7 @@ class Command(BaseCommand):
             '!wh': Command.whois_command,
             '!teams': Command.teams_command,
             '!swap': Command.swap_command,
+            '!suggest': Command.suggest_command,
             '!custom': Command.custom_command,
             '!ban': Command.ban_command,  # just a prank command atm
             '!new': Command.new_command,
@@ -325,7 +337,7 @@ class Command(BaseCommand):
         staff_only = ['!staff', '!forcestart', '!fs', '!new', '!lobbykick', '!lk', '!mode', '!server']
 
         disabled_by_queue = [
-            '!register', '!b', '!balance', '!mmr', '!swap', '!voice',
+            '!register', '!b', '!balance', '!mmr', '!swap', '!suggest', '!voice',
         ]
         if bot.use_queue and command in disabled_by_queue:
             bot.channels.lobby.send('Bots are taken hostages by discord queue.')
@@ -396,7 +408,7 @@ class Command(BaseCommand):
             return
 
         # get players from DB using dota id
-        players = Player.objects.filter(dota_id__in=players_steam.keys())
+        players = Player.objects.filter(dota_id__in=players_steam.keys()).select_related('roles')
         players = {player.dota_id: player for player in players}
 
         unregistered = [players_steam[p].name for p in players_steam.keys()
@@ -410,7 +422,11 @@ class Command(BaseCommand):
         print(players)
 
         players = players.values()
-        result = BalanceResultManager.balance_teams(players)
+        try:
+            result = balance_service.balance_teams_gevent(players, limit=40)
+        except BalanceServiceError as e:
+            bot.channels.lobby.send(str(e))
+            return
 
         try:
             answer_num = int(command.split(' ')[1])
@@ -423,7 +439,7 @@ class Command(BaseCommand):
 
         url = '%s%s?page=%s' % (host, url, answer_num)
 
-        bot.balance_answer = answer = result.answers.all()[answer_num-1]
+        bot.balance_answer = answer = BalanceResultManager.answer(result, answer_num-1, save=True)
         for i, team in enumerate(answer.teams):
             player_names = [p[0] for p in team['players']]
             bot.channels.lobby.send('Team %d (avg. %d): %s' %
@@ -661,9 +677,10 @@ class Command(BaseCommand):
             bot.channels.lobby.send(f'{member.name}: I don\'t know him')
             return
 
-        match_count = player.matchplayer_set.filter(
-            match__season=LadderSettings.get_solo().current_season
-        ).count()
+        match_count = player.season_stats\
+            .filter(season=LadderSettings.get_solo().current_season)\
+            .values_list('match_count', flat=True)\
+            .first() or 0
 
         roles = ' '.join(str(getattr(player.roles, r)) for r in role_names)
         bot.channels.lobby.send(
@@ -707,22 +724,22 @@ class Command(BaseCommand):
             bot.channels.lobby.send('Please balance teams first.')
             return
 
-        # get player indexes
+        # get player indexes, can be several pairs: !swap 1 2 3 4
         try:
-            player_1 = int(command.split(' ')[1]) - 1
-            player_2 = int(command.split(' ')[2]) - 1
-            if not 0 <= player_1 < 5 or not 0 <= player_2 < 5:
+            indexes = [int(x) - 1 for x in command.split(' ')[1:]]
+            if not indexes or len(indexes) % 2 or not all(0 <= i < 5 for i in indexes):
                 raise ValueError
-        except (IndexError, ValueError):
+        except ValueError:
             bot.channels.lobby.send('Can\'t do that')
             return
 
         teams = [team['players'] for team in bot.balance_answer.teams]
 
         # swap players and generate new balance
-        swap = teams[0][player_1]
-        teams[0][player_1] = teams[1][player_2]
-        teams[1][player_2] = swap
+        for player_1, player_2 in zip(indexes[::2], indexes[1::2]):
+            swap = teams[0][player_1]
+            teams[0][player_1] = teams[1][player_2]
+            teams[1][player_2] = swap
 
         bot.balance_answer = BalanceAnswerManager.balance_custom(teams)
 
@@ -732,6 +749,38 @@ class Command(BaseCommand):
                 'Team %d (avg. %d): %s' %
                 (i+1, team['mmr'], ' | '.join(player_names)))
 
+    # shows best swaps for current teams, doesn't change anything
+    @staticmethod
+    def suggest_command(bot, msg):
+        command = msg.text
+        print('Suggest command:')
+        print(command)
+
+        if not bot.balance_answer:
+            bot.channels.lobby.send('Please balance teams first.')
+            return
+
+        # !suggest 2 also shows swaps of 2 players from each team
+        try:
+            swap_size = max(1, min(2, int(command.split(' ')[1])))
+        except (IndexError, ValueError):
+            swap_size = 1
+
+        teams = [team['players'] for team in bot.balance_answer.teams]
+        mmr_exponent = LadderSettings.get_solo().balance_exponent
+        swaps = evaluate_swaps(teams, mmr_exponent, max_swap_size=swap_size, limit=3)
+
+        current_diff = abs(bot.balance_answer.teams[0]['mmr'] - bot.balance_answer.teams[1]['mmr'])
+        bot.channels.lobby.send('Current MMR difference: %d' % current_diff)
+
+        for swap in swaps:
+            players_1 = ' + '.join(teams[0][i][0] for i in swap['swap'][0])
+            players_2 = ' + '.join(teams[1][i][0] for i in swap['swap'][1])
+            indices = ' '.join('%d %d' % (i + 1, j + 1) for i, j in zip(*swap['swap']))
+            bot.channels.lobby.send(
+                '%s <-> %s: MMR difference %d (!swap %s)' %
+                (players_1, players_2, swap['mmr_diff'], indices))
+
     # creates balance record for already made-up teams
     # TODO: refactor this code to decrese repetition
     # TODO: between this func, balance_command() and check_teams()
@@ -762,9 +811,9 @@ class Command(BaseCommand):
             return
 
         # create balance record for these players
-        radiant = [(p.name, p.ladder_mmr) for key, p in players.items()
+        radiant = [team_member(p) for key, p in players.items()
                    if players_steam[int(key)].team == DOTA_GC_TEAM.GOOD_GUYS]
-        dire = [(p.name, p.ladder_mmr) for key, p in players.items()
+        dire = [team_member(p) for key, p in players.items()
                 if players_steam[int(key)].team == DOTA_GC_TEAM.BAD_GUYS]
 
         bot.balance_answer = BalanceAnswerManager.balance_custom([radiant, dire])
@@ -1138,12 +1187,15 @@ class Command(BaseCommand):
             return
 
         # TODO: write smth like "record_balance(answer, 0 if RadVictory else 1, match_id)"
-        if lobby.match_outcome == EMatchOutcome.RadVictory:
-            print('Radiant won!')
-            MatchManager.record_balance(queue.balance, 0, lobby.match_id)
-        elif lobby.match_outcome == EMatchOutcome.DireVictory:
-            print('Dire won!')
-            MatchManager.record_balance(queue.balance, 1, lobby.match_id)
+        try:
+            if lobby.match_outcome == EMatchOutcome.RadVictory:
+                print('Radiant won!')
+                MatchManager.record_balance(queue.balance, 0, lobby.match_id)
+            elif lobby.match_outcome == EMatchOutcome.DireVictory:
+                print('Dire won!')
+                MatchManager.record_balance(queue.balance, 1, lobby.match_id)
+        except Player.DoesNotExist as e:
+            print('Match is not recorded: %s' % e)
 
     # checks if teams are setup according to balance
     @staticmethod
@@ -1162,12 +1214,7 @@ class Command(BaseCommand):
         print(game_teams)
 
         # get teams from balance result (player ids)
-        # TODO: make function balance_teams_to_ids(balance_answer)
-        balancer_teams = [
-            set(Player.objects.filter(name__in=[player[0] for player in team['players']])
-                              .values_list('dota_id', flat=True))
-            for team in bot.balance_answer.teams
-        ]
+        balancer_teams = team_ids(bot.balance_answer.teams, field=3)
 
         print('Balancer teams:')
         print(balancer_teams)
@@ -1266,42 +1313,37 @@ class Command(BaseCommand):
 
         bot.players = current_players
 
-        print('Old players: %s' % old_players)
-        print('Current players: %s' % current_players)
-
         if not old_players or not current_players:
             return
 
         joined_players = set(current_players.keys()) - set(old_players.keys())
+        if not joined_players:
+            return
 
-        players = Player.objects.filter(
-            dota_id__in=joined_players
-        ).prefetch_related('blacklist', 'blacklisted_by')
-
-        print('New guys: %s' % players)
-
-        for p in players:
-            print('Player: %s' % p)
-            print('Blacklist: %s' % p.blacklist.all())
-            print('Blacklisted by: %s' % p.blacklisted_by.all())
-
-            blacklist = list(p.blacklist.all()) + list(p.blacklisted_by.all())
-            blacklist = [int(b.dota_id) for b in blacklist]
-            blacklist = set(blacklist)
-
-            print('Set: %s' % blacklist)
-            collision = blacklist.intersection(set(old_players.keys()))
-            print('Collision: %s' % collision)
+        # runs on every lobby change, so no DB queries here
+        blacklist = Command.blacklist_graph(bot)
+        old_ids = [str(dota_id) for dota_id in old_players]
 
+        for dota_id in joined_players:
+            collision = blacklist.conflicts_with(str(dota_id), old_ids)
             if not collision:
                 continue  # this guy can play
 
             # tell player he collides with other players
-            collision = [old_players[c].name for c in collision]
+            collision = [old_players[int(c)].name for c in collision]
             bot.channels.lobby.send('%s, you can\'t play with: %s' %
-                                   (p.name, ', '.join(collision)))
+                                   (current_players[dota_id].name, ', '.join(collision)))
+
+            bot.practice_lobby_kick_from_team(dota_id)
+
+    @staticmethod
+    def blacklist_graph(bot):
+        # whole blacklist is small, one query loads it by dota ids
+        if bot.blacklist is None or time.time() - bot.blacklist_time > BLACKLIST_REFRESH:
+            bot.blacklist = ConflictGraph.load(field='dota_id')
+            bot.blacklist_time = time.time()
 
-            bot.practice_lobby_kick_from_team(int(p.dota_id))
+        return bot.blacklist
 
     @staticmethod
     def kick_banned_from_playing(bot):
@@ -1341,11 +1383,7 @@ class Command(BaseCommand):
             if player.team in (DOTA_GC_TEAM.GOOD_GUYS, DOTA_GC_TEAM.BAD_GUYS)
         }
 
-        players_balance = [player for team in bot.balance_answer.teams
-                           for player in team['players']]
-        players_balance = Player.objects\
-            .filter(name__in=[player[0] for player in players_balance])\
-            .values_list('dota_id', flat=True)
+        players_balance = set.union(*team_ids(bot.balance_answer.teams, field=3))
 
         for player in players_steam.keys():
             if str(player) not in players_balance:
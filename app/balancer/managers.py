@@ -1,38 +1,412 @@
-from django.db import models, transaction
-from app.balancer.balancer import balance_teams, balance_from_teams, role_balance_teams
+import hashlib
+import json
+import time
+from collections import namedtuple
+
+from django.core.cache import cache
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Q
+from app.balancer import balancer, branch_bound, vectorized
+from app.balancer.balancer import balance_from_teams, role_names
+from app.balancer.blacklist import ConflictGraph
 from app.ladder.models import LadderSettings
 
 
+ENGINES = {
+    LadderSettings.PYTHON_ENGINE: balancer,
+    LadderSettings.NUMPY_ENGINE: vectorized,
+}
+
+
+# plain data copies of players, engines need nothing else from them;
+# unlike models they can be sent to a worker process
+PlayerSnapshot = namedtuple('PlayerSnapshot', ['id', 'name', 'ladder_mmr', 'roles', 'dota_id'])
+RolesSnapshot = namedtuple('RolesSnapshot', role_names)
+
+# everything we need to balance players and to save the result;
+# blacklist has pairs of players names who shouldn't play in the same team,
+# pareto has weights for pareto ranking (None for threshold ranking);
+# lazy jobs save only their input, not the answers
+BalanceJob = namedtuple('BalanceJob', [
+    'key', 'players', 'mmr_exponent', 'role_balancing', 'limit', 'engine', 'blacklist', 'pareto', 'lazy',
+])
+
+
+def sqlite_pragma(name):
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA %s' % name)
+        return cursor.fetchall()
+
+
+def sqlite_size():
+    # database file size and how much of it is used by data, in bytes
+    page_size = sqlite_pragma('page_size')[0][0]
+    page_count = sqlite_pragma('page_count')[0][0]
+    free_pages = sqlite_pragma('freelist_count')[0][0]
+
+    return page_count * page_size, (page_count - free_pages) * page_size
+
+
+def run_balance_job(job):
+    """
+    Balances players of the job. Doesn't touch DB, so it's safe to run in another process.
+
+    :return: list of answers
+    """
+    # seed is taken from the key, so the same input always gives the same answers
+    seed = int(job.key, 16)
+    engine = ENGINES[job.engine]
+
+    if job.role_balancing:
+        return engine.role_balance_teams(
+            list(job.players), job.mmr_exponent,
+            seed=seed, limit=job.limit, blacklist=job.blacklist, pareto=job.pareto,
+        )
+
+    # exhaustive search explodes for bigger lobbies
+    if len(job.players) > 10:
+        engine = branch_bound
+
+    players = [(p.name, p.ladder_mmr) for p in job.players]
+    return engine.balance_teams(players, job.mmr_exponent, seed=seed, limit=job.limit, blacklist=job.blacklist)
+
+
 class BalanceResultManager(models.Manager):
+    # cached results are evicted after this time (or earlier, when cache is culled)
+    cache_timeout = 24 * 60 * 60
+
     @staticmethod
-    def balance_teams(players, role_balancing=True):
+    def balance_key(players, mmr_exponent, role_balancing, limit=None, blacklist=(), pareto=None):
+        # everything that affects balance answers goes into the key,
+        # so if any of it changes, we get a new key and a fresh balance
+        data = {
+            'players': [
+                [p.id, p.ladder_mmr] + ([getattr(p.roles, r) for r in role_names] if role_balancing else [])
+                for p in sorted(players, key=lambda p: p.id)
+            ],
+            'mmr_exponent': mmr_exponent,
+            'role_balancing': role_balancing,
+            'limit': limit,
+            'blacklist': sorted(blacklist),
+            'pareto': pareto,
+        }
+        data = json.dumps(data, sort_keys=True).encode()
+
+        return hashlib.sha1(data).hexdigest()
+
+    @staticmethod
+    def cached_result(key):
         from app.balancer.models import BalanceResult, BalanceAnswer
 
-        # balance teams and save result
+        result_id = cache.get('balance_result_%s' % key)
+        if result_id is None:
+            return None
+
+        # answers can be linked to only one match or queue,
+        # so results that are already in use can't be given out again
+        in_use = BalanceAnswer.objects\
+            .filter(result_id=result_id)\
+            .filter(Q(match__isnull=False) | Q(ladderqueue__isnull=False))\
+            .exists()
+        if in_use:
+            return None
+
+        return BalanceResult.objects.filter(id=result_id).first()
+
+    @staticmethod
+    def snapshots(players, role_balancing=True):
+        return [
+            PlayerSnapshot(
+                id=p.id,
+                name=p.name,
+                ladder_mmr=p.ladder_mmr,
+                roles=RolesSnapshot(*(getattr(p.roles, r) for r in role_names)) if role_balancing else None,
+                dota_id=p.dota_id,
+            )
+            for p in sorted(players, key=lambda p: p.id)
+        ]
+
+    @staticmethod
+    def balance_job(players, role_balancing=True, limit=None):
+        """
+        Collects everything needed to balance players.
+
+        :param role_balancing: balance by roles or by MMR only
+        :param limit: save only this amount of best answers, all of them if None
+        :return: BalanceJob
+        """
         # TODO: make mmr_exponent changable from admin panel
-        mmr_exponent = LadderSettings.get_solo().balance_exponent
-        if role_balancing:
-            answers = role_balance_teams(players, mmr_exponent)
-        else:
-            players = [(p.name, p.ladder_mmr) for p in players]
-            answers = balance_teams(players, mmr_exponent)
+        settings = LadderSettings.get_solo()
+        mmr_exponent = settings.balance_exponent
+
+        players = BalanceResultManager.snapshots(players, role_balancing)
+
+        # blacklist of these players only, engines get it by names
+        names = {p.id: p.name for p in players}
+        blacklist = [(names[a], names[b]) for a, b in ConflictGraph.load(list(names)).pairs()]
+
+        pareto = None
+        if role_balancing and settings.balance_ranking == LadderSettings.PARETO_RANKING:
+            pareto = (settings.pareto_role_weight, settings.pareto_mmr_weight)
+
+        return BalanceJob(
+            key=BalanceResultManager.balance_key(players, mmr_exponent, role_balancing, limit, blacklist, pareto),
+            players=players,
+            mmr_exponent=mmr_exponent,
+            role_balancing=role_balancing,
+            limit=limit,
+            engine=settings.balancer_engine,
+            blacklist=blacklist,
+            pareto=pareto,
+            lazy=settings.lazy_balance_answers,
+        )
+
+    @staticmethod
+    def job_snapshot(job):
+        # job as JSON, enough to balance the same players again and get the same answers
+        return {
+            'key': job.key,
+            'players': [
+                [p.id, p.name, p.ladder_mmr, list(p.roles) if p.roles else None, p.dota_id]
+                for p in job.players
+            ],
+            'mmr_exponent': job.mmr_exponent,
+            'role_balancing': job.role_balancing,
+            'limit': job.limit,
+            'engine': job.engine,
+            'blacklist': [list(pair) for pair in job.blacklist],
+            'pareto': list(job.pareto) if job.pareto else None,
+        }
+
+    @staticmethod
+    def snapshot_job(snapshot):
+        # reverse of job_snapshot()
+        return BalanceJob(
+            key=snapshot['key'],
+            players=[
+                PlayerSnapshot(p_id, name, mmr, RolesSnapshot(*roles) if roles else None, dota_id)
+                for p_id, name, mmr, roles, dota_id in snapshot['players']
+            ],
+            mmr_exponent=snapshot['mmr_exponent'],
+            role_balancing=snapshot['role_balancing'],
+            limit=snapshot['limit'],
+            engine=snapshot['engine'],
+            blacklist=[tuple(pair) for pair in snapshot['blacklist']],
+            pareto=tuple(snapshot['pareto']) if snapshot['pareto'] else None,
+            lazy=True,
+        )
+
+    @staticmethod
+    def save_answers(job, answers):
+        from app.balancer.models import BalanceResult, BalanceAnswer, pack_teams
+
+        # players are saved once per result, answers only have their indices
+        players = [[p.id, p.name, p.ladder_mmr, p.dota_id] for p in job.players]
+        index = {p.name: i for i, p in enumerate(job.players)}
+
+        if job.lazy:
+            # answers are balanced again when they are needed,
+            # until then we keep them in cache
+            result = BalanceResult.objects.create(
+                mmr_exponent=job.mmr_exponent,
+                players=players,
+                snapshot=BalanceResultManager.job_snapshot(job),
+            )
+            cache.set('balance_answers_%s' % result.id, answers, BalanceResultManager.cache_timeout)
+            cache.set('balance_result_%s' % job.key, result.id, BalanceResultManager.cache_timeout)
+            return result
 
         with transaction.atomic():
-            result = BalanceResult.objects.create(mmr_exponent=mmr_exponent)
-            for answer in answers:
-                BalanceAnswer.objects.create(
-                    teams=answer['teams'],
+            result = BalanceResult.objects.create(mmr_exponent=job.mmr_exponent, players=players)
+            BalanceAnswer.objects.bulk_create([
+                BalanceAnswer(
+                    packed=pack_teams(answer['teams'], index),
                     mmr_diff=answer['mmr_diff'],
                     mmr_diff_exp=answer['mmr_diff_exp'],
                     result=result
                 )
+                for answer in answers
+            ])
+
+        cache.set('balance_result_%s' % job.key, result.id, BalanceResultManager.cache_timeout)
 
         return result
 
+    @staticmethod
+    def balance_teams(players, role_balancing=True, limit=None):
+        """
+        Balances players and saves the result.
+
+        :param role_balancing: balance by roles or by MMR only
+        :param limit: save only this amount of best answers, all of them if None
+        :return: BalanceResult
+        """
+        job = BalanceResultManager.balance_job(players, role_balancing, limit)
+
+        # same players get balanced over and over (lobby !balance, queue refills),
+        # so reuse previous result if nothing has changed since then
+        result = BalanceResultManager.cached_result(job.key)
+        if result:
+            return result
+
+        answers = run_balance_job(job)
+
+        return BalanceResultManager.save_answers(job, answers)
+
+    @staticmethod
+    def lazy_answers(result):
+        # answers of a lazy result, from cache or balanced again
+        key = 'balance_answers_%s' % result.id
+        answers = cache.get(key)
+        if answers is None:
+            answers = run_balance_job(BalanceResultManager.snapshot_job(result.snapshot))
+            cache.set(key, answers, BalanceResultManager.cache_timeout)
+
+        return answers
+
+    @staticmethod
+    def lazy_answer(result, index, answer):
+        # unsaved BalanceAnswer for an answer of a lazy result
+        from app.balancer.models import BalanceAnswer, pack_teams
+
+        players = {p[1]: i for i, p in enumerate(result.players)}
+        return BalanceAnswer(
+            packed=pack_teams(answer['teams'], players),
+            mmr_diff=answer['mmr_diff'],
+            mmr_diff_exp=answer['mmr_diff_exp'],
+            result=result,
+            index=index,
+        )
+
+    @staticmethod
+    def answers(result):
+        """
+        All answers of the result, best first.
+        Lazy results have saved only answers that were linked to something,
+        the others are unsaved BalanceAnswer objects (see answer() to save them).
+
+        :return: list of BalanceAnswer
+        """
+        if result.snapshot is None:
+            return list(result.answers.all())
+
+        saved = {answer.index: answer for answer in result.answers.all()}
+        return [
+            saved.get(i) or BalanceResultManager.lazy_answer(result, i, answer)
+            for i, answer in enumerate(BalanceResultManager.lazy_answers(result))
+        ]
+
+    @staticmethod
+    def answer(result, index, save=False):
+        """
+        Answer of the result by its position (best answer is 0).
+
+        :param save: save the answer if it's not saved yet;
+                     answers have to be saved before they are linked to a match or queue
+        :return: BalanceAnswer, None if there is no such answer
+        """
+        if result.snapshot is None:
+            answers = list(result.answers.all()[index:index + 1])
+            return answers[0] if answers else None
+
+        answer = result.answers.filter(index=index).first()
+        if answer:
+            return answer
+
+        answers = BalanceResultManager.lazy_answers(result)
+        if not 0 <= index < len(answers):
+            return None
+
+        answer = BalanceResultManager.lazy_answer(result, index, answers[index])
+        if save:
+            try:
+                with transaction.atomic():
+                    answer.save()
+            except IntegrityError:
+                # someone saved this answer while we were balancing it, use theirs
+                answer = result.answers.get(index=index)
+
+        return answer
+
+    @staticmethod
+    def compact(older_than, batch_size=50, pause=0, vacuum=False, dry_run=False):
+        """
+        Deletes results that aren't used by any match or queue.
+        Works in small batches, so bots don't wait for DB lock for long.
+
+        :param older_than: datetime, newer results are kept (and results made before they got a date)
+        :param pause: seconds to wait between batches
+        :param vacuum: give freed space back to file system (SQLite with incremental auto_vacuum only)
+        :param dry_run: only count what would be deleted
+        :return: dict with amounts of deleted results and answers, and bytes reclaimed
+        """
+        from app.balancer.models import BalanceResult, BalanceAnswer
+
+        # custom answers have no result, NULL would make NOT IN exclude everything
+        in_use = BalanceAnswer.objects\
+            .filter(Q(match__isnull=False) | Q(ladderqueue__isnull=False))\
+            .filter(result__isnull=False)\
+            .values('result_id')
+        unused = BalanceResult.objects\
+            .filter(date__lt=older_than)\
+            .exclude(id__in=in_use)
+
+        stats = {'results': 0, 'answers': 0, 'bytes': None, 'file_bytes': None, 'vacuumed': False}
+
+        if dry_run:
+            stats['results'] = unused.count()
+            stats['answers'] = BalanceAnswer.objects.filter(result__in=unused).count()
+            return stats
+
+        sqlite = connection.vendor == 'sqlite'
+        if sqlite:
+            file_before, used_before = sqlite_size()
+
+        while True:
+            ids = list(unused.values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+
+            with transaction.atomic():
+                # check again, an answer could get a match since we've picked these results
+                batch = unused.filter(id__in=ids)
+                stats['answers'] += BalanceAnswer.objects.filter(result__in=batch).delete()[0]
+                stats['results'] += batch.delete()[1].get(BalanceResult._meta.label, 0)
+
+            if pause:
+                time.sleep(pause)
+
+        if sqlite:
+            # free pages go back to file system only in incremental auto_vacuum mode
+            # (it's turned on with "PRAGMA auto_vacuum = INCREMENTAL" followed by full VACUUM)
+            if vacuum and sqlite_pragma('auto_vacuum')[0][0] == 2:
+                sqlite_pragma('incremental_vacuum')
+                stats['vacuumed'] = True
+
+            file_after, used_after = sqlite_size()
+            stats['bytes'] = used_before - used_after
+            stats['file_bytes'] = file_before - file_after
+
+        return stats
+
 
 class BalanceAnswerManager(models.Manager):
+    # rendered answers of balancer pages are evicted after this time
+    view_cache_timeout = 60 * 60
+
+    @staticmethod
+    def view_cache_key(answer):
+        # answers of lazy results can be unsaved, they have the same key before and after saving
+        if answer.index is not None:
+            return 'balance_answer_view_%s_%s' % (answer.result_id, answer.index)
+
+        return 'balance_answer_view_%s' % answer.id
+
     @staticmethod
     def balance_custom(teams):
+        """
+        :param teams: two lists of players (see models.team_member)
+        """
         from app.balancer.models import BalanceAnswer
 
         mmr_exponent = LadderSettings.get_solo().balance_exponent
@@ -44,4 +418,4 @@ class BalanceAnswerManager(models.Manager):
             mmr_diff_exp=answer['mmr_diff_exp'],
         )
 
-        return answer
\ No newline at end of file
+        return answer
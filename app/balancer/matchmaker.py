@@ -0,0 +1,149 @@
+"""
+Matchmaker that picks the best 10 players out of everyone who is waiting in queues.
+
+Queues are filled first-come-first-served, so when a lot of people are queueing
+we can often make a better game by taking players from the whole pool.
+We never enumerate all C(N, 10) sets though: the longest waiting player
+always gets into the game, only players in his MMR range are considered
+and only a few candidate sets around him are actually balanced.
+"""
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+from app.balancer import vectorized
+
+
+MATCH_SIZE = 10
+
+# players are matched within this MMR range around the longest waiting player;
+# range grows while he waits, so nobody gets stuck in the queue forever
+MMR_RANGE = 1500
+MMR_RANGE_GROWTH = 100  # per minute of waiting
+
+# how much one minute of waiting is worth compared to MMR difference between teams
+WAIT_WEIGHT = 5
+
+
+# wait is in minutes
+Candidate = namedtuple('Candidate', ['id', 'mmr', 'wait'])
+
+# player in a queue as we get him from DB;
+# filter_mmr is what channel MMR limits are checked against (see Player.filter_mmr)
+Waiting = namedtuple('Waiting', ['id', 'mmr', 'filter_mmr', 'joined_date'])
+
+
+def mmr_range(anchor):
+    return MMR_RANGE + MMR_RANGE_GROWTH * anchor.wait
+
+
+def candidates_around(pool, mmrs, anchor):
+    """
+    Players from pool that fit into MMR range of anchor.
+
+    :param pool: candidates sorted by MMR
+    :param mmrs: MMRs of pool, used for binary search
+    """
+    r = mmr_range(anchor)
+    return pool[bisect_left(mmrs, anchor.mmr - r):bisect_right(mmrs, anchor.mmr + r)]
+
+
+def candidate_sets(candidates, anchor):
+    """
+    Sets of players worth balancing.
+
+    Neighbours by MMR give closest games, so we take every window of 10
+    players (by MMR) that includes anchor. Also we take 10 longest waiting
+    players, so those who wait long enough play even if games are a bit less even.
+    """
+    sets = []
+
+    ind = candidates.index(anchor)
+    for start in range(max(0, ind - MATCH_SIZE + 1), min(ind, len(candidates) - MATCH_SIZE) + 1):
+        sets.append(candidates[start:start + MATCH_SIZE])
+
+    by_wait = sorted(candidates, key=lambda c: -c.wait)
+    longest = [anchor] + [c for c in by_wait if c is not anchor][:MATCH_SIZE - 1]
+    if set(longest) not in [set(s) for s in sets]:
+        sets.append(longest)
+
+    return sets
+
+
+def wait_bonus(players):
+    return WAIT_WEIGHT * sum(p.wait for p in players)
+
+
+def set_cost(players, mmr_exponent):
+    """
+    Less is better: MMR difference of the best balance we can get
+    minus bonus for time these players have been waiting.
+    """
+    answer = vectorized.balance_teams([(p.id, p.mmr) for p in players], mmr_exponent, limit=1)[0]
+    return answer['mmr_diff'] - wait_bonus(players)
+
+
+def best_set(candidates, anchor, mmr_exponent):
+    """
+    Picks best set of 10 players that includes anchor.
+    Balance can't be better than zero MMR difference, so we look at sets
+    with the biggest wait bonus first and stop when the rest can't win.
+    """
+    sets = candidate_sets(candidates, anchor)
+    sets.sort(key=lambda s: -wait_bonus(s))
+
+    best, best_cost = None, None
+    for players in sets:
+        if best is not None and -wait_bonus(players) >= best_cost:
+            break
+
+        cost = set_cost(players, mmr_exponent)
+        if best is None or cost < best_cost:
+            best, best_cost = players, cost
+
+    return best
+
+
+def find_matches(pool, mmr_exponent=3):
+    """
+    Picks sets of 10 players to start games with.
+
+    :param pool: list of Candidate
+    :return: list of matches, each match is a list of 10 players ids
+    """
+    pool = sorted(pool, key=lambda c: c.mmr)
+    matches = []
+
+    # longest waiting players go first
+    for anchor in sorted(pool, key=lambda c: -c.wait):
+        if anchor not in pool:
+            continue  # already got a game
+
+        mmrs = [c.mmr for c in pool]
+        candidates = candidates_around(pool, mmrs, anchor)
+        if len(candidates) < MATCH_SIZE:
+            continue
+
+        players = best_set(candidates, anchor, mmr_exponent)
+        matches.append([p.id for p in players])
+
+        pool = [c for c in pool if c not in players]
+
+    return matches
+
+
+def pick_matches(waiting, now, min_mmr, max_mmr, mmr_exponent=3):
+    """
+    Picks games for a channel out of players waiting in queues.
+
+    :param waiting: list of Waiting
+    :param min_mmr, max_mmr: MMR limits of the channel, max_mmr 0 means no limit
+    :return: list of matches, each match is a list of 10 players ids
+    """
+    pool = [
+        Candidate(id=p.id, mmr=p.mmr, wait=(now - p.joined_date).total_seconds() / 60)
+        for p in waiting
+        # same check as when player joins a queue
+        if p.filter_mmr >= min_mmr and not p.filter_mmr > max_mmr > 0
+    ]
+
+    return find_matches(pool, mmr_exponent)
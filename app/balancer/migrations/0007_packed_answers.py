@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 09:40
+from __future__ import unicode_literals
+
+import collections
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('balancer', '0006_auto_20170109_1401'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='balanceresult',
+            name='players',
+            field=jsonfield.fields.JSONField(default=list),
+        ),
+        migrations.RenameField(
+            model_name='balanceanswer',
+            old_name='teams',
+            new_name='teams_json',
+        ),
+        migrations.AlterField(
+            model_name='balanceanswer',
+            name='teams_json',
+            field=jsonfield.fields.JSONField(db_column='teams', load_kwargs={'object_pairs_hook': collections.OrderedDict}, null=True),
+        ),
+        migrations.AddField(
+            model_name='balanceanswer',
+            name='packed',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 09:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('balancer', '0007_packed_answers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='balanceanswer',
+            name='index',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='balanceresult',
+            name='snapshot',
+            field=jsonfield.fields.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def add_ids(apps, schema_editor):
+    BalanceResult = apps.get_model('balancer', 'BalanceResult')
+    BalanceAnswer = apps.get_model('balancer', 'BalanceAnswer')
+    Player = apps.get_model('ladder', 'Player')
+
+    # old answers only have names; players renamed since then get no ids
+    by_id = {p_id: dota_id for p_id, dota_id in Player.objects.values_list('id', 'dota_id')}
+    by_name = {name: (p_id, dota_id) for p_id, name, dota_id in Player.objects.values_list('id', 'name', 'dota_id')}
+
+    # packed answers take ids from result players, they only miss dota ids
+    for result in BalanceResult.objects.exclude(players=[]).iterator():
+        players = [p[:3] + [by_id.get(p[0])] for p in result.players]
+        snapshot = result.snapshot
+        if snapshot:
+            snapshot['players'] = [p[:4] + [by_id.get(p[0])] for p in snapshot['players']]
+        BalanceResult.objects.filter(id=result.id).update(players=players, snapshot=snapshot)
+
+    for answer in BalanceAnswer.objects.filter(teams_json__isnull=False).only('id', 'teams_json').iterator():
+        teams = answer.teams_json
+        for team in teams:
+            team['players'] = [p[:2] + list(by_name.get(p[0], (None, None))) for p in team['players']]
+        BalanceAnswer.objects.filter(id=answer.id).update(teams_json=teams)
+
+
+def remove_ids(apps, schema_editor):
+    BalanceResult = apps.get_model('balancer', 'BalanceResult')
+    BalanceAnswer = apps.get_model('balancer', 'BalanceAnswer')
+
+    for result in BalanceResult.objects.exclude(players=[]).iterator():
+        players = [p[:3] for p in result.players]
+        snapshot = result.snapshot
+        if snapshot:
+            snapshot['players'] = [p[:4] for p in snapshot['players']]
+        BalanceResult.objects.filter(id=result.id).update(players=players, snapshot=snapshot)
+
+    for answer in BalanceAnswer.objects.filter(teams_json__isnull=False).only('id', 'teams_json').iterator():
+        teams = answer.teams_json
+        for team in teams:
+            team['players'] = [p[:2] for p in team['players']]
+        BalanceAnswer.objects.filter(id=answer.id).update(teams_json=teams)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('balancer', '0008_lazy_answers'),
+        ('ladder', '0079_laddersettings_lazy_balance_answers'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_ids, remove_ids),
+    ]
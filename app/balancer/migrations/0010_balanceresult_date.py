@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 09:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('balancer', '0009_team_member_ids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='balanceresult',
+            name='date',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 10:18
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def drop_duplicates(apps, schema_editor):
+    # keep one answer per position; extra copies that a match or queue uses
+    # stay as they are, but without position, so they don't break the constraint
+    BalanceAnswer = apps.get_model('balancer', 'BalanceAnswer')
+
+    duplicates = BalanceAnswer.objects\
+        .filter(result__isnull=False, index__isnull=False)\
+        .values('result', 'index')\
+        .annotate(count=Count('id'))\
+        .filter(count__gt=1)
+
+    for duplicate in duplicates:
+        answers = BalanceAnswer.objects\
+            .filter(result=duplicate['result'], index=duplicate['index'])\
+            .order_by('id')
+        first = answers[0].id
+
+        answers.exclude(id=first).filter(match__isnull=True, ladderqueue__isnull=True).delete()
+        answers.exclude(id=first).update(index=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('balancer', '0010_balanceresult_date'),
+        ('ladder', '0082_player_sums'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='balanceanswer',
+            unique_together=set([('result', 'index')]),
+        ),
+    ]
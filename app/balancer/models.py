@@ -1,4 +1,3 @@
-
 import collections
 from django.db import models
 from jsonfield import JSONField
@@ -8,12 +7,116 @@ from jsonfield import JSONField
 # with the same 10 players
 class BalanceResult(models.Model):
     mmr_exponent = models.FloatField(default=3)
+    date = models.DateTimeField(auto_now_add=True, null=True)
+
+    # players of this balance as [id, name, mmr, dota_id], answers refer to them by index
+    players = JSONField(default=list)
+
+    # input of the balance (see BalanceResultManager.job_snapshot);
+    # results that have it don't save their answers, they are balanced again from it
+    snapshot = JSONField(null=True, blank=True)
+
+
+def pack_teams(teams, index):
+    """
+    Packs teams of balance answer into a flat list of numbers. For every team:
+    amount of players, players indices in BalanceResult.players,
+    their role scores (if there are any), team MMR, team MMR exponent
+    and team role score (if there is any).
+
+    :param index: player name -> index in BalanceResult.players
+    """
+    packed = [int('role_score' in teams[0])]
+    for team in teams:
+        packed.append(len(team['players']))
+        packed.extend(index[p[0]] for p in team['players'])
+        packed.extend(team.get('role_score', []))
+        packed.extend([team['mmr'], team['mmr_exp']])
+        if 'role_score_sum' in team:
+            packed.append(team['role_score_sum'])
+
+    return ','.join(str(x) for x in packed)
+
+
+def unpack_teams(packed, players):
+    """
+    Reverse of pack_teams(), gives teams in the same format as balancer does.
+
+    :param players: BalanceResult.players
+    """
+    values = iter(int(x) for x in packed.split(','))
+
+    def take(n):
+        return [next(values) for _ in range(n)]
+
+    has_roles = next(values)
+    teams = []
+    for _ in range(2):
+        players_num = next(values)
+        team = collections.OrderedDict()
+        team['players'] = [
+            [players[i][1], players[i][2], players[i][0], players[i][3]]
+            for i in take(players_num)
+        ]
+        role_score = take(players_num) if has_roles else None
+        team['mmr'], team['mmr_exp'] = take(2)
+        if has_roles:
+            team['role_score'] = role_score
+            team['role_score_sum'] = next(values)
+        teams.append(team)
+
+    return teams
+
+
+def team_member(player):
+    # how player goes into teams of BalanceAnswer: name and MMR (as engines give them),
+    # then ids, so we can find players without looking them up by name
+    return [player.name, player.ladder_mmr, player.id, player.dota_id]
+
+
+def team_ids(teams, field=2):
+    """
+    Sets of players ids in every team.
+
+    :param field: 2 for Player.id, 3 for Player.dota_id
+    """
+    return [set(p[field] for p in team['players']) for team in teams]
 
 
 # BalanceAsnwer is a single way to make 2 teams out of 10 players
 class BalanceAnswer(models.Model):
+    # custom answers (and old ones) keep teams as JSON,
+    # answers made by balancer are packed (see pack_teams);
+    # either way they are read and written through teams property
     # TODO: check if we need load_kwargs here
-    teams = JSONField(load_kwargs={'object_pairs_hook': collections.OrderedDict})
+    teams_json = JSONField(db_column='teams', null=True, load_kwargs={'object_pairs_hook': collections.OrderedDict})
+    packed = models.TextField(null=True, blank=True)
     mmr_diff = models.IntegerField()
     mmr_diff_exp = models.IntegerField()
     result = models.ForeignKey(BalanceResult, related_name='answers', null=True)
+
+    # position of the answer in a lazy result
+    index = models.PositiveSmallIntegerField(null=True, blank=True)
+
+    _teams = None
+
+    class Meta:
+        # two bots can save the same lazy answer at once
+        unique_together = ('result', 'index')
+
+    @property
+    def teams(self):
+        # decoded on first use; readers change teams in place, so it's the same list every time
+        if self._teams is None:
+            if self.packed:
+                self._teams = unpack_teams(self.packed, self.result.players)
+            else:
+                self._teams = self.teams_json
+
+        return self._teams
+
+    @teams.setter
+    def teams(self, teams):
+        self._teams = teams
+        self.teams_json = teams
+        self.packed = None
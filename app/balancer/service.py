@@ -0,0 +1,161 @@
+"""
+Balancing service that runs balancer in worker processes.
+
+Bots are single threaded (asyncio loop in discord bot, gevent hub in dota bot),
+so a long balance would freeze them. Here players are balanced in a process pool,
+and bots only wait for the answer without blocking anything else.
+
+Queues that wait for the last player can be prepared (see incremental),
+then the last join is balanced right in the bot, without a trip to the pool.
+"""
+import asyncio
+import concurrent.futures
+import threading
+
+from app.balancer import incremental
+from app.balancer.managers import BalanceResultManager, run_balance_job
+from app.ladder.models import LadderSettings
+
+
+class BalanceServiceError(Exception):
+    pass
+
+
+class BalanceService:
+    def __init__(self, workers=2, max_pending=8, timeout=30, max_prepared=16):
+        """
+        :param workers: amount of worker processes
+        :param max_pending: max amount of balances that are running or waiting for a worker
+        :param timeout: seconds to wait for a balance
+        :param max_prepared: max amount of prepared balances kept in memory
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.executor = None
+        self.max_prepared = max_prepared
+        self.prepared = {}
+
+    def submit(self, job, func=run_balance_job):
+        """
+        Sends balance job to a worker.
+
+        :param func: what worker does with the job, balances it by default
+        :return: concurrent.futures.Future with answers
+        """
+        if not self.slots.acquire(blocking=False):
+            raise BalanceServiceError('Too many balances are running, try again later.')
+
+        # pool is started on first use, so just importing this module doesn't spawn processes
+        if not self.executor:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+
+        try:
+            future = self.executor.submit(func, job)
+        except Exception:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda f: self.slots.release())
+
+        return future
+
+    async def prepare(self, name, players):
+        """
+        Precomputes balance for players that wait for one more player (e.g. a queue of 9).
+        Tables are made by a worker; next balance_teams() with the same name
+        only has to add the last player, that's quick enough to be done right here.
+        Tables give numpy engine answers, so with other engines nothing is prepared.
+
+        :param name: anything that identifies these players, e.g. queue id
+        """
+        job = BalanceResultManager.balance_job(players)
+        if job.engine != LadderSettings.NUMPY_ENGINE:
+            return
+
+        try:
+            future = asyncio.wrap_future(self.submit(job, prepare_job))
+            self.prepared[name] = await asyncio.wait_for(future, self.timeout)
+        except (BalanceServiceError, asyncio.TimeoutError):
+            return  # players will be balanced from scratch
+
+        # forget the oldest ones, their queues are probably gone
+        while len(self.prepared) > self.max_prepared:
+            del self.prepared[next(iter(self.prepared))]
+
+    def run_prepared(self, job, name):
+        """
+        Balances the job with prepared tables.
+
+        :return: answers, None if nothing fits these players
+        """
+        partial = self.prepared.pop(name, None)
+        if partial is None or not job.role_balancing or job.engine != LadderSettings.NUMPY_ENGINE:
+            return None
+
+        return incremental.role_balance_teams(
+            partial, list(job.players), job.mmr_exponent,
+            seed=int(job.key, 16), limit=job.limit, blacklist=job.blacklist, pareto=job.pareto,
+        )
+
+    async def balance_teams(self, players, role_balancing=True, limit=None, prepared=None):
+        """
+        Same as BalanceResultManager.balance_teams(), but awaitable.
+        DB queries are made in the caller's thread, only balancing goes to a worker.
+
+        :param prepared: name given to prepare() when there was one player less
+        """
+        job = BalanceResultManager.balance_job(players, role_balancing, limit)
+
+        result = BalanceResultManager.cached_result(job.key)
+        if result:
+            return result
+
+        answers = self.run_prepared(job, prepared)
+        if answers is not None:
+            return BalanceResultManager.save_answers(job, answers)
+
+        future = asyncio.wrap_future(self.submit(job))
+        try:
+            answers = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise BalanceServiceError('Balance took too long.')
+
+        return BalanceResultManager.save_answers(job, answers)
+
+    def balance_teams_gevent(self, players, role_balancing=True, limit=None):
+        """
+        Same as BalanceResultManager.balance_teams(), but only blocks current greenlet.
+        """
+        import gevent
+
+        job = BalanceResultManager.balance_job(players, role_balancing, limit)
+
+        result = BalanceResultManager.cached_result(job.key)
+        if result:
+            return result
+
+        future = self.submit(job)
+
+        # wait for the worker in gevent's thread pool, so hub keeps running other greenlets
+        waiter = gevent.get_hub().threadpool.spawn(future.result, self.timeout)
+        try:
+            answers = waiter.get()
+        except concurrent.futures.TimeoutError:
+            raise BalanceServiceError('Balance took too long.')
+
+        return BalanceResultManager.save_answers(job, answers)
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def prepare_job(job):
+    # PartialBalance for a worker to make, same settings as the job
+    return incremental.PartialBalance(job.players, job.mmr_exponent)
+
+
+# one service per bot process
+balance_service = BalanceService()
@@ -0,0 +1,19 @@
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from app.balancer.managers import BalanceAnswerManager
+from app.balancer.models import BalanceAnswer
+from app.ladder.models import Match
+
+
+@receiver([post_save, post_delete], sender=Match)
+def match_change(instance, **kwargs):
+    # balancer pages show if a match was recorded for the answer
+    try:
+        answer = instance.balance
+    except BalanceAnswer.DoesNotExist:
+        return  # answer is deleted together with the match
+
+    if answer:
+        cache.delete(BalanceAnswerManager.view_cache_key(answer))
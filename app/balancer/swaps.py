@@ -0,0 +1,69 @@
+"""
+Evaluates player swaps between two already made-up teams.
+
+Instead of building a new balance for every swap (as balance_from_teams() does)
+we take MMR sums of both teams once and update them for all swaps at once:
+swapping players a and b changes team sums by (b - a) and (a - b).
+"""
+import itertools
+
+import numpy as np
+
+from app.balancer.vectorized import mmr_arrays
+
+
+def swap_groups(team_size, swap_size):
+    # indices of players that leave a team, one row per group
+    groups = list(itertools.combinations(range(team_size), swap_size))
+    return np.array(groups, dtype=np.intp).reshape(len(groups), swap_size)
+
+
+def evaluate_swaps(teams, mmr_exponent=3, max_swap_size=1, limit=None):
+    """
+    Scores all swaps of 1 (and optionally 2 and more) players between two teams.
+
+    :param teams: list of two teams, each team is a list of players (name and mmr)
+    :param max_swap_size: max amount of players swapped from each team
+    :param limit: return only this amount of best swaps
+    :return: list of swaps sorted by mmr difference (same one balance_from_teams() gives), e.g.
+             {'swap': ([0], [3]), 'mmr_diff': 20, 'mmr_diff_exp': 10000}
+             where swap has indices of players in first and second team
+    """
+    team_size = [len(team) for team in teams]
+    mmrs = [p[1] for team in teams for p in team]
+    mmrs, mmrs_exp = mmr_arrays(mmrs, mmr_exponent, max(team_size))
+
+    first = np.arange(team_size[0])
+    second = team_size[0] + np.arange(team_size[1])
+
+    swaps = []
+    for swap_size in range(1, max_swap_size + 1):
+        if swap_size > min(team_size):
+            break
+
+        groups_1 = first[swap_groups(team_size[0], swap_size)]
+        groups_2 = second[swap_groups(team_size[1], swap_size)]
+
+        # diff between teams for every pair of swapped groups
+        def diffs(values):
+            # first team gets (in - out) delta to its sum, second team gets the opposite
+            delta = values[groups_2].sum(axis=1)[None, :] - values[groups_1].sum(axis=1)[:, None]
+            sum_1 = values[first].sum() + delta
+            sum_2 = values[second].sum() - delta
+
+            return np.abs(sum_1 // team_size[0] - sum_2 // team_size[1]).ravel().tolist()
+
+        mmr_diff = diffs(mmrs)
+        mmr_diff_exp = diffs(mmrs_exp)
+
+        pairs = itertools.product((g.tolist() for g in groups_1), (g.tolist() for g in groups_2))
+        for i, (group_1, group_2) in enumerate(pairs):
+            swaps.append({
+                'swap': (group_1, [ind - team_size[0] for ind in group_2]),
+                'mmr_diff': mmr_diff[i],
+                'mmr_diff_exp': mmr_diff_exp[i],
+            })
+
+    swaps.sort(key=lambda x: x['mmr_diff_exp'])
+
+    return swaps if limit is None else swaps[:limit]
@@ -1,3 +1,624 @@
-from django.test import TestCase
+import asyncio
+import json
+import random
+import time
+from io import StringIO
+from datetime import timedelta
 
-# Create your tests here.
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from app.balancer import balancer, branch_bound, incremental, matchmaker, vectorized, views
+from app.balancer.blacklist import ConflictGraph
+from app.balancer.managers import BalanceJob, BalanceResultManager, PlayerSnapshot, RolesSnapshot, run_balance_job
+from app.balancer.models import BalanceAnswer, BalanceResult
+from app.balancer.service import BalanceService, BalanceServiceError
+from app.balancer.swaps import evaluate_swaps
+from app.balancer.views import answer_view
+from app.ladder.models import LadderSettings, Match, Player
+from app.ladder.tests import create_players, custom_answer
+
+
+def slow_job(job):
+    # stands for a balance that takes too long, runs in a worker
+    time.sleep(0.5)
+    return []
+
+
+def snapshots(rnd, count=10):
+    # players with random MMR and role preferences
+    return [
+        PlayerSnapshot(i, 'Player %d' % i, rnd.randint(500, 8000), RolesSnapshot(*rnd.choices(range(1, 6), k=5)), str(i))
+        for i in range(count)
+    ]
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CacheTestCase(TestCase):
+    # cached balances would live longer than test DB, so tests get their own cache
+    def setUp(self):
+        cache.clear()
+
+
+class VectorizedTestCase(TestCase):
+    @staticmethod
+    def blacklist(rnd, names):
+        # a few random pairs, some lobbies get an impossible one
+        return [tuple(rnd.sample(names, 2)) for _ in range(rnd.randint(0, 3))]
+
+    def test_same_as_python_engine(self):
+        rnd = random.Random(0)
+
+        for i in range(20):
+            players = [('Player %d' % j, rnd.randint(500, 8000)) for j in range(rnd.choice([8, 10]))]
+            mmr_exponent = rnd.choice([1, 2, 3, 2.5])
+
+            for blacklist in [(), self.blacklist(rnd, [p[0] for p in players])]:
+                self.assertEqual(
+                    vectorized.balance_teams(list(players), mmr_exponent, seed=i, blacklist=blacklist),
+                    balancer.balance_teams(list(players), mmr_exponent, seed=i, blacklist=blacklist),
+                    msg='players: %s, blacklist: %s' % (players, blacklist),
+                )
+
+    def test_same_role_balance_as_python_engine(self):
+        rnd = random.Random(1)
+
+        for i in range(20):
+            players = snapshots(rnd)
+            mmr_exponent = rnd.choice([1, 2, 3, 2.5])
+
+            for blacklist in [(), self.blacklist(rnd, [p.name for p in players])]:
+                self.assertEqual(
+                    vectorized.role_balance_teams(list(players), mmr_exponent, seed=i, blacklist=blacklist),
+                    balancer.role_balance_teams(list(players), mmr_exponent, seed=i, blacklist=blacklist),
+                    msg='players: %s, blacklist: %s' % (players, blacklist),
+                )
+
+
+class LimitTestCase(TestCase):
+    # limited balance is the same as the first answers of the full one
+    def test_balance_limit(self):
+        rnd = random.Random(2)
+
+        for engine in [balancer, vectorized]:
+            for i in range(5):
+                players = [('Player %d' % j, rnd.randint(500, 8000)) for j in range(10)]
+                full = engine.balance_teams(list(players), seed=i)
+
+                for limit in [0, 1, 5, 40, 1000]:
+                    self.assertEqual(
+                        engine.balance_teams(list(players), seed=i, limit=limit), full[:limit],
+                        msg='engine: %s, players: %s, limit: %s' % (engine.__name__, players, limit),
+                    )
+
+    def test_role_balance_limit(self):
+        rnd = random.Random(3)
+
+        for engine in [balancer, vectorized]:
+            for i in range(5):
+                players = snapshots(rnd)
+
+                for pareto in [None, (1, 1)]:
+                    full = engine.role_balance_teams(list(players), seed=i, pareto=pareto)
+
+                    for limit in [0, 1, 5, 40, 1000]:
+                        self.assertEqual(
+                            engine.role_balance_teams(list(players), seed=i, limit=limit, pareto=pareto), full[:limit],
+                            msg='engine: %s, players: %s, pareto: %s, limit: %s' % (engine.__name__, players, pareto, limit),
+                        )
+
+
+class BranchBoundTestCase(TestCase):
+    @staticmethod
+    def normalize(answers):
+        # team sides are random, so compare teams regardless of side
+        return [
+            (
+                sorted((team['players'], team['mmr'], team['mmr_exp']) for team in answer['teams']),
+                answer['mmr_diff'],
+                answer['mmr_diff_exp'],
+            )
+            for answer in answers
+        ]
+
+    def assert_same_answers(self, players, mmr_exponent):
+        full = balancer.balance_teams(list(players), mmr_exponent)
+
+        for limit in [None, 0, 1, 5, 40, 1000]:
+            answers = branch_bound.balance_teams(list(players), mmr_exponent, limit=limit)
+            expected = full if limit is None else full[:limit]
+
+            self.assertEqual(self.normalize(answers), self.normalize(expected),
+                             msg='players: %s, exponent: %s, limit: %s' % (players, mmr_exponent, limit))
+
+    def test_same_as_exhaustive_search(self):
+        rnd = random.Random(0)
+
+        for players_num in range(2, 13):
+            for mmr_exponent in [1, 2, 3, 5, 2.5]:
+                players = [('Player %d' % i, rnd.randint(500, 8000)) for i in range(players_num)]
+                self.assert_same_answers(players, mmr_exponent)
+
+    def test_same_mmr_players(self):
+        # many answers have equal mmr difference, order between them must be the same
+        rnd = random.Random(1)
+
+        for players_num in [10, 12]:
+            players = [('Player %d' % i, rnd.choice([3000, 4000, 5000])) for i in range(players_num)]
+            self.assert_same_answers(players, mmr_exponent=3)
+
+    def test_reproducible_with_seed(self):
+        players = [('Player %d' % i, 1000 + i * 500) for i in range(12)]
+
+        self.assertEqual(
+            branch_bound.balance_teams(list(players), seed=42, limit=10),
+            branch_bound.balance_teams(list(players), seed=42, limit=10),
+        )
+
+
+class SwapsTestCase(TestCase):
+    def test_same_as_balance_from_teams(self):
+        rnd = random.Random(0)
+
+        for mmr_exponent in [1, 3, 5]:
+            players = [('Player %d' % i, rnd.randint(500, 8000)) for i in range(10)]
+            teams = [players[:5], players[5:]]
+
+            swaps = evaluate_swaps(teams, mmr_exponent, max_swap_size=2)
+            self.assertEqual(len(swaps), 25 + 100)
+
+            for swap in swaps:
+                new_teams = [list(teams[0]), list(teams[1])]
+                for i, j in zip(*swap['swap']):
+                    new_teams[0][i], new_teams[1][j] = teams[1][j], teams[0][i]
+
+                answer = balancer.balance_from_teams(new_teams, mmr_exponent)
+                self.assertEqual(swap['mmr_diff'], answer['mmr_diff'])
+                self.assertEqual(swap['mmr_diff_exp'], answer['mmr_diff_exp'])
+
+            # best swaps go first
+            diffs = [swap['mmr_diff_exp'] for swap in swaps]
+            self.assertEqual(diffs, sorted(diffs))
+
+
+class BlacklistTestCase(TestCase):
+    def test_blacklisted_players_in_different_teams(self):
+        players = [('Player %d' % i, 1000 + i * 500) for i in range(10)]
+        blacklist = [('Player 3', 'Player 4'), ('Player 3', 'Player 7')]
+
+        for engine in [balancer, vectorized, branch_bound]:
+            answers = engine.balance_teams(list(players), blacklist=blacklist)
+            self.assertTrue(answers)
+
+            for answer in answers:
+                for team in answer['teams']:
+                    names = {p[0] for p in team['players']}
+                    self.assertFalse(any({a, b} <= names for a, b in blacklist))
+
+    def test_impossible_blacklist_is_ignored(self):
+        # three players can't go to two teams without a conflict
+        players = [('Player %d' % i, 1000 + i * 500) for i in range(10)]
+        blacklist = [('Player 3', 'Player 4'), ('Player 4', 'Player 5'), ('Player 3', 'Player 5')]
+
+        self.assertEqual(
+            balancer.balance_teams(list(players), seed=1, blacklist=blacklist),
+            balancer.balance_teams(list(players), seed=1),
+        )
+
+    def test_load_with_one_query(self):
+        players = create_players([3000] * 4)
+        players[0].blacklist.add(players[1])
+        players[2].blacklist.add(players[0])
+
+        with self.assertNumQueries(1):
+            graph = ConflictGraph.load([p.id for p in players[:3]])
+
+        self.assertEqual(graph.pairs(), sorted([
+            tuple(sorted((players[0].id, players[1].id))),
+            tuple(sorted((players[0].id, players[2].id))),
+        ]))
+        self.assertEqual(graph.conflicts_with(players[0].id, [players[2].id, players[3].id]), {players[2].id})
+
+
+class IncrementalTestCase(TestCase):
+    def test_same_as_full_balance(self):
+        rnd = random.Random(0)
+
+        for i in range(50):
+            players = snapshots(rnd)
+            if i % 2:
+                # equal MMRs check that players are ordered the same way
+                players = [p._replace(ladder_mmr=rnd.choice([3000, 4000, 5000])) for p in players]
+            last = rnd.choice(players)
+            partial = incremental.PartialBalance([p for p in players if p is not last])
+
+            self.assertEqual(
+                incremental.role_balance_teams(partial, list(players), seed=i),
+                vectorized.role_balance_teams(list(players), seed=i),
+            )
+
+    def test_other_players(self):
+        players = [
+            PlayerSnapshot(j, 'Player %d' % j, 1000 + j * 500, RolesSnapshot(1, 2, 3, 4, 5), str(j))
+            for j in range(11)
+        ]
+        partial = incremental.PartialBalance(players[:9])
+
+        self.assertIsNone(incremental.role_balance_teams(partial, players[1:]))
+        self.assertIsNone(incremental.role_balance_teams(partial, players[:10], mmr_exponent=2))
+
+
+class BalanceServiceTestCase(CacheTestCase):
+    def setUp(self):
+        super(BalanceServiceTestCase, self).setUp()
+        self.service = BalanceService(workers=1)
+        self.addCleanup(self.service.shutdown)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_prepared_queue(self):
+        players = create_players([1000 + i * 100 for i in range(10)])
+        self.run_async(self.service.prepare('queue', players[:9]))
+
+        def no_workers(*args):
+            raise AssertionError('prepared balance went to a worker')
+        self.service.submit = no_workers
+
+        result = self.run_async(self.service.balance_teams(players, limit=1, prepared='queue'))
+        job = BalanceResultManager.balance_job(players, limit=1)
+        expected = run_balance_job(job)[0]
+        self.assertEqual(
+            [[p[0] for p in team['players']] for team in result.answers.get().teams],
+            [[p[0] for p in team['players']] for team in expected['teams']],
+        )
+        self.assertEqual(self.service.prepared, {})
+
+    def test_prepare_respects_engine(self):
+        players = create_players([1000 + i * 100 for i in range(9)])
+        LadderSettings.objects.update(balancer_engine=LadderSettings.PYTHON_ENGINE)
+
+        self.run_async(self.service.prepare('queue', players))
+        self.assertEqual(self.service.prepared, {})
+
+    def test_too_many_pending(self):
+        service = BalanceService(workers=1, max_pending=1)
+        self.addCleanup(service.shutdown)
+        job = BalanceResultManager.balance_job(create_players([1000 + i * 100 for i in range(10)]))
+
+        future = service.submit(job, slow_job)
+        with self.assertRaises(BalanceServiceError):
+            service.submit(job, slow_job)
+        self.assertEqual(future.result(), [])
+
+    def test_timeout(self):
+        players = create_players([1000 + i * 100 for i in range(10)])
+        self.service.timeout = 0.05
+
+        submit = self.service.submit
+        self.service.submit = lambda job: submit(job, slow_job)
+
+        with self.assertRaises(BalanceServiceError):
+            self.run_async(self.service.balance_teams(players))
+        self.assertFalse(BalanceResult.objects.exists())
+
+
+class ParetoTestCase(TestCase):
+    def test_front(self):
+        rnd = random.Random(0)
+
+        for _ in range(200):
+            role_scores = [rnd.randint(0, 5) for _ in range(20)]
+            mmr_diffs = [rnd.randint(0, 5) for _ in range(20)]
+
+            def dominated(i):
+                return any(
+                    role_scores[j] >= role_scores[i] and mmr_diffs[j] <= mmr_diffs[i] and
+                    (role_scores[j], mmr_diffs[j]) != (role_scores[i], mmr_diffs[i])
+                    for j in range(20)
+                )
+
+            front = balancer.pareto_order(role_scores, mmr_diffs, weights=(1, 1))
+            self.assertEqual(sorted(front), [i for i in range(20) if not dominated(i)])
+
+    def test_same_in_all_engines(self):
+        rnd = random.Random(0)
+
+        for i in range(20):
+            players = snapshots(rnd)
+            weights = (rnd.randint(0, 3), rnd.randint(0, 3))
+
+            answers = balancer.role_balance_teams(list(players), seed=i, pareto=weights)
+            self.assertEqual(answers, vectorized.role_balance_teams(list(players), seed=i, pareto=weights))
+
+
+class ResultCacheTestCase(CacheTestCase):
+    def balance(self, players):
+        players = Player.objects.filter(id__in=[p.id for p in players])
+        return BalanceResultManager.balance_teams(players, role_balancing=False, limit=5)
+
+    def test_same_players_get_cached_result(self):
+        players = create_players([1000 + i * 100 for i in range(10)])
+        result = self.balance(players)
+
+        self.assertEqual(self.balance(players), result)
+        self.assertEqual(BalanceResult.objects.count(), 1)
+
+        # result that went to a match is not given out again
+        Match.objects.create(winner=0, balance=result.answers.first())
+        self.assertNotEqual(self.balance(players), result)
+
+    def test_changes_drop_cached_result(self):
+        players = create_players([1000 + i * 100 for i in range(10)])
+        result = self.balance(players)
+
+        Player.objects.filter(id=players[0].id).update(ladder_mmr=5000)
+        mmr_changed = self.balance(players)
+        self.assertNotEqual(mmr_changed, result)
+
+        players[0].blacklist.add(players[1])
+        blacklisted = self.balance(players)
+        self.assertNotIn(blacklisted, [result, mmr_changed])
+        self.assertEqual(self.balance(players), blacklisted)
+
+
+class MatchmakerTestCase(TestCase):
+    now = timezone.now()
+
+    def waiting(self, mmrs, waits):
+        # waits are in minutes
+        return [
+            matchmaker.Waiting(i, mmr, mmr, self.now - timedelta(minutes=wait))
+            for i, (mmr, wait) in enumerate(zip(mmrs, waits))
+        ]
+
+    def test_longest_waiting_player_plays(self):
+        rnd = random.Random(0)
+        waiting = self.waiting([rnd.randint(10, 40) * 100 for _ in range(35)], [rnd.randint(0, 30) for _ in range(35)])
+
+        matches = matchmaker.pick_matches(waiting, self.now, 0, 0)
+        picked = [p for match in matches for p in match]
+
+        self.assertTrue(matches)
+        self.assertTrue(all(len(match) == 10 for match in matches))
+        self.assertEqual(len(picked), len(set(picked)))
+        self.assertIn(max(waiting, key=lambda p: self.now - p.joined_date).id, matches[0])
+
+    def test_mmr_range(self):
+        # two groups far from each other don't mix
+        waiting = self.waiting([1000] * 10 + [5000] * 10, [0] * 20)
+        matches = matchmaker.pick_matches(waiting, self.now, 0, 0)
+        self.assertEqual(sorted(sorted(match) for match in matches), [list(range(10)), list(range(10, 20))])
+
+        # range grows while player waits
+        waiting = self.waiting([1000] + [3000] * 9, [0] * 10)
+        self.assertEqual(matchmaker.pick_matches(waiting, self.now, 0, 0), [])
+        waiting = self.waiting([1000] + [3000] * 9, [10] + [0] * 9)
+        self.assertEqual(len(matchmaker.pick_matches(waiting, self.now, 0, 0)), 1)
+
+    def test_channel_limits(self):
+        waiting = self.waiting([1000 + i * 10 for i in range(12)], [0] * 12)
+
+        self.assertEqual(matchmaker.pick_matches(waiting, self.now, 1020, 0), [list(range(2, 12))])
+        self.assertEqual(matchmaker.pick_matches(waiting, self.now, 1020, 1100), [])
+        self.assertEqual(matchmaker.pick_matches(waiting[:9], self.now, 0, 0), [])
+
+
+class PackedAnswersTestCase(CacheTestCase):
+    def test_same_teams_after_save(self):
+        rnd = random.Random(0)
+        players = snapshots(rnd)
+
+        for role_balancing in [True, False]:
+            job = BalanceJob('0' * 40, players, 3, role_balancing, None, None, (), None, False)
+            if role_balancing:
+                answers = vectorized.role_balance_teams(list(players))
+            else:
+                answers = vectorized.balance_teams([(p.name, p.ladder_mmr) for p in players])
+
+            result = BalanceResultManager.save_answers(job, answers)
+
+            # teams were tuples before saving, JSON gives lists
+            saved = [answer.teams for answer in result.answers.all()]
+            for answer in saved:
+                for team in answer:
+                    for p in team['players']:
+                        # players got their ids
+                        self.assertEqual(p[2:], [int(p[0].split()[1]), p[0].split()[1]])
+                        del p[2:]
+            self.assertEqual(json.dumps(saved), json.dumps([answer['teams'] for answer in answers]))
+
+    def test_teams_assignment(self):
+        teams = [{'players': [['A', 1000]], 'mmr': 1000, 'mmr_exp': 1000}, {'players': [['B', 2000]], 'mmr': 2000, 'mmr_exp': 2000}]
+        answer = BalanceAnswer.objects.create(teams=teams, mmr_diff=1000, mmr_diff_exp=1000)
+
+        self.assertEqual(BalanceAnswer.objects.get(id=answer.id).teams, teams)
+
+
+class LazyAnswersTestCase(CacheTestCase):
+    def test_same_answers_as_saved(self):
+        rnd = random.Random(1)
+        players = snapshots(rnd)
+        job = BalanceJob('ab' * 20, players, 3, True, None, LadderSettings.NUMPY_ENGINE, (), None, False)
+        answers = run_balance_job(job)
+
+        saved = BalanceResultManager.save_answers(job, answers)
+        lazy = BalanceResultManager.save_answers(job._replace(lazy=True), answers)
+        self.assertFalse(lazy.answers.exists())
+
+        # answers are balanced again when they are not in cache
+        cache.delete('balance_answers_%s' % lazy.id)
+        lazy = BalanceResult.objects.get(id=lazy.id)
+        teams = [answer.teams for answer in BalanceResultManager.answers(lazy)]
+        self.assertEqual(teams, [answer.teams for answer in saved.answers.all()])
+
+        # only answers that are asked to be saved get a row
+        answer = BalanceResultManager.answer(lazy, 3, save=True)
+        self.assertEqual(list(lazy.answers.all()), [answer])
+        self.assertEqual(BalanceResultManager.answers(lazy)[3], answer)
+        self.assertEqual(BalanceResultManager.answer(lazy, 3), answer)
+        self.assertIsNone(BalanceResultManager.answer(lazy, len(answers)))
+
+    def test_answer_saved_twice(self):
+        rnd = random.Random(2)
+        job = BalanceJob('cd' * 20, snapshots(rnd), 3, True, None, LadderSettings.NUMPY_ENGINE, (), None, True)
+        result = BalanceResultManager.save_answers(job, run_balance_job(job))
+
+        # another bot saves the same answer while this one balances it
+        lazy_answer = BalanceResultManager.lazy_answer
+
+        def racing(result, index, answer):
+            lazy_answer(result, index, answer).save()
+            return lazy_answer(result, index, answer)
+
+        BalanceResultManager.lazy_answer = staticmethod(racing)
+        self.addCleanup(setattr, BalanceResultManager, 'lazy_answer', staticmethod(lazy_answer))
+
+        answer = BalanceResultManager.answer(result, 2, save=True)
+        self.assertEqual(list(result.answers.all()), [answer])
+
+
+class AnswerViewCacheTestCase(CacheTestCase):
+    def test_match_drops_cache(self):
+        players = create_players([1000 + i for i in range(10)])
+        answer = custom_answer(players)
+
+        self.assertFalse(answer_view(answer)['has_match'])
+        with self.assertNumQueries(0):
+            answer_view(answer)
+
+        match = Match.objects.create(winner=1, balance=answer)
+        self.assertEqual(answer_view(answer)['match_winner'], 1)
+
+        match.delete()
+        self.assertFalse(answer_view(answer)['has_match'])
+
+    def test_lazy_answer(self):
+        players = create_players([1000 + i for i in range(10)])
+        job = BalanceResultManager.balance_job(players, role_balancing=False, limit=5)._replace(lazy=True)
+        result = BalanceResultManager.save_answers(job, run_balance_job(job))
+
+        # view is cached while the answer isn't saved yet
+        self.assertFalse(answer_view(BalanceResultManager.answer(result, 2))['has_match'])
+
+        match = Match.objects.create(winner=1, balance=BalanceResultManager.answer(result, 2, save=True))
+        self.assertEqual(answer_view(BalanceResultManager.answer(result, 2))['match_winner'], 1)
+
+        match.delete()
+        self.assertFalse(answer_view(BalanceResultManager.answer(result, 2))['has_match'])
+
+
+class CompactionTestCase(CacheTestCase):
+    def test_keeps_used_and_new_results(self):
+        players = create_players([1000 + i for i in range(10)])
+        job = BalanceResultManager.balance_job(players, role_balancing=False, limit=5)
+
+        old, used, new, undated = [BalanceResultManager.save_answers(job, run_balance_job(job)) for _ in range(4)]
+        BalanceResult.objects.filter(id__in=[old.id, used.id]).update(date=timezone.now() - timedelta(days=10))
+        Match.objects.create(winner=0, balance=used.answers.last())
+        # results made before they had a date can be of any age
+        BalanceResult.objects.filter(id=undated.id).update(date=None)
+
+        stats = BalanceResultManager.compact(timezone.now() - timedelta(days=7), batch_size=1)
+
+        self.assertEqual((stats['results'], stats['answers']), (1, 5))
+        self.assertEqual(set(BalanceResult.objects.values_list('id', flat=True)), {used.id, new.id, undated.id})
+        self.assertEqual(used.answers.count(), 5)
+
+    def test_custom_answer_in_match(self):
+        players = create_players([1000 + i for i in range(10)])
+        job = BalanceResultManager.balance_job(players, role_balancing=False, limit=5)
+        old = BalanceResultManager.save_answers(job, run_balance_job(job))
+        BalanceResult.objects.filter(id=old.id).update(date=timezone.now() - timedelta(days=10))
+
+        # custom answers have no result
+        custom = custom_answer(players)
+        Match.objects.create(winner=0, balance=custom)
+
+        stats = BalanceResultManager.compact(timezone.now() - timedelta(days=7))
+
+        self.assertEqual((stats['results'], stats['answers']), (1, 5))
+        self.assertFalse(BalanceResult.objects.exists())
+
+    def test_zero_retention_keeps_everything(self):
+        players = create_players([1000 + i for i in range(10)])
+        job = BalanceResultManager.balance_job(players, role_balancing=False, limit=5)
+        BalanceResultManager.save_answers(job, run_balance_job(job))
+        BalanceResult.objects.update(date=timezone.now() - timedelta(days=10))
+
+        LadderSettings.objects.update(balance_retention_days=0)
+        call_command('balance_compact', stdout=StringIO())
+        self.assertTrue(BalanceResult.objects.exists())
+
+
+class BalanceApiTestCase(CacheTestCase):
+    def test_dry_run(self):
+        players = create_players([1000 + i for i in range(10)])
+        params = {'player': [str(p.id) for p in players[:9]] + ['Player 9:5000'], 'limit': 3, 'roles': 0}
+
+        response = self.client.get('/balancer/api/balance/', params)
+        answers = json.loads(response.content.decode())['answers']
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(answers), 3)
+        self.assertIn(5000, [p['mmr'] for team in answers[0]['teams'] for p in team['players']])
+        self.assertFalse(BalanceResult.objects.exists())
+
+        response = self.client.get('/balancer/api/balance/', params, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_ids_and_names(self):
+        players = create_players([1000 + i for i in range(9)])
+        # numbers are ids, even when someone has a number for a name
+        numbered = Player.objects.create(name=str(players[0].id), dota_mmr=1000)
+
+        params = {'player': [str(p.id) for p in players] + ['Player 8'], 'limit': 1}
+        response = self.client.get('/balancer/api/balance/', params)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('listed twice', response.content.decode())
+
+        params = {'player': [str(p.id) for p in players] + [str(numbered.id)], 'limit': 1}
+        answer = json.loads(self.client.get('/balancer/api/balance/', params).content.decode())['answers'][0]
+        ids = [p['id'] for team in answer['teams'] for p in team['players']]
+        self.assertEqual(sorted(ids), sorted([p.id for p in players] + [numbered.id]))
+
+    def test_save_needs_permission(self):
+        players = create_players([1000 + i for i in range(10)])
+        params = {'player': [str(p.id) for p in players], 'limit': 1, 'roles': 0}
+
+        response = self.client.post('/balancer/api/balance/', params)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(BalanceResult.objects.exists())
+
+        user = User.objects.create_user('admin', password='admin')
+        user.user_permissions.add(Permission.objects.get(codename='add_balanceresult'))
+        self.client.login(username='admin', password='admin')
+
+        response = self.client.post('/balancer/api/balance/', params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode())['result']['id'], BalanceResult.objects.get().id)
+
+    def test_saved_result_reused(self):
+        players = create_players([1000 + i for i in range(10)])
+        params = {'player': [str(p.id) for p in players], 'limit': 3}
+
+        user = User.objects.create_user('admin', password='admin')
+        user.user_permissions.add(Permission.objects.get(codename='add_balanceresult'))
+        self.client.login(username='admin', password='admin')
+        first = json.loads(self.client.post('/balancer/api/balance/', params).content.decode())
+
+        # the same input is answered from the saved result, without balancing
+        def run_balance_job(job):
+            raise AssertionError('balanced again')
+
+        self.addCleanup(setattr, views, 'run_balance_job', views.run_balance_job)
+        views.run_balance_job = run_balance_job
+
+        second = json.loads(self.client.post('/balancer/api/balance/', params).content.decode())
+        self.assertEqual(second, first)
+        self.assertEqual(BalanceResult.objects.count(), 1)
@@ -1,7 +1,7 @@
 from django.conf.urls import url
 
 from app.balancer.views import BalancerInput, BalancerResult, BalancerInputCustom, MatchCreate, BalancerAnswer, \
-    MatchDelete, RecordMatch
+    MatchDelete, RecordMatch, BalanceApi
 
 urlpatterns = [
     url(r'^$', BalancerInput.as_view(), name='balancer-input'),
@@ -14,8 +14,12 @@ urlpatterns = [
 
     url(r'^answers/(?P<pk>[0-9]+)/match-create/(?P<winner>[0-1])/$', MatchCreate.as_view(),
         name='match-create'),
+    url(r'^results/(?P<result>[0-9]+)/answers/(?P<index>[0-9]+)/match-create/(?P<winner>[0-1])/$',
+        MatchCreate.as_view(), name='result-match-create'),
     url(r'^answers/(?P<pk>[0-9]+)/match-delete/$', MatchDelete.as_view(),
         name='match-delete'),
 
     url(r'^record-match/$', RecordMatch.as_view(), name='record-match'),
+
+    url(r'^api/balance/$', BalanceApi.as_view(), name='api-balance'),
 ]
@@ -0,0 +1,366 @@
+"""
+NumPy version of the team balancer.
+
+Produces exactly the same answers as functions from balancer.py,
+but instead of building every team as a python dict it keeps
+players MMRs in arrays and calculates all teams at once
+over precomputed matrices of team splits.
+"""
+import heapq
+from functools import lru_cache
+
+import numpy as np
+
+from app.balancer.blacklist import conflict_bitsets
+from app.balancer.balancer import pareto_order, role_names, role_permutations, side_randomizer, team_members, \
+    team_splits
+
+
+INT64_MAX = np.iinfo(np.int64).max
+
+# role index for every team member, one row per roles permutation
+ROLE_PERMUTATIONS = np.array([
+    [role_names.index(role) for role in roles]
+    for roles in role_permutations
+], dtype=np.intp)
+
+# carry and mid can't be given to players much weaker than team's top 2
+IMPORTANT_ROLES = np.isin(ROLE_PERMUTATIONS, [role_names.index('carry'), role_names.index('mid')])
+IMPORTANT_ROLES_MMR_GAP = 1500
+
+
+@lru_cache(maxsize=None)
+def split_matrices(players_num):
+    """
+    Team splits from balancer.team_splits() as arrays:
+    bitmasks of first teams and index matrices of first and second teams, one split per row.
+    """
+    everyone = (1 << players_num) - 1
+    masks = team_splits(players_num)
+
+    first = [team_members(mask) for mask in masks]
+    second = [team_members(everyone ^ mask) for mask in masks]
+
+    masks = np.array(masks, dtype=np.int64)
+    first = np.array(first, dtype=np.intp).reshape(len(masks), players_num // 2)
+    second = np.array(second, dtype=np.intp).reshape(len(masks), players_num - players_num // 2)
+
+    # these arrays are shared between calls
+    for array in (masks, first, second):
+        array.flags.writeable = False
+
+    return masks, first, second
+
+
+def has_one_of(masks, players):
+    # same as balancer.has_one_of(), for an array of masks
+    both = masks & players
+    return (both != 0) & (both != players)
+
+
+def top_low_splits(players_num):
+    """
+    Indices of splits that don't place top 2 or lowest 2 players in the same team.
+    """
+    masks, _, _ = split_matrices(players_num)
+    top_players = 0b11
+    low_players = 0b11 << (players_num - 2)
+
+    return np.flatnonzero(has_one_of(masks, top_players) & has_one_of(masks, low_players))
+
+
+def without_conflicts(players_num, kept, bitsets):
+    """
+    Same as blacklist.without_conflicts(), for indices of splits.
+    """
+    if not any(bitsets):
+        return kept
+
+    masks = split_matrices(players_num)[0][kept]
+    everyone = (1 << players_num) - 1
+
+    ok = np.ones(len(kept), dtype=bool)
+    for i, bitset in enumerate(bitsets):
+        if bitset:
+            # team of player i can't have anyone from his bitset
+            team = np.where(masks >> i & 1, masks, everyone ^ masks)
+            ok &= (team & bitset) == 0
+
+    return kept[ok] if ok.any() else kept
+
+
+def mmr_arrays(mmrs, mmr_exponent, team_players):
+    """
+    Makes arrays of players MMR and MMR exponent.
+
+    MMR exponent grows fast (8000 ** 5 doesn't fit int64),
+    so if team sums can overflow we use arrays of python ints.
+    They are slower, but results stay exactly the same.
+    """
+    exact = isinstance(mmr_exponent, int) and all(isinstance(mmr, int) for mmr in mmrs)
+    if exact and mmrs and max(abs(mmr) for mmr in mmrs) ** mmr_exponent * team_players <= INT64_MAX:
+        mmrs = np.array(mmrs, dtype=np.int64)
+    else:
+        mmrs = np.array(mmrs, dtype=object)
+
+    return mmrs, mmrs ** mmr_exponent
+
+
+def roles_matrix(players):
+    """
+    Players role preferences, one row per player, one column per role.
+    """
+    return np.array([
+        [getattr(player.roles, role) for role in role_names]
+        for player in players
+    ], dtype=np.int64).reshape(len(players), len(role_names))
+
+
+def assign_best_roles(teams, prefs, mmrs):
+    """
+    Same as balancer.assign_best_roles(), but for many teams at once.
+    All role permutations of all teams are scored in one go.
+
+    :param teams: index matrix of teams, players in each team go by MMR (desc)
+    :param prefs: roles matrix of players
+    :param mmrs: MMRs array of players
+    :return: players indices for each team in role_names order,
+             comfort of each player on his role and total comfort for each team
+    """
+    return best_roles(teams, role_scores(teams, prefs), prefs, mmrs)
+
+
+def role_scores(teams, prefs):
+    # comfort of every team in every roles permutation, one row per team
+    members = np.arange(teams.shape[1])
+    return prefs[teams][:, members, ROLE_PERMUTATIONS].sum(axis=2)
+
+
+def best_roles(teams, scores, prefs, mmrs):
+    """
+    Picks the best roles permutation for every team out of its role_scores().
+    Returns the same as assign_best_roles().
+    """
+    members = np.arange(teams.shape[1])
+
+    # permutations that give carry or mid to a weak player are not allowed
+    team_mmrs = mmrs[teams]
+    mmr_ok = np.less(team_mmrs[:, 1:2] - team_mmrs, IMPORTANT_ROLES_MMR_GAP).astype(bool)
+    allowed = ~(IMPORTANT_ROLES[None, :, :] & ~mmr_ok[:, None, :]).any(axis=2)
+    scores = np.where(allowed, scores, -1)
+
+    # argmax takes first of the best permutations, same as balancer.py does
+    best = scores.argmax(axis=1)
+    role_score_sum = scores[np.arange(len(teams)), best]
+
+    # sort players according to their roles
+    role_members = np.argsort(ROLE_PERMUTATIONS[best], axis=1)
+    role_players = np.take_along_axis(teams, role_members, axis=1)
+    role_score = prefs[role_players, members]
+
+    return role_players, role_score, role_score_sum
+
+
+def stable_order(keys):
+    """
+    Indices that sort answers by keys (list of arrays, most significant first)
+    keeping original order for equal answers, same as list.sort() does.
+    """
+    order = np.arange(len(keys[0]))
+    for key in reversed(keys):
+        order = order[np.argsort(key[order], kind='stable')]
+
+    return order
+
+
+def ranked_indices(keys, limit=None):
+    """
+    Same as stable_order(), but if we need only a few best answers
+    they are picked with a bounded heap instead of sorting everything.
+    """
+    if limit is None:
+        return stable_order(keys).tolist()
+
+    keys = [key.tolist() for key in keys]
+    return heapq.nsmallest(limit, range(len(keys[0])), key=lambda i: [key[i] for key in keys])
+
+
+def balance_teams(players, mmr_exponent=3, seed=None, limit=None, blacklist=()):
+    """
+    Same as balancer.balance_teams(), but vectorized.
+
+    :param players: a list of players (name and MMR for each).
+    :param seed: seed for random team sides, makes answers reproducible
+    :param limit: return only this amount of best answers
+    :param blacklist: pairs of players names that shouldn't play in the same team
+    :return: a list of team pairs with some meta data
+    """
+    return list(iter_balance_teams(players, mmr_exponent, seed, limit, blacklist))
+
+
+def iter_balance_teams(players, mmr_exponent=3, seed=None, limit=None, blacklist=()):
+    """
+    Yields answers of balance_teams() one by one in ranked order.
+    Answers are built only when they are consumed.
+    """
+    rnd = side_randomizer(seed)
+
+    players = sorted(players, key=lambda x: -x[1])
+
+    players_num = len(players)
+    team_players = players_num // 2
+
+    # discard answers that place top 2 or lowest 2 players in the same team
+    _, first, second = split_matrices(players_num)
+    kept = top_low_splits(players_num)
+
+    # blacklisted players go to different teams
+    kept = without_conflicts(players_num, kept, conflict_bitsets([p[0] for p in players], blacklist))
+    teams = (first[kept], second[kept])
+
+    # calc avg MMR for all teams at once
+    mmrs, mmrs_exp = mmr_arrays([p[1] for p in players], mmr_exponent, players_num - team_players)
+    team_mmr = [mmrs[t].sum(axis=1) // team_players for t in teams]
+    team_mmr_exp = [mmrs_exp[t].sum(axis=1) // team_players for t in teams]
+
+    # calc mmr differences for each pair of teams
+    mmr_diff = np.abs(team_mmr[0] - team_mmr[1])
+    mmr_diff_exp = np.abs(team_mmr_exp[0] - team_mmr_exp[1])
+
+    teams = [t.tolist() for t in teams]
+    team_mmr = [t.tolist() for t in team_mmr]
+    team_mmr_exp = [t.tolist() for t in team_mmr_exp]
+
+    # team is given by (side of split, index of split)
+    def team(side, k):
+        return {
+            'players': tuple(players[j] for j in teams[side][k]),
+            'mmr': team_mmr[side][k],
+            'mmr_exp': team_mmr_exp[side][k],
+        }
+
+    # assign team side randomly (Radiant or Dire);
+    # this is done before sorting to keep random calls same as in balancer.py
+    sides = [rnd.sample(((0, k), (1, k)), 2) for k in range(len(kept))]
+
+    # sort answers by mmr difference
+    order = ranked_indices([mmr_diff_exp], limit)
+
+    mmr_diff = mmr_diff.tolist()
+    mmr_diff_exp = mmr_diff_exp.tolist()
+    for ind in order:
+        yield {
+            'teams': [team(side, k) for side, k in sides[ind]],
+            'mmr_diff': mmr_diff[ind],
+            'mmr_diff_exp': mmr_diff_exp[ind],
+        }
+
+
+def role_balance_teams(players, mmr_exponent=3, seed=None, limit=None, blacklist=(), pareto=None):
+    """
+    Same as balancer.role_balance_teams(), but vectorized.
+
+    :param players: a list of Player objects
+    :param seed: seed for random team sides, makes answers reproducible
+    :param limit: return only this amount of best answers
+    :param blacklist: pairs of players names that shouldn't play in the same team
+    :param pareto: weights for pareto ranking, see balancer.role_balance_teams()
+    :return: a list of team pairs with some meta data
+    """
+    return list(iter_role_balance_teams(players, mmr_exponent, seed, limit, blacklist, pareto))
+
+
+def iter_role_balance_teams(players, mmr_exponent=3, seed=None, limit=None, blacklist=(), pareto=None):
+    """
+    Yields answers of role_balance_teams() one by one in ranked order.
+    Answers are built only when they are consumed.
+    """
+    players = sorted(players, key=lambda x: -x.ladder_mmr)
+
+    players_num = len(players)
+    team_players = 5
+
+    # discard answers that place top 2 or lowest 2 players on same team
+    _, first, second = split_matrices(players_num)
+    kept = top_low_splits(players_num)
+
+    # blacklisted players go to different teams
+    kept = without_conflicts(players_num, kept, conflict_bitsets([p.name for p in players], blacklist))
+
+    # calc avg MMR for all teams at once, first teams of splits go first, then second ones
+    teams = np.concatenate([first[kept], second[kept]])
+    mmrs, mmrs_exp = mmr_arrays([p.ladder_mmr for p in players], mmr_exponent, team_players)
+    team_mmr = mmrs[teams].sum(axis=1) // team_players
+    team_mmr_exp = mmrs_exp[teams].sum(axis=1) // team_players
+
+    # roles are assigned only for teams that are left after filtering
+    roles = assign_best_roles(teams, roles_matrix(players), mmrs)
+
+    yield from iter_role_answers(players, team_mmr, team_mmr_exp, roles, seed, limit, pareto)
+
+
+def iter_role_answers(players, team_mmr, team_mmr_exp, roles, seed=None, limit=None, pareto=None):
+    """
+    Ranks splits and yields answers of role_balance_teams().
+
+    :param players: players sorted by MMR (desc)
+    :param team_mmr: avg MMR of all teams, first teams of splits go first, then second ones
+    :param team_mmr_exp: same for MMR exponent
+    :param roles: assign_best_roles() result for the same teams
+    """
+    rnd = side_randomizer(seed)
+
+    splits_num = len(team_mmr) // 2
+    role_players, role_score, team_role_score_sum = roles
+
+    # calc mmr differences for each pair of teams
+    mmr_diff = np.abs(team_mmr[:splits_num] - team_mmr[splits_num:])
+    mmr_diff_exp = np.abs(team_mmr_exp[:splits_num] - team_mmr_exp[splits_num:])
+    role_score_sum = team_role_score_sum[:splits_num] + team_role_score_sum[splits_num:]
+
+    team_mmr = team_mmr.tolist()
+    team_mmr_exp = team_mmr_exp.tolist()
+    role_players = role_players.tolist()
+    role_score = role_score.tolist()
+    team_role_score_sum = team_role_score_sum.tolist()
+
+    def team(i):
+        return {
+            'players': [(players[j].name, players[j].ladder_mmr) for j in role_players[i]],
+            'mmr': team_mmr[i],
+            'mmr_exp': team_mmr_exp[i],
+            'role_score': role_score[i],
+            'role_score_sum': team_role_score_sum[i],
+        }
+
+    # teams of split k are k and splits_num + k
+    pairs = [(k, splits_num + k) for k in range(splits_num)]
+
+    # assign team side randomly (Radiant or Dire)
+    sides = [rnd.sample(pair, len(pair)) for pair in pairs]
+
+    if pareto:
+        order = pareto_order(role_score_sum.tolist(), mmr_diff_exp.tolist(), pareto, limit)
+    else:
+        # discard answers that have too unbalanced teams
+        balanced = np.ones(len(pairs), dtype=bool)
+        for diff in [200, 300, 400]:
+            if (mmr_diff <= diff).any():
+                balanced = mmr_diff <= diff
+                break
+        balanced = np.flatnonzero(balanced)
+
+        # sort answers by role score and mmr difference
+        order = ranked_indices([-role_score_sum[balanced], mmr_diff_exp[balanced]], limit)
+        order = balanced[order].tolist()
+
+    mmr_diff = mmr_diff.tolist()
+    mmr_diff_exp = mmr_diff_exp.tolist()
+    role_score_sum = role_score_sum.tolist()
+    for ind in order:
+        yield {
+            'teams': [team(i) for i in sides[ind]],
+            'mmr_diff': mmr_diff[ind],
+            'mmr_diff_exp': mmr_diff_exp[ind],
+            'role_score_sum': role_score_sum[ind],
+        }
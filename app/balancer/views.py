@@ -1,14 +1,16 @@
 from django.contrib.auth.mixins import PermissionRequiredMixin
+from django.core.cache import cache
 from app.balancer.balancer import balance_teams, role_names
 from app.balancer.forms import BalancerForm, BalancerCustomForm
-from app.balancer.managers import BalanceResultManager, BalanceAnswerManager
-from app.balancer.models import BalanceResult, BalanceAnswer
+from app.balancer.managers import BalanceResultManager, BalanceAnswerManager, run_balance_job
+from app.balancer.models import BalanceResult, BalanceAnswer, team_member
 from app.ladder.models import Player, Match, MatchPlayer
 from django.core.paginator import PageNotAnInteger
 from django.core.urlresolvers import reverse_lazy, reverse
 from django.db import transaction
-from django.http import Http404, HttpResponseBadRequest
-from django.views.generic import FormView, DetailView, RedirectView
+from django.db.models import Q
+from django.http import Http404, HttpResponseBadRequest, HttpResponseNotModified, JsonResponse
+from django.views.generic import FormView, DetailView, RedirectView, View
 from app.ladder.managers import MatchManager
 from pure_pagination import Paginator
 
@@ -51,8 +53,8 @@ class RecordMatch(FormView):
     def form_valid(self, form):
         players = list(form.cleaned_data.values())
 
-        radiant = [(p.name, p.ladder_mmr) for p in players[:5]]
-        dire = [(p.name, p.ladder_mmr) for p in players[5:]]
+        radiant = [team_member(p) for p in players[:5]]
+        dire = [team_member(p) for p in players[5:]]
 
         self.answer = BalanceAnswerManager.balance_custom([radiant, dire])
 
@@ -62,6 +64,73 @@ class RecordMatch(FormView):
         return reverse('balancer:balancer-answer', args=(self.answer.id,))
 
 
+def answer_view(answer):
+    """
+    Teams of the answer prepared for balancer-result.html, and its match state.
+    Cached per answer, match signals drop the cache when match is created or deleted.
+    """
+    key = BalanceAnswerManager.view_cache_key(answer)
+    view = cache.get(key)
+    if view is not None:
+        return view
+
+    # custom answers don't have a result
+    mmr_exponent = answer.result.mmr_exponent if answer.result_id else 3
+
+    players = [p for team in answer.teams for p in team['players']]
+    mmr_max = max([player[1] ** mmr_exponent for player in players])
+    slugs = dict(Player.objects.filter(id__in=[p[2] for p in players]).values_list('id', 'slug'))
+
+    teams = []
+    for team in answer.teams:
+        role_score = team.get('role_score')
+        team = dict(team, players=[
+            {
+                'name': player[0],
+                'mmr': player[1],
+                'mmr_percent': float(player[1] ** mmr_exponent) / mmr_max * 100,
+                'role_score': role_score[i] if role_score else None,
+                'slug': slugs.get(player[2], ''),  # player could be deleted since this balance
+            }
+            for i, player in enumerate(team['players'])
+        ])
+        teams.append(team)
+
+    winner = None
+    if answer.id:
+        winner = Match.objects.filter(balance_id=answer.id).values_list('winner', flat=True).first()
+
+    view = {
+        'teams': teams,
+        'has_match': winner is not None,
+        'match_winner': winner,
+    }
+    cache.set(key, view, BalanceAnswerManager.view_cache_timeout)
+
+    return view
+
+
+class ResultAnswers:
+    # answers of a result for paginator, only answers of the page are fetched
+    def __init__(self, result):
+        self.result = result
+
+    def __len__(self):
+        key = 'balance_result_count_%s' % self.result.id
+        count = cache.get(key)
+        if count is None:
+            if self.result.snapshot is None:
+                count = self.result.answers.count()
+            else:
+                count = len(BalanceResultManager.lazy_answers(self.result))
+            cache.set(key, count, BalanceAnswerManager.view_cache_timeout)
+
+        return count
+
+    def __getitem__(self, key):
+        return [BalanceResultManager.answer(self.result, i) for i in range(*key.indices(len(self)))]
+
+
 class BalancerResult(DetailView):
     model = BalanceResult
     template_name = 'balancer/balancer-result.html'
@@ -73,27 +142,14 @@ class BalancerResult(DetailView):
         # paginate
         page_num = self.request.GET.get('page', 1)
         try:
-            answers = context['result'].answers.all()
+            answers = ResultAnswers(context['result'])
             page = Paginator(answers, 1, request=self.request).page(page_num)
         except PageNotAnInteger:
             raise Http404
 
         answer = page.object_list[0]
-        mmr_exponent = answer.result.mmr_exponent
-
-        players = [p for team in answer.teams for p in team['players']]
-        mmr_max = max([player[1] ** mmr_exponent for player in players])
-
-        for team in answer.teams:
-            for i, player in enumerate(team['players']):
-                mmr_percent = float(player[1] ** mmr_exponent) / mmr_max * 100
-                team['players'][i] = {
-                    'name': player[0],
-                    'mmr': player[1],
-                    'mmr_percent': mmr_percent,
-                    'role_score': team['role_score'][i],
-                }
 
+        context.update(answer_view(answer))
         context.update({
             'answer': answer,
             'role_names': role_names,
@@ -111,33 +167,9 @@ class BalancerAnswer(DetailView):
 
     def get_context_data(self, **kwargs):
         context = super(BalancerAnswer, self).get_context_data(**kwargs)
-        answer = context['answer']
-
-        # TODO: move mmr_exponent field from BalanceResult to BalanceAnswer model
-        # TODO: also this code repeats from BalancerResult view. Move to separate func?
-        mmr_exponent = 3
-
-        players = [p for team in answer.teams for p in team['players']]
-        mmr_max = max([player[1] ** mmr_exponent for player in players])
-
-        for team in answer.teams:
-            for i, player in enumerate(team['players']):
-                try:
-                    slug = Player.objects.get(name=player[0]).slug
-                except Player.DoesNotExist:
-                    slug = ''  # player was renamed since this balance
-
-                mmr_percent = float(player[1] ** mmr_exponent) / mmr_max * 100
-                team['players'][i] = {
-                    'name': player[0],
-                    'mmr': player[1],
-                    'mmr_percent': mmr_percent,
-                    'role_score': team['role_score'][i] if team.get('role_score') else None,
-                    'slug': slug,
-                }
 
+        context.update(answer_view(context['answer']))
         context.update({
-            'answer': answer,
             'role_names': role_names,
         })
 
@@ -149,10 +181,17 @@ class MatchCreate(PermissionRequiredMixin, RedirectView):
     permission_required = 'ladder.add_match'
 
     def get(self, request, *args, **kwargs):
-        try:
-            answer = BalanceAnswer.objects.get(id=kwargs['pk'])
-        except BalanceAnswer.DoesNotExist:
-            return HttpResponseBadRequest(request)
+        if 'result' in kwargs:
+            # answers of lazy results are saved only when they are used
+            result = BalanceResult.objects.filter(id=kwargs['result']).first()
+            answer = result and BalanceResultManager.answer(result, int(kwargs['index']), save=True)
+            if not answer:
+                return HttpResponseBadRequest(request)
+        else:
+            try:
+                answer = BalanceAnswer.objects.get(id=kwargs['pk'])
+            except BalanceAnswer.DoesNotExist:
+                return HttpResponseBadRequest(request)
 
         if hasattr(answer, 'match'):
             # we already created a match from this BalanceAnswer
@@ -160,13 +199,16 @@ class MatchCreate(PermissionRequiredMixin, RedirectView):
 
         # check that players from balance exist
         # (we don't allow CustomBalance results here)
-        players = [p[0] for t in answer.teams for p in t['players']]
-        players = Player.objects.filter(name__in=players)
+        players = [p[2] for t in answer.teams for p in t['players'] if p[2]]
 
         if len(players) < 10:
             return HttpResponseBadRequest(request)
 
-        MatchManager.record_balance(answer, int(kwargs['winner']))
+        try:
+            MatchManager.record_balance(answer, int(kwargs['winner']))
+        except Player.DoesNotExist:
+            # some players were deleted since the balance was made
+            return HttpResponseBadRequest(request)
 
         return super(MatchCreate, self).get(request, *args, **kwargs)
 
@@ -188,3 +230,150 @@ class MatchDelete(PermissionRequiredMixin, RedirectView):
         answer.match.delete()
 
         return super(MatchDelete, self).get(request, *args, **kwargs)
+
+
+class BalanceApiError(Exception):
+    pass
+
+
+def api_players(values):
+    """
+    Finds players for balance API.
+
+    :param values: list of "<id or name>" or "<id or name>:<mmr>" strings,
+                   numbers are always ids (players with numbers for names are found by id),
+                   MMR replaces player's ladder MMR in this balance
+    :return: list of Player objects (with MMR overrides, they must not be saved)
+    """
+    refs = []
+    for value in values:
+        ref, sep, mmr = value.rpartition(':')
+        if not sep or not mmr.isdigit():
+            ref, mmr = value, None
+        refs.append((ref.strip(), int(mmr) if mmr else None))
+
+    ids = [int(ref) for ref, _ in refs if ref.isdigit()]
+    names = [ref for ref, _ in refs if not ref.isdigit()]
+    by_id, by_name = {}, {}
+    for player in Player.objects.filter(Q(id__in=ids) | Q(name__in=names)).select_related('roles'):
+        by_id[player.id] = player
+        by_name[player.name] = player
+
+    def find(ref):
+        return by_id.get(int(ref)) if ref.isdigit() else by_name.get(ref)
+
+    missing = [ref for ref, _ in refs if not find(ref)]
+    if missing:
+        raise BalanceApiError('Unknown players: %s' % ', '.join(missing))
+
+    players = []
+    for ref, mmr in refs:
+        player = find(ref)
+        if player in players:
+            raise BalanceApiError('Player is listed twice: %s' % player.name)
+        if mmr is not None:
+            player.ladder_mmr = mmr
+        players.append(player)
+
+    return players
+
+
+def api_answer(answer, players, role_balancing):
+    # engine answer with full player info instead of (name, mmr) pairs
+    teams = []
+    for team in answer['teams']:
+        team_players = []
+        for i, (name, mmr) in enumerate(p[:2] for p in team['players']):
+            player = {'id': players[name].id, 'dota_id': players[name].dota_id, 'name': name, 'mmr': mmr}
+            if role_balancing:
+                player.update({'role': role_names[i], 'role_score': team['role_score'][i]})
+            team_players.append(player)
+
+        teams.append({
+            'players': team_players,
+            'mmr': team['mmr'],
+            'mmr_exp': team['mmr_exp'],
+            'role_score_sum': team.get('role_score_sum'),
+        })
+
+    return {
+        'teams': teams,
+        'mmr_diff': answer['mmr_diff'],
+        'mmr_diff_exp': answer['mmr_diff_exp'],
+    }
+
+
+class BalanceApi(PermissionRequiredMixin, View):
+    """
+    Balances 10 players and returns best answers as JSON.
+
+    GET is a dry run, it doesn't write anything to DB. POST saves the result,
+    so it can be opened on the site and used for a match; it needs a permission,
+    because MMRs given here end up in matches.
+    Parameters: player (10 times, see api_players), limit, roles (0 for MMR only balance).
+    Responses have an ETag made from the input, so repeated requests get 304.
+    """
+    max_limit = 126
+    permission_required = 'balancer.add_balanceresult'
+    raise_exception = True
+
+    def has_permission(self):
+        # dry runs don't write anything, anyone can make them
+        return self.request.method in ('GET', 'HEAD') or super(BalanceApi, self).has_permission()
+
+    def get(self, request, *args, **kwargs):
+        return self.balance(request, request.GET, dry_run=True)
+
+    def post(self, request, *args, **kwargs):
+        return self.balance(request, request.POST, dry_run=False)
+
+    def balance(self, request, params, dry_run):
+        try:
+            players = api_players(params.getlist('player'))
+            if len(players) != 10:
+                raise BalanceApiError('Need 10 players, got %d' % len(players))
+
+            limit = int(params.get('limit', 5))
+            if not 1 <= limit <= self.max_limit:
+                raise BalanceApiError('Limit should be from 1 to %d' % self.max_limit)
+        except ValueError:
+            return JsonResponse({'error': 'Limit should be a number'}, status=400)
+        except BalanceApiError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        role_balancing = params.get('roles', '1') != '0'
+        job = BalanceResultManager.balance_job(players, role_balancing, limit)
+
+        # same input gives the same answers
+        etag = '"%s"' % job.key
+        if dry_run and request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return HttpResponseNotModified()
+
+        # saved results are reused, like bots do, so repeated POSTs don't balance again
+        result = None if dry_run else BalanceResultManager.cached_result(job.key)
+        if result:
+            answers = [
+                {'teams': answer.teams, 'mmr_diff': answer.mmr_diff, 'mmr_diff_exp': answer.mmr_diff_exp}
+                for answer in BalanceResultManager.answers(result)
+            ]
+        else:
+            answers = run_balance_job(job)
+            if not dry_run:
+                result = BalanceResultManager.save_answers(job, answers)
+
+        if result:
+            result = {
+                'id': result.id,
+                'url': request.build_absolute_uri(reverse('balancer:balancer-result', args=(result.id,))),
+            }
+
+        by_name = {p.name: p for p in players}
+        response = JsonResponse({
+            'key': job.key,
+            'dry_run': dry_run,
+            'result': result,
+            'answers': [api_answer(answer, by_name, role_balancing) for answer in answers],
+        })
+        response['ETag'] = etag
+
+        return response
@@ -2,7 +2,7 @@ from django import forms
 from django_reverse_admin import ReverseModelAdmin
 
 from app.ladder.models import Player, Match, MatchPlayer, ScoreChange, LadderSettings, LadderQueue, QueuePlayer, \
-    QueueChannel, RolesPreference, DiscordChannels, DiscordPoll
+    QueueChannel, RolesPreference, DiscordChannels, DiscordPoll, PlayerSeasonStats
 from django.contrib import admin
 from django.db.models import Prefetch
 from dal import autocomplete
@@ -101,6 +101,18 @@ class MatchAdmin(admin.ModelAdmin):
 
     list_display = ('date', 'dota_id')
 
+    def save_model(self, request, obj, form, change):
+        obj.old_season = Match.objects.filter(id=obj.id).values_list('season', flat=True).first()
+        super(MatchAdmin, self).save_model(request, obj, form, change)
+
+    def save_related(self, request, form, formsets, change):
+        super(MatchAdmin, self).save_related(request, form, formsets, change)
+
+        # winner, season or players could change, count season stats again
+        match = form.instance
+        for season in {match.season, match.old_season} - {None}:
+            PlayerSeasonStats.objects.rebuild(season)
+
 
 class ScoreChangeAdminForm(forms.ModelForm):
     player = forms.ModelChoiceField(
@@ -0,0 +1,34 @@
+from app.ladder.models import PlayerSeasonStats
+from django.core.management import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Checks players season stats against their matches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--season', type=int, default=None, help='all seasons by default')
+        parser.add_argument('--rebuild', action='store_true', help='count stats again from matches')
+
+    def handle(self, *args, **options):
+        season = options['season']
+
+        counted = PlayerSeasonStats.objects.count_matches(season)
+
+        stored = PlayerSeasonStats.objects.filter(match_count__gt=0)
+        if season is not None:
+            stored = stored.filter(season=season)
+        stored = {
+            (s.player_id, s.season): (s.match_count, s.wins)
+            for s in stored.only('player_id', 'season', 'match_count', 'wins')
+        }
+
+        # (player, season) keys that are missing or differ on either side
+        drift = sorted(set(key for key, _ in set(counted.items()) ^ set(stored.items())))
+        for key in drift:
+            print('player %d, season %d: %s (should be %s)' % (key + (stored.get(key), counted.get(key))))
+
+        print('%d of %d stats are wrong' % (len(drift), len(counted)))
+
+        if options['rebuild']:
+            rows = PlayerSeasonStats.objects.rebuild(options['season'])
+            print('Rebuilt %d stats.' % rows)
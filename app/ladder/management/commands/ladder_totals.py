@@ -0,0 +1,36 @@
+from app.ladder.models import LadderSettings, Player, ScoreChange
+from django.core.management import BaseCommand
+from django.db import transaction
+
+
+class Command(BaseCommand):
+    help = 'Checks players MMR and score against their score changes in current season'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='set totals counted from score changes')
+
+    def handle(self, *args, **options):
+        season = LadderSettings.get_solo().current_season
+
+        sums = ScoreChange.objects.count_sums(season)
+
+        drift = []
+        for player in Player.objects.filter(id__in=sums.keys()):
+            mmr, score = sums[player.id]
+            if (player.ladder_mmr_sum, player.score_sum) != (mmr, score) or \
+                    (player.ladder_mmr, player.score) != (max(mmr, 0), max(score, 0)):
+                drift.append((player, mmr, score))
+                print('%s: MMR %d, sum %d (should be %d), score %d, sum %d (should be %d)' %
+                      (player, player.ladder_mmr, player.ladder_mmr_sum, mmr, player.score, player.score_sum, score))
+
+        print('%d of %d players have wrong totals' % (len(drift), len(sums)))
+
+        if options['fix'] and drift:
+            with transaction.atomic():
+                for player, mmr, score in drift:
+                    Player.objects.filter(id=player.id).update(
+                        ladder_mmr=max(mmr, 0), score=max(score, 0),
+                        ladder_mmr_sum=mmr, score_sum=score,
+                    )
+                Player.objects.update_ranks(season)
+            print('Fixed.')
@@ -0,0 +1,95 @@
+import random
+import timeit
+
+from app.ladder.managers import window_ranks_supported
+from app.ladder.models import Player, RolesPreference
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+
+class Rollback(Exception):
+    pass
+
+
+def per_row_ranks(players):
+    # how ranks were updated before: sort in Python and save every player
+    players = list(players)
+
+    for field in ['ladder_mmr', 'score']:
+        players.sort(key=lambda p: getattr(p, field), reverse=True)
+
+        ranks = [1]
+        for i in range(1, len(players)):
+            curr_val = getattr(players[i], field)
+            prev_val = getattr(players[i-1], field)
+            ranks.append(ranks[i-1] if curr_val == prev_val else i+1)
+
+        for i, player in enumerate(players):
+            setattr(player, f'rank_{field}', ranks[i])
+            player.save()
+
+
+class Command(BaseCommand):
+    help = 'Times rank updates on synthetic ladders (players are removed afterwards)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+        parser.add_argument('--per-row-max', type=int, default=10000,
+                            help='don\'t run per-row saves for bigger ladders, it takes too long')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        print('Window functions: %s' % ('yes' if window_ranks_supported() else 'no'))
+
+        for size in options['sizes']:
+            try:
+                with transaction.atomic():
+                    self.run(size, rnd, options)
+                    raise Rollback
+            except Rollback:
+                pass
+
+    def run(self, size, rnd, options):
+        # players go straight to DB, Player.save() would give each of them a ScoreChange
+        roles_start = RolesPreference.objects.count()
+        RolesPreference.objects.bulk_create([RolesPreference() for _ in range(size)])
+        roles = RolesPreference.objects.order_by('id').values_list('id', flat=True)[roles_start:]
+
+        Player.objects.bulk_create([
+            Player(
+                name='bench_%d' % i,
+                slug='bench-%d' % i,
+                dota_mmr=0,
+                ladder_mmr=rnd.randint(1000, 8000),
+                score=rnd.randint(0, 100),
+                roles_id=role,
+            )
+            for i, role in enumerate(roles)
+        ], batch_size=100)
+
+        players = Player.objects.filter(name__startswith='bench_')
+        ids = players.values('id').order_by()
+
+        timings = []
+        if window_ranks_supported():
+            timings.append(('window', lambda: Player.objects.window_ranks(ids)))
+        timings.append(('python', lambda: Player.objects.python_ranks(ids)))
+        if size <= options['per_row_max']:
+            timings.append(('per-row', lambda: per_row_ranks(players)))
+
+        results = {}
+        ranks = []
+        for name, func in timings:
+            # start from stale ranks every time, so every path writes all of them
+            players.update(rank_ladder_mmr=0, rank_score=0)
+            results[name] = timeit.timeit(func, number=1)
+            ranks.append(sorted(players.values_list('id', 'rank_ladder_mmr', 'rank_score')))
+
+        # all paths give the same ranks
+        assert all(r == ranks[0] for r in ranks)
+
+        slowest = max(results.values())
+        print('%d players:' % size)
+        for name, seconds in results.items():
+            print('  %-8s %9.3f s  x%.1f' % (name, seconds, slowest / seconds))
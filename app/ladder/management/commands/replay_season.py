@@ -0,0 +1,80 @@
+import time
+
+import numpy as np
+from app.ladder import replay
+from app.ladder.managers import MatchManager
+from app.ladder.models import LadderSettings, Player
+from django.core.management import BaseCommand
+
+
+def ranks(values, ranked):
+    # 1 + amount of ranked players with a better value
+    better = np.sort(-values[ranked])
+    return 1 + np.searchsorted(better, -values, side='left')
+
+
+class Command(BaseCommand):
+    help = 'Counts MMR and score of a season again under different rules. ' \
+           'Shows what changes, writes it with --apply'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--season', type=int, default=None, help='current season by default')
+        parser.add_argument('--apply', action='store_true', help='write replayed changes to DB')
+        parser.add_argument('--limit', type=int, default=20, help='amount of players to show')
+
+        # rules, current ones by default
+        parser.add_argument('--mmr-per-game', type=int)
+        parser.add_argument('--score-per-game', type=int)
+        parser.add_argument('--underdog-diff', type=int)
+        parser.add_argument('--underdog-bonus', type=int)
+        parser.add_argument('--underdog-max', type=int)
+        parser.add_argument('--boundaries', dest='boundaries', action='store_true', default=None)
+        parser.add_argument('--no-boundaries', dest='boundaries', action='store_false')
+
+    def handle(self, *args, **options):
+        season = options['season']
+        if season is None:
+            season = LadderSettings.get_solo().current_season
+
+        rules = MatchManager.rules()
+        rules = rules._replace(**{
+            field: options[field] for field in rules._fields if options[field] is not None
+        })
+
+        start = time.time()
+        data = replay.load_season(season)
+        loaded = time.time()
+        old = replay.recorded(data)
+        new = replay.replay(data, rules)
+        replayed = time.time()
+
+        print('Season %d: %d matches, %d players. Loaded in %.2f s, replayed in %.3f s' %
+              (season, len(data.winner), len(data.players), loaded - start, replayed - loaded))
+        print(rules)
+
+        rated = data.row_change > 0
+        changed_rows = rated & ((old.row_mmr != new.row_mmr) | (old.row_score != new.row_score))
+        changed = np.flatnonzero((old.mmr != new.mmr) | (old.score != new.score))
+        print('Changed: %d of %d match score changes, %d of %d players' %
+              (changed_rows.sum(), rated.sum(), len(changed), len(data.players)))
+
+        # players who played this season are ranked
+        ranked = np.zeros(len(data.players), dtype=bool)
+        ranked[data.row_player] = True
+        old_rank, new_rank = ranks(old.mmr, ranked), ranks(new.mmr, ranked)
+
+        shown = sorted(changed, key=lambda p: -abs(new.mmr[p] - old.mmr[p]))[:options['limit']]
+        if shown:
+            names = Player.objects.in_bulk(data.players[shown].tolist())
+            print()
+            print('%-25s %16s %12s %12s' % ('Player', 'MMR', 'Score', 'MMR rank'))
+            for p in shown:
+                print('%-25s %6d -> %6d %4d -> %4d %4d -> %4d' % (
+                    names[int(data.players[p])].name[:25],
+                    old.mmr[p], new.mmr[p], old.score[p], new.score[p], old_rank[p], new_rank[p],
+                ))
+
+        if options['apply']:
+            rows, players = replay.apply(data, new)
+            print()
+            print('Applied: %d score changes, %d players totals' % (rows, players))
@@ -11,5 +11,10 @@ class Command(BaseCommand):
             ladder.current_season += 1
             ladder.save()
 
-            for player in Player.objects.all():
+            # totals are counted from scratch in a new season,
+            # initial MMR is taken from players loaded before the reset
+            players = list(Player.objects.all())
+            Player.objects.update(ladder_mmr=0, score=0, ladder_mmr_sum=0, score_sum=0)
+
+            for player in players:
                 PlayerManager.init_score(player)
@@ -1,11 +1,41 @@
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import datetime
+import sqlite3
 
 import pytz
-from django.db import models, transaction
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Q, Sum, Case, When, Value, IntegerField, DateTimeField
+from django.db.models.functions import Greatest
 from django.utils import timezone
 
 
+# how matches change players MMR and score; MatchManager.rules() gives the current ones
+Rules = namedtuple('Rules', [
+    'mmr_per_game', 'score_per_game',
+    'underdog_diff', 'underdog_bonus', 'underdog_max',  # bonus for every underdog_diff of teams MMR diff
+    'boundaries',  # keep players MMR within their min/max allowed MMR
+])
+
+
+def total_changes(mmr_change, score_change):
+    """
+    Player fields update that counts a score change.
+    Totals can't go below zero (see Player.save), but every change must be possible to take back,
+    so sums of changes are kept too and totals are made from them.
+    """
+    return {
+        'ladder_mmr_sum': F('ladder_mmr_sum') + mmr_change,
+        'score_sum': F('score_sum') + score_change,
+        'ladder_mmr': Greatest(F('ladder_mmr_sum') + mmr_change, Value(0), output_field=IntegerField()),
+        'score': Greatest(F('score_sum') + score_change, Value(0), output_field=IntegerField()),
+    }
+
+
+def window_ranks_supported():
+    # window functions came in SQLite 3.25, UPDATE ... FROM in 3.33
+    return connection.vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 33)
+
+
 class PlayerManager(models.Manager):
     # gives player initial score and mmr
     @staticmethod
@@ -31,30 +61,145 @@ class PlayerManager(models.Manager):
         player.max_allowed_mmr = initial_mmr + 1000
         player.save()
 
-    def update_ranks(self):
-        from app.ladder.models import LadderSettings
-
-        # recalculate player rankings by particular field (ladder_mmr or score)
-        def update_ranks_by(field):
-            players.sort(key=lambda p: getattr(p, field), reverse=True)
+    def update_ranks(self, season=None):
+        # counts all ranks again; matches use update_match_ranks(), this one repairs them
+        from app.ladder.models import LadderSettings, MatchPlayer
 
-            ranks = [1]
-            for i in range(1, len(players)):
-                curr_val = getattr(players[i], field)
-                prev_val = getattr(players[i-1], field)
-                ranks.append(ranks[i-1] if curr_val == prev_val else i+1)
+        if season is None:
+            season = LadderSettings.get_solo().current_season
 
-            for i, player in enumerate(players):
-                setattr(player, f'rank_{field}', ranks[i])
-                player.save()
+        # rank players who played this season (or everyone, if nobody did yet)
+        players = MatchPlayer.objects.filter(match__season=season).values('player_id').order_by()
+        if not players.exists():
+            players = self.values('id').order_by()
 
-        season = LadderSettings.get_solo().current_season
-        players = self.filter(matchplayer__match__season=season).distinct()
-        players = players or self.all()
-        players = list(players)  # evaluate
-
-        update_ranks_by('ladder_mmr')
-        update_ranks_by('score')
+        if window_ranks_supported():
+            self.window_ranks(players)
+        else:
+            self.python_ranks(players)
+
+    def window_ranks(self, players):
+        """
+        Counts ranks in DB and writes changed ones in a single UPDATE.
+        Raw SQL, because this Django knows neither window functions nor UPDATE ... FROM.
+
+        :param players: values() queryset with ids of ranked players
+        """
+        players, params = players.query.sql_with_params()
+        table = connection.ops.quote_name(self.model._meta.db_table)
+
+        # RANK() gives equal values the same rank and skips ranks after them (1, 1, 3),
+        # same as 1 + amount of players with a better value
+        sql = """
+            UPDATE {table} SET rank_ladder_mmr = ranks.mmr_rank, rank_score = ranks.score_rank
+            FROM (
+                SELECT id,
+                       RANK() OVER (ORDER BY ladder_mmr DESC) AS mmr_rank,
+                       RANK() OVER (ORDER BY score DESC) AS score_rank
+                FROM {table} WHERE id IN ({players})
+            ) AS ranks
+            WHERE {table}.id = ranks.id
+              AND ({table}.rank_ladder_mmr != ranks.mmr_rank OR {table}.rank_score != ranks.score_rank)
+        """.format(table=table, players=players)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def python_ranks(self, players):
+        """
+        Same as window_ranks() for DBs without window functions:
+        ranks are counted here and changed ones are written in batches.
+        """
+        players = list(self.filter(id__in=players).values_list('id', 'ladder_mmr', 'score', 'rank_ladder_mmr', 'rank_score'))
+
+        ranks = {}
+        for i in range(2):  # ladder_mmr, then score
+            players.sort(key=lambda p: p[1 + i], reverse=True)
+            rank = 1
+            for pos, player in enumerate(players):
+                if pos and player[1 + i] != players[pos - 1][1 + i]:
+                    rank = pos + 1
+                ranks.setdefault(player[0], [None, None])[i] = rank
+
+        self.set_ranks({
+            player[0]: ranks[player[0]] for player in players
+            if ranks[player[0]] != [player[3], player[4]]
+        })
+
+    def update_match_ranks(self, before, changes, season):
+        """
+        Updates ranks after players of a match got new MMR and score.
+        Other players' ranks only change if match players went past them,
+        so only these players are looked at, and only changed ranks are written.
+        Match players should be ranked already (played this season before),
+        otherwise use update_ranks().
+
+        :param before: player id -> dict with ladder_mmr, score, their sums and ranks before the match
+        :param changes: player id -> (mmr change, score change)
+        """
+        from app.ladder.models import MatchPlayer
+
+        fields = ['ladder_mmr', 'score']
+        old = {p: [before[p][field] for field in fields] for p in changes}
+        new = {
+            p: [max(before[p][field + '_sum'] + change, 0) for field, change in zip(fields, changes[p])]
+            for p in changes
+        }
+
+        ranked = self.filter(id__in=MatchPlayer.objects.filter(match__season=season).values('player_id').order_by())
+
+        def shift(i, value):
+            # how rank of a player with this value changes
+            return sum((new[p][i] > value) - (old[p][i] > value) for p in changes)
+
+        # players whose value is between old and new value of some match player
+        passed = Q(pk__in=[])
+        for i, field in enumerate(fields):
+            for p in changes:
+                low, high = sorted([old[p][i], new[p][i]])
+                passed |= Q(**{field + '__gte': low, field + '__lt': high})
+
+        ranks = {}
+        others = ranked.exclude(id__in=changes).filter(passed)
+        for player in others.values('id', 'ladder_mmr', 'score', 'rank_ladder_mmr', 'rank_score'):
+            rank = [player['rank_' + field] + shift(i, player[field]) for i, field in enumerate(fields)]
+            if rank != [player['rank_' + field] for field in fields]:
+                ranks[player['id']] = rank
+
+        # match players are counted from scratch, all in one query
+        better = ranked.aggregate(**{
+            '%s_%s' % (field, p): Count(Case(When(then=1, **{field + '__gt': new[p][i]}), output_field=IntegerField()))
+            for p in changes
+            for i, field in enumerate(fields)
+        })
+        for p in changes:
+            rank = [1 + better['%s_%s' % (field, p)] for field in fields]
+            if rank != [before[p]['rank_' + field] for field in fields]:
+                ranks[p] = rank
+
+        self.set_ranks(ranks)
+
+    def set_ranks(self, ranks):
+        """
+        :param ranks: player id -> (rank_ladder_mmr, rank_score)
+        """
+        self.set_values(ranks, ['rank_ladder_mmr', 'rank_score'])
+
+    def set_values(self, values, fields):
+        """
+        Writes integer fields of many players with one UPDATE per a few hundred players.
+
+        :param values: player id -> values of fields
+        """
+        values = list(values.items())
+        batch_size = 900 // (1 + 2 * len(fields))  # SQLite allows 999 query parameters
+
+        for start in range(0, len(values), batch_size):
+            batch = values[start:start + batch_size]
+            self.filter(id__in=[p for p, _ in batch]).update(**{
+                field: Case(*[When(id=p, then=Value(vals[i])) for p, vals in batch], output_field=IntegerField())
+                for i, field in enumerate(fields)
+            })
 
     @staticmethod
     def dota_to_ladder_mmr(mmr):
@@ -69,86 +214,239 @@ class MatchManager(models.Manager):
     underdog_diff = 150
 
     @staticmethod
-    def add_scores(match):
-        from app.ladder.models import ScoreChange
+    def rules(settings=None):
         from app.ladder.models import LadderSettings
 
+        if settings is None:
+            settings = LadderSettings.get_solo()
+
         # TODO: make values like win/loss change and underdog bonus changeble in admin panel
-        mmr_diff = match.balance.teams[0]['mmr'] - match.balance.teams[1]['mmr']
+        return Rules(
+            mmr_per_game=settings.mmr_per_game,
+            score_per_game=1,
+            underdog_diff=MatchManager.underdog_diff,
+            underdog_bonus=15,  # 15 mmr points for each 150 mmr diff
+            underdog_max=15,  # but no more than 15 mmr
+            boundaries=False,  # TODO: get this values from LadderSettings
+        )
+
+    @staticmethod
+    def underdog(mmr_diff, rules):
+        """
+        :param mmr_diff: first team MMR - second team MMR
+        :return: underdog team, its MMR bonus
+        """
         underdog = 0 if mmr_diff <= 0 else 1
-        underdog_bonus = abs(mmr_diff) // MatchManager.underdog_diff * 15  # 15 mmr points for each 200 mmr diff
-        underdog_bonus = min(15, underdog_bonus)  # but no more than 15 mmr
+        bonus = abs(mmr_diff) // rules.underdog_diff * rules.underdog_bonus
+        return underdog, min(rules.underdog_max, bonus)
+
+    @staticmethod
+    def add_scores(match, settings=None):
+        from app.ladder.models import Player, ScoreChange
+        from app.ladder.models import LadderSettings
+
+        if settings is None:
+            settings = LadderSettings.get_solo()
+        rules = MatchManager.rules(settings)
+
+        mmr_diff = match.balance.teams[0]['mmr'] - match.balance.teams[1]['mmr']
+        underdog, underdog_bonus = MatchManager.underdog(mmr_diff, rules)
 
         print('mmr diff: %d' % mmr_diff)
         print('underdog: %d' % underdog)
         print('underdog bonus: %d' % underdog_bonus)
         print('')
 
+        score_changes = []
+        players = defaultdict(list)  # (score change, mmr change) -> players ids
         for matchPlayer in match.matchplayer_set.all():
             is_victory = 1 if matchPlayer.team == match.winner else -1
             is_underdog = 1 if matchPlayer.team == underdog else -1
 
-            score_change = 1 * is_victory
+            score_change = rules.score_per_game * is_victory
 
-            mmr_per_game = LadderSettings.get_solo().mmr_per_game
-            mmr_change = mmr_per_game * is_victory
+            mmr_change = rules.mmr_per_game * is_victory
             mmr_change += underdog_bonus * is_underdog
 
-            use_boundary = False  # TODO: get this values from LadderSettings
-            if use_boundary:
+            if rules.boundaries:
                 # make sure new ladder mmr is in boundaries
                 player = matchPlayer.player
                 new_mmr = player.ladder_mmr + mmr_change
                 new_mmr = max(player.min_allowed_mmr, min(new_mmr, player.max_allowed_mmr))
                 mmr_change = new_mmr - player.ladder_mmr
 
-            ScoreChange.objects.create(
-                player=matchPlayer.player,
+            score_changes.append(ScoreChange(
+                player_id=matchPlayer.player_id,
                 score_change=score_change,
                 mmr_change=mmr_change,
                 match=matchPlayer,
-                season=LadderSettings.get_solo().current_season,
-            )
+                season=settings.current_season,
+            ))
+            players[(score_change, mmr_change)].append(matchPlayer.player_id)
+
+        # bulk_create doesn't send signals, so players stats are updated here,
+        # players with the same changes (usually a whole team) in one query
+        ScoreChange.objects.bulk_create(score_changes)
+        for (score_change, mmr_change), ids in players.items():
+            Player.objects.filter(id__in=ids).update(**total_changes(mmr_change, score_change))
+
+        # player id -> (mmr change, score change)
+        return {p: (mmr_change, score_change) for (score_change, mmr_change), ids in players.items() for p in ids}
 
     @staticmethod
     def record_balance(answer, winner, dota_id=None):
         from app.ladder.models import Player, Match, MatchPlayer
         from app.ladder.models import LadderSettings
 
-        players = [p[0] for t in answer.teams for p in t['players']]
-        players = Player.objects.filter(name__in=players)
-
-        # check that all players from balance exist
-        # (we don't allow CustomBalance results here)
+        # custom balances can have people who aren't ladder players, we don't record them
+        players = [p[2] for t in answer.teams for p in t['players'] if p[2]]
         if len(players) < 10:
             return None
 
+        settings = LadderSettings.get_solo()
+        season = settings.current_season
+
         with transaction.atomic():
+            before = Player.objects\
+                .filter(id__in=players)\
+                .values('id', 'ladder_mmr', 'score', 'ladder_mmr_sum', 'score_sum', 'rank_ladder_mmr', 'rank_score')
+            before = {p['id']: p for p in before}
+
+            # players could be deleted since the balance was made
+            if len(before) != len(players):
+                missing = [p[0] for t in answer.teams for p in t['players'] if p[2] not in before]
+                raise Player.DoesNotExist('Players of the balance don\'t exist: %s' % ', '.join(missing))
+
+            # new players change the set of ranked players, then all ranks are counted again
+            ranked = MatchPlayer.objects\
+                .filter(match__season=season, player_id__in=players)\
+                .values('player_id').distinct().count() == len(players)
+
             match = Match.objects.create(
                 winner=winner,
                 balance=answer,
-                season=LadderSettings.get_solo().current_season,
+                season=settings.current_season,
                 dota_id=dota_id,
             )
 
-            for i, team in enumerate(answer.teams):
-                for player in team['players']:
-                    player = next(p for p in players if p.name == player[0])
+            MatchPlayer.objects.bulk_create([
+                MatchPlayer(match=match, player_id=player[2], team=i)
+                for i, team in enumerate(answer.teams)
+                for player in team['players']
+            ])
 
-                    MatchPlayer.objects.create(
-                        match=match,
-                        player=player,
-                        team=i
-                    )
+            changes = MatchManager.add_scores(match, settings)
+            PlayerSeasonStatsManager.add_match(match, [
+                [player[2] for player in team['players']]
+                for team in answer.teams
+            ])
 
-            MatchManager.add_scores(match)
-            Player.objects.update_ranks()
+            if ranked:
+                Player.objects.update_match_ranks(before, changes, season)
+            else:
+                Player.objects.update_ranks(season)
 
         return match
 
 
+class PlayerSeasonStatsManager(models.Manager):
+    @staticmethod
+    def add_match(match, teams, sign=1):
+        """
+        Counts match in season stats of its players.
+
+        :param teams: players ids of both teams
+        :param sign: -1 takes the match back (when it's deleted)
+        """
+        from app.ladder.models import PlayerSeasonStats
+
+        stats = PlayerSeasonStats.objects.filter(season=match.season)
+
+        if sign > 0:
+            # first match of the season for some players
+            players = [p for team in teams for p in team]
+            known = set(stats.filter(player_id__in=players).values_list('player_id', flat=True))
+            PlayerSeasonStats.objects.bulk_create([
+                PlayerSeasonStats(player_id=p, season=match.season)
+                for p in players if p not in known
+            ])
+
+        for team, players in enumerate(teams):
+            won = int(team == match.winner)
+            stats.filter(player_id__in=players).update(
+                match_count=F('match_count') + sign,
+                wins=F('wins') + sign * won,
+                losses=F('losses') + sign * (1 - won),
+            )
+
+    @staticmethod
+    def count_matches(season=None):
+        """
+        Counts season stats from matches.
+
+        :return: (player id, season) -> (match count, wins)
+        """
+        from app.ladder.models import MatchPlayer
+
+        players = MatchPlayer.objects.order_by()
+        if season is not None:
+            players = players.filter(match__season=season)
+
+        players = players\
+            .values('player_id', 'match__season')\
+            .annotate(
+                match_count=Count('id'),
+                wins=Count(Case(When(team=F('match__winner'), then=1))),
+            )
+
+        return {(p['player_id'], p['match__season']): (p['match_count'], p['wins']) for p in players}
+
+    @staticmethod
+    def rebuild(season=None):
+        from app.ladder.models import PlayerSeasonStats
+
+        stats = PlayerSeasonStatsManager.count_matches(season)
+
+        with transaction.atomic():
+            old = PlayerSeasonStats.objects.all()
+            if season is not None:
+                old = old.filter(season=season)
+            old.delete()
+
+            PlayerSeasonStats.objects.bulk_create([
+                PlayerSeasonStats(player_id=player, season=s, match_count=count, wins=wins, losses=count - wins)
+                for (player, s), (count, wins) in stats.items()
+            ])
+
+        return len(stats)
+
+
 class ScoreChangeManager(models.Manager):
-    pass
+    @staticmethod
+    def count_sums(season):
+        """
+        :return: player id -> (sum of MMR changes, sum of score changes) of the season
+        """
+        from app.ladder.models import ScoreChange
+
+        sums = ScoreChange.objects\
+            .filter(season=season)\
+            .order_by()\
+            .values('player_id')\
+            .annotate(Sum('mmr_change'), Sum('score_change'))
+
+        return {s['player_id']: (s['mmr_change__sum'], s['score_change__sum']) for s in sums}
+
+    @staticmethod
+    def count_totals(season):
+        """
+        Players MMR and score as they should be after all score changes of the season (see total_changes).
+
+        :return: player id -> (mmr, score)
+        """
+        sums = ScoreChangeManager.count_sums(season)
+
+        return {p: (max(mmr, 0), max(score, 0)) for p, (mmr, score) in sums.items()}
 
 
 class QueueChannelManager(models.Manager):
@@ -180,3 +478,63 @@ class QueueChannelManager(models.Manager):
         LadderQueue.objects\
             .filter(channel__active=False)\
             .update(active=False)
+
+    @staticmethod
+    def matchmake(channel):
+        """
+        Makes games from players who wait in not full queues of any channel.
+        Players are picked by matchmaker and moved to a new queue in given channel.
+
+        :return: list of new full queues
+        """
+        from app.balancer import matchmaker
+        from app.ladder.models import LadderSettings, LadderQueue, QueuePlayer
+
+        settings = LadderSettings.get_solo()
+        dota_mmr_filter = settings.queue_mmr_filter == LadderSettings.DOTA_MMR
+
+        waiting = QueuePlayer.objects\
+            .filter(queue__active=True)\
+            .annotate(Count('queue__players'))\
+            .filter(queue__players__count__lt=10)\
+            .select_related('player')
+        waiting = [
+            matchmaker.Waiting(
+                id=qp.player_id,
+                mmr=qp.player.ladder_mmr,
+                filter_mmr=qp.player.dota_mmr if dota_mmr_filter else qp.player.ladder_mmr,
+                joined_date=qp.joined_date,
+            )
+            for qp in waiting
+        ]
+        joined = {p.id: p.joined_date for p in waiting}
+
+        matches = matchmaker.pick_matches(
+            waiting, timezone.now(), channel.min_mmr, channel.max_mmr, settings.balance_exponent
+        )
+
+        queues = []
+        for match in matches:
+            with transaction.atomic():
+                # delete one by one, so signals close queues that are left empty
+                for qp in QueuePlayer.objects.filter(player_id__in=match, queue__active=True):
+                    qp.delete()
+
+                queue = LadderQueue.objects.create(
+                    min_mmr=channel.min_mmr,
+                    max_mmr=channel.max_mmr,
+                    channel=channel
+                )
+                # one by one, same as when player joins a queue, so save() and signals run
+                for player_id in match:
+                    QueuePlayer.objects.create(queue=queue, player_id=player_id)
+
+                # players keep their place: joined_date is auto_now_add, so it's set back after create
+                queue.queueplayer_set.update(joined_date=Case(
+                    *[When(player_id=p, then=Value(joined[p])) for p in match],
+                    output_field=DateTimeField(),
+                ))
+
+            queues.append(queue)
+
+        return queues
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 08:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ladder', '0075_auto_20220113_1520'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='laddersettings',
+            name='balancer_engine',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Python'), (1, 'NumPy')], default=1),
+        ),
+    ]
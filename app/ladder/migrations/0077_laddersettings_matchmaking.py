@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 09:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ladder', '0076_laddersettings_balancer_engine'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='laddersettings',
+            name='matchmaking',
+            field=models.BooleanField(default=False),
+        ),
+    ]
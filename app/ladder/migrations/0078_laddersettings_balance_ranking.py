@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 09:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ladder', '0077_laddersettings_matchmaking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='laddersettings',
+            name='balance_ranking',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Best roles within MMR difference threshold'), (1, 'Pareto front of roles and MMR difference')], default=0),
+        ),
+        migrations.AddField(
+            model_name='laddersettings',
+            name='pareto_mmr_weight',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='laddersettings',
+            name='pareto_role_weight',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+    ]
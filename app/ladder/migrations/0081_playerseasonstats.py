@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 09:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Case, Count, F, When
+import django.db.models.deletion
+
+
+def count_stats(apps, schema_editor):
+    MatchPlayer = apps.get_model('ladder', 'MatchPlayer')
+    PlayerSeasonStats = apps.get_model('ladder', 'PlayerSeasonStats')
+
+    stats = MatchPlayer.objects\
+        .order_by()\
+        .values('player_id', 'match__season')\
+        .annotate(
+            match_count=Count('id'),
+            wins=Count(Case(When(team=F('match__winner'), then=1))),
+        )
+
+    PlayerSeasonStats.objects.bulk_create([
+        PlayerSeasonStats(
+            player_id=s['player_id'],
+            season=s['match__season'],
+            match_count=s['match_count'],
+            wins=s['wins'],
+            losses=s['match_count'] - s['wins'],
+        ) for s in stats
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ladder', '0080_laddersettings_balance_retention_days'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayerSeasonStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('season', models.PositiveSmallIntegerField(db_index=True)),
+                ('match_count', models.PositiveIntegerField(default=0)),
+                ('wins', models.PositiveIntegerField(default=0)),
+                ('losses', models.PositiveIntegerField(default=0)),
+                ('player', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='season_stats', to='ladder.Player')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='playerseasonstats',
+            unique_together=set([('player', 'season')]),
+        ),
+        migrations.RunPython(count_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 10:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+def count_sums(apps, schema_editor):
+    LadderSettings = apps.get_model('ladder', 'LadderSettings')
+    Player = apps.get_model('ladder', 'Player')
+    ScoreChange = apps.get_model('ladder', 'ScoreChange')
+
+    settings = LadderSettings.objects.first()
+    season = settings.current_season if settings else 1
+
+    # players without changes in this season have nothing to take back, totals are their sums
+    Player.objects.update(ladder_mmr_sum=F('ladder_mmr'), score_sum=F('score'))
+
+    sums = ScoreChange.objects\
+        .filter(season=season)\
+        .order_by()\
+        .values('player_id')\
+        .annotate(Sum('mmr_change'), Sum('score_change'))
+    for s in sums:
+        Player.objects.filter(id=s['player_id']).update(
+            ladder_mmr_sum=s['mmr_change__sum'],
+            score_sum=s['score_change__sum'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ladder', '0081_playerseasonstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='ladder_mmr_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='score_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_sums, migrations.RunPython.noop),
+    ]
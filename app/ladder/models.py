@@ -5,7 +5,7 @@ from multiselectfield import MultiSelectField
 
 from app.balancer.models import BalanceAnswer
 from autoslug import AutoSlugField
-from app.ladder.managers import PlayerManager, ScoreChangeManager
+from app.ladder.managers import PlayerManager, ScoreChangeManager, PlayerSeasonStatsManager
 from solo.models import SingletonModel
 from annoying.fields import AutoOneToOneField
 
@@ -33,6 +33,9 @@ class Player(models.Model):
 
     ladder_mmr = models.PositiveIntegerField(default=0)
     score = models.PositiveIntegerField(default=0)
+    # sums of score changes of current season, totals are these sums but not below zero
+    ladder_mmr_sum = models.IntegerField(default=0)
+    score_sum = models.IntegerField(default=0)
     rank_ladder_mmr = models.PositiveIntegerField(default=0)
     rank_score = models.PositiveIntegerField(default=0)
 
@@ -88,6 +91,10 @@ class Player(models.Model):
         if created:
             self.roles = RolesPreference.objects.create()
 
+            # totals are sums of score changes, init_score() gives the first one
+            self.score = self.ladder_mmr = 0
+            self.score_sum = self.ladder_mmr_sum = 0
+
         super(Player, self).save(*args, **kwargs)
 
         # give player initial score and mmr
@@ -133,6 +140,27 @@ class ScoreChange(models.Model):
         ordering = ('-id', )
 
 
+# match stats of a player in a season, so lists don't count them from all matches;
+# updated when matches are recorded or deleted, ladder_stats command rebuilds them
+class PlayerSeasonStats(models.Model):
+    player = models.ForeignKey(Player, related_name='season_stats')
+    season = models.PositiveSmallIntegerField(db_index=True)
+    match_count = models.PositiveIntegerField(default=0)
+    wins = models.PositiveIntegerField(default=0)
+    losses = models.PositiveIntegerField(default=0)
+
+    objects = PlayerSeasonStatsManager()
+
+    class Meta:
+        unique_together = ('player', 'season')
+
+    @property
+    def winrate(self):
+        if not self.match_count:
+            return 0
+        return float(self.wins) / self.match_count * 100
+
+
 class LadderSettings(SingletonModel):
     current_season = models.PositiveSmallIntegerField(default=1)
     use_queue = models.BooleanField(default=True)
@@ -164,6 +192,37 @@ class LadderSettings(SingletonModel):
     )
     queue_mmr_filter = models.PositiveSmallIntegerField(choices=QFILTER_CHOICES, default=LADDER_MMR)
 
+    # team balancer implementation
+    PYTHON_ENGINE = 0
+    NUMPY_ENGINE = 1
+    ENGINE_CHOICES = (
+        (PYTHON_ENGINE, 'Python'),
+        (NUMPY_ENGINE, 'NumPy'),
+    )
+    balancer_engine = models.PositiveSmallIntegerField(choices=ENGINE_CHOICES, default=NUMPY_ENGINE)
+
+    # pick best 10 players from everyone waiting in queues instead of first-come-first-served
+    matchmaking = models.BooleanField(default=False)
+
+    # how role balance answers are ranked
+    THRESHOLD_RANKING = 0
+    PARETO_RANKING = 1
+    RANKING_CHOICES = (
+        (THRESHOLD_RANKING, 'Best roles within MMR difference threshold'),
+        (PARETO_RANKING, 'Pareto front of roles and MMR difference'),
+    )
+    balance_ranking = models.PositiveSmallIntegerField(choices=RANKING_CHOICES, default=THRESHOLD_RANKING)
+
+    # pareto ranking: how much role comfort and MMR difference matter
+    pareto_role_weight = models.PositiveSmallIntegerField(default=1)
+    pareto_mmr_weight = models.PositiveSmallIntegerField(default=1)
+
+    # save only balance input, answers are balanced again when someone looks at them
+    lazy_balance_answers = models.BooleanField(default=False)
+
+    # balance results that no match or queue uses are deleted after this amount of days (0 keeps them)
+    balance_retention_days = models.PositiveSmallIntegerField(default=7)
+
 
 class DiscordChannels(SingletonModel):
     polls = models.PositiveIntegerField(null=True, blank=True)
@@ -0,0 +1,211 @@
+"""
+Replays rating of a whole season under given rules (see managers.Rules).
+
+Matches of the season, their teams and other score changes (season start,
+changes made by admins) are loaded once into arrays, then players MMR and score
+are counted again in memory. Result can be compared with what is recorded
+or written back with a few bulk queries in one transaction.
+"""
+import bisect
+from collections import defaultdict, namedtuple
+
+import numpy as np
+from django.db import transaction
+
+from app.ladder.managers import MatchManager
+
+
+# season as arrays; players are referred to by index in players array,
+# match players are rows in order of matches, rows of match i are rows[starts[i]:starts[i + 1]]
+Season = namedtuple('Season', [
+    'season',
+    'players',  # players ids
+    'min_mmr', 'max_mmr',  # MMR boundaries of players
+    'team_mmr',  # MMR of both teams in balance answer of every match
+    'winner',  # winner team of every match
+    'starts',  # first row of every match, then amount of rows
+    'row_player', 'row_team',
+    'row_change',  # id of ScoreChange of the row, 0 if match player has none (not rated)
+    'row_mmr', 'row_score',  # recorded changes
+    'other_player', 'other_mmr', 'other_score',  # score changes not made by matches
+    'other_before',  # amount of matches played before every other change
+])
+
+# players totals and changes of every row
+Replay = namedtuple('Replay', ['mmr', 'score', 'row_mmr', 'row_score'])
+
+
+def load_season(season):
+    from app.ladder.models import Match, MatchPlayer, Player, ScoreChange
+
+    matches = Match.objects\
+        .filter(season=season)\
+        .order_by('date', 'id')\
+        .select_related('balance__result')\
+        .defer('balance__result__snapshot')
+    matches = list(matches)
+    match_pos = {m.id: i for i, m in enumerate(matches)}
+
+    rows = MatchPlayer.objects\
+        .filter(match__season=season)\
+        .order_by()\
+        .values_list('id', 'match_id', 'player_id', 'team')
+    rows = sorted(rows, key=lambda r: (match_pos[r[1]], r[3], r[0]))
+
+    # matchplayer id -> its score change
+    changes = ScoreChange.objects\
+        .filter(season=season, match__isnull=False)\
+        .order_by()\
+        .values_list('match_id', 'id', 'mmr_change', 'score_change')
+    changes = {c[0]: c[1:] for c in changes}
+
+    others = ScoreChange.objects\
+        .filter(season=season, match__isnull=True)\
+        .order_by('date', 'id')\
+        .values_list('player_id', 'mmr_change', 'score_change', 'date')
+
+    players = sorted(set(r[2] for r in rows) | set(o[0] for o in others))
+    index = {p: i for i, p in enumerate(players)}
+    boundaries = {
+        p[0]: p[1:] for p in Player.objects.values_list('id', 'min_allowed_mmr', 'max_allowed_mmr')
+    }
+
+    def teams_mmr(match):
+        if match.balance is None:
+            return [0, 0]
+        return [team['mmr'] for team in match.balance.teams]
+
+    match_dates = [m.date for m in matches]
+    counts = np.bincount([match_pos[r[1]] for r in rows], minlength=len(matches))
+    no_change = (0, 0, 0)
+
+    return Season(
+        season=season,
+        players=np.array(players, dtype=np.int64),
+        min_mmr=np.array([boundaries[p][0] for p in players], dtype=np.int64),
+        max_mmr=np.array([boundaries[p][1] for p in players], dtype=np.int64),
+        team_mmr=np.array([teams_mmr(m) for m in matches], dtype=np.int64).reshape(-1, 2),
+        winner=np.array([m.winner for m in matches], dtype=np.int64),
+        starts=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        row_player=np.array([index[r[2]] for r in rows], dtype=np.int64),
+        row_team=np.array([r[3] for r in rows], dtype=np.int64),
+        row_change=np.array([changes.get(r[0], no_change)[0] for r in rows], dtype=np.int64),
+        row_mmr=np.array([changes.get(r[0], no_change)[1] for r in rows], dtype=np.int64),
+        row_score=np.array([changes.get(r[0], no_change)[2] for r in rows], dtype=np.int64),
+        other_player=np.array([index[o[0]] for o in others], dtype=np.int64),
+        other_mmr=np.array([o[1] for o in others], dtype=np.int64),
+        other_score=np.array([o[2] for o in others], dtype=np.int64),
+        other_before=np.array([bisect.bisect_right(match_dates, o[3]) for o in others], dtype=np.int64),
+    )
+
+
+def row_matches(season):
+    # match index of every row
+    return np.repeat(np.arange(len(season.winner)), np.diff(season.starts))
+
+
+def sums(season, row_mmr, row_score):
+    # sums of MMR and score changes of every player
+    players = np.concatenate([season.other_player, season.row_player])
+    return [
+        np.bincount(players, np.concatenate([other, rows]), minlength=len(season.players)).astype(np.int64)
+        for other, rows in [(season.other_mmr, row_mmr), (season.other_score, row_score)]
+    ]
+
+
+def totals(season, row_mmr, row_score):
+    # players totals after all changes of the season, they can't go below zero (see managers.total_changes)
+    return [np.maximum(s, 0) for s in sums(season, row_mmr, row_score)]
+
+
+def recorded(season):
+    # what is in DB now, as Replay
+    mmr, score = totals(season, season.row_mmr, season.row_score)
+    return Replay(mmr, score, season.row_mmr, season.row_score)
+
+
+def replay(season, rules):
+    """
+    Counts players MMR and score of the season under given rules,
+    same way as MatchManager.add_scores() does for every match.
+    Teams MMR is taken from balance answers as they were.
+    """
+    underdog = np.array([MatchManager.underdog(int(diff), rules) for diff in season.team_mmr[:, 0] - season.team_mmr[:, 1]],
+                        dtype=np.int64).reshape(-1, 2)
+
+    row_match = row_matches(season)
+    victory = np.where(season.row_team == season.winner[row_match], 1, -1)
+    is_underdog = np.where(season.row_team == underdog[row_match, 0], 1, -1)
+
+    rated = season.row_change > 0
+    row_score = rules.score_per_game * victory * rated
+    row_mmr = (rules.mmr_per_game * victory + underdog[row_match, 1] * is_underdog) * rated
+
+    if rules.boundaries:
+        row_mmr = bounded(season, row_mmr)
+
+    mmr, score = totals(season, row_mmr, row_score)
+    return Replay(mmr, score, row_mmr, row_score)
+
+
+def bounded(season, row_mmr):
+    # boundaries depend on MMR players have at the moment, so here matches go one by one
+    mmr_sum = np.zeros(len(season.players), dtype=np.int64)
+    row_mmr = row_mmr.copy()
+
+    other = 0
+    for match in range(len(season.winner)):
+        while other < len(season.other_before) and season.other_before[other] <= match:
+            mmr_sum[season.other_player[other]] += season.other_mmr[other]
+            other += 1
+
+        rows = slice(season.starts[match], season.starts[match + 1])
+        players = season.row_player[rows]
+        mmr = np.maximum(mmr_sum[players], 0)
+        new_mmr = np.clip(mmr + row_mmr[rows], season.min_mmr[players], season.max_mmr[players])
+        row_mmr[rows] = np.where(season.row_change[rows] > 0, new_mmr - mmr, 0)
+        mmr_sum[players] += row_mmr[rows]
+
+    return row_mmr
+
+
+def apply(season, result):
+    """
+    Writes replayed score changes, and players totals and ranks if it's current season.
+    Signals are not used, whole season is written in one transaction.
+
+    :return: amount of changed score changes, amount of changed players
+    """
+    from app.ladder.models import LadderSettings, Player, ScoreChange
+
+    changed = (season.row_change > 0) & ((result.row_mmr != season.row_mmr) | (result.row_score != season.row_score))
+
+    # score changes with the same values are updated together, there are just a few different ones
+    groups = defaultdict(list)
+    for row in np.flatnonzero(changed):
+        groups[(int(result.row_mmr[row]), int(result.row_score[row]))].append(int(season.row_change[row]))
+
+    players = {}
+    with transaction.atomic():
+        batch_size = 500
+        for (mmr_change, score_change), ids in groups.items():
+            for start in range(0, len(ids), batch_size):
+                ScoreChange.objects\
+                    .filter(id__in=ids[start:start + batch_size])\
+                    .update(mmr_change=mmr_change, score_change=score_change)
+
+        # totals are kept for current season only
+        if season.season == LadderSettings.get_solo().current_season:
+            mmr_sum, score_sum = sums(season, result.row_mmr, result.row_score)
+            new = dict(zip(season.players.tolist(), zip(
+                result.mmr.tolist(), result.score.tolist(), mmr_sum.tolist(), score_sum.tolist()
+            )))
+            fields = ['ladder_mmr', 'score', 'ladder_mmr_sum', 'score_sum']
+            for player in Player.objects.values_list('id', *fields):
+                if player[0] in new and new[player[0]] != player[1:]:
+                    players[player[0]] = new[player[0]]
+
+            Player.objects.set_values(players, fields)
+            Player.objects.update_ranks(season.season)
+
+    return int(changed.sum()), len(players)
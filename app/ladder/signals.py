@@ -1,22 +1,56 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
-from django.db.models import Sum
 
+from app.ladder.managers import PlayerSeasonStatsManager, total_changes
 from app.ladder.models import ScoreChange, Match, Player, LadderSettings, QueuePlayer, LadderQueue
 
 
-@receiver([post_save, post_delete], sender=ScoreChange)
+def add_to_totals(player_id, season, mmr_change, score_change):
+    # totals are kept for current season only
+    if season != LadderSettings.get_solo().current_season:
+        return
+
+    Player.objects.filter(id=player_id).update(**total_changes(mmr_change, score_change))
+
+
+@receiver(pre_save, sender=ScoreChange)
+def score_change_edit(instance, **kwargs):
+    # remember what was counted for an edited change, so it can be taken back
+    instance.counted = None
+    if instance.id:
+        instance.counted = ScoreChange.objects\
+            .filter(id=instance.id)\
+            .values_list('player_id', 'season', 'mmr_change', 'score_change')\
+            .first()
+
+
+@receiver(post_save, sender=ScoreChange)
 def score_change(instance, **kwargs):
-    player = instance.player
+    if instance.counted:
+        player_id, season, mmr_change, score_change = instance.counted
+        add_to_totals(player_id, season, -mmr_change, -score_change)
+
+    add_to_totals(instance.player_id, instance.season, instance.mmr_change, instance.score_change)
+
+    # callers often save the player after making a change, don't let them write old totals back
+    player = getattr(instance, ScoreChange._meta.get_field('player').get_cache_name(), None)
+    if player is not None:
+        player.refresh_from_db(fields=['ladder_mmr', 'score', 'ladder_mmr_sum', 'score_sum'])
+
+
+@receiver(post_delete, sender=ScoreChange)
+def score_change_delete(instance, **kwargs):
+    add_to_totals(instance.player_id, instance.season, -instance.mmr_change, -instance.score_change)
 
-    season = LadderSettings.get_solo().current_season
-    vals = player.scorechange_set.filter(season=season).aggregate(
-        Sum('mmr_change'), Sum('score_change'))
 
-    player.ladder_mmr = vals['mmr_change__sum']
-    player.score = vals['score_change__sum']
+@receiver(pre_delete, sender=Match)
+def match_delete(instance, **kwargs):
+    # match players are still there, take the match back from their stats
+    teams = [[], []]
+    for team, player_id in instance.matchplayer_set.order_by().values_list('team', 'player_id'):
+        teams[team].append(player_id)
 
-    player.save()
+    PlayerSeasonStatsManager.add_match(instance, teams, sign=-1)
 
 
 @receiver(post_delete, sender=Match)
@@ -0,0 +1,288 @@
+import random
+from datetime import timedelta
+from unittest import skipUnless
+
+from django.contrib.auth.models import Permission, User
+from django.db.models import F, Sum
+from django.test import TestCase
+from django.utils import timezone
+
+from app.balancer.managers import BalanceAnswerManager
+from app.balancer.models import team_ids, team_member
+from app.ladder import replay
+from app.ladder.managers import MatchManager, QueueChannelManager, window_ranks_supported
+from app.ladder.models import LadderQueue, LadderSettings, Match, Player, PlayerSeasonStats, QueueChannel, QueuePlayer, ScoreChange
+
+
+def create_players(dota_mmrs):
+    # players 'Player 0', 'Player 1', ... with given dota MMR,
+    # their ladder MMR and score come from the first score change (see Player.save)
+    return [Player.objects.create(name='Player %d' % i, dota_mmr=mmr) for i, mmr in enumerate(dota_mmrs)]
+
+
+def custom_answer(players):
+    # first 5 players against next 5
+    return BalanceAnswerManager.balance_custom([
+        [team_member(p) for p in players[:5]],
+        [team_member(p) for p in players[5:10]],
+    ])
+
+
+class TeamIdsTestCase(TestCase):
+    def test_renamed_player_is_recorded(self):
+        players = create_players([1000 + i for i in range(10)])
+        answer = custom_answer(players)
+
+        Player.objects.filter(id=players[0].id).update(name='Renamed')
+
+        match = MatchManager.record_balance(answer, 0)
+        self.assertEqual(set(match.players.values_list('id', flat=True)), {p.id for p in players})
+        self.assertEqual(team_ids(answer.teams), [{p.id for p in players[:5]}, {p.id for p in players[5:]}])
+
+
+class MatchIngestTestCase(TestCase):
+    def test_query_budget(self):
+        LadderSettings.get_solo()
+        players = create_players([1000] * 50)
+
+        # same amount of queries for small and big ladder
+        for ladder in [players[:10], players]:
+            random.Random(0).shuffle(ladder)
+            MatchManager.record_balance(custom_answer(ladder), 0)  # first match of these players
+
+            answer = custom_answer(ladder)
+            with self.assertNumQueries(17):
+                MatchManager.record_balance(answer, 1)
+
+    def test_deleted_player(self):
+        players = create_players([1000] * 10)
+        answer = custom_answer(players)
+        players[3].delete()
+
+        with self.assertRaises(Player.DoesNotExist):
+            MatchManager.record_balance(answer, 0)
+        self.assertFalse(Match.objects.exists())
+
+        # admins get an error instead of a crash
+        user = User.objects.create_user('admin', password='admin')
+        user.user_permissions.add(Permission.objects.get(codename='add_match'))
+        self.client.login(username='admin', password='admin')
+
+        response = self.client.get('/balancer/answers/%d/match-create/0/' % answer.id)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Match.objects.exists())
+
+    def test_stats_and_ranks(self):
+        rnd = random.Random(0)
+        players = create_players([1000] * 20)
+
+        for _ in range(5):
+            rnd.shuffle(players)
+            MatchManager.record_balance(custom_answer(players), rnd.randint(0, 1))
+
+        self.assertStats()
+
+    def test_incremental_ranks(self):
+        rnd = random.Random(1)
+        players = create_players([rnd.randint(10, 30) * 100 for _ in range(30)])
+
+        # everyone gets ranked, then ranks are only updated for players who moved
+        for start in range(0, 30, 10):
+            MatchManager.record_balance(custom_answer(players[start:start + 10]), 0)
+
+        for _ in range(20):
+            rnd.shuffle(players)
+            MatchManager.record_balance(custom_answer(players), rnd.randint(0, 1))
+            self.assertStats()
+
+    def test_season_stats(self):
+        rnd = random.Random(3)
+        players = create_players([1000] * 15)
+
+        matches = []
+        for _ in range(6):
+            rnd.shuffle(players)
+            matches.append(MatchManager.record_balance(custom_answer(players), rnd.randint(0, 1)))
+        self.assertStats()
+
+        matches[2].delete()
+        Match.objects.filter(id__in=[m.id for m in matches[4:]]).delete()
+        self.assertStats()
+
+        player = Player.objects.filter(season_stats__match_count__gt=0).first()
+        PlayerSeasonStats.objects.filter(player=player).update(wins=100)
+        PlayerSeasonStats.objects.rebuild()
+        self.assertStats()
+
+    @skipUnless(window_ranks_supported(), 'needs SQLite 3.33')
+    def test_window_ranks(self):
+        rnd = random.Random(2)
+        create_players([1000] * 30)
+        for player in Player.objects.all():
+            Player.objects.filter(id=player.id).update(ladder_mmr=rnd.randint(1, 5) * 100, score=rnd.randint(0, 3))
+
+        # both ways give the same ranks
+        ranks = []
+        for update in [Player.objects.window_ranks, Player.objects.python_ranks]:
+            Player.objects.update(rank_ladder_mmr=0, rank_score=0)
+            update(Player.objects.values('id').order_by())
+            ranks.append(list(Player.objects.order_by('id').values_list('rank_ladder_mmr', 'rank_score')))
+
+        self.assertEqual(ranks[0], ranks[1])
+        self.assertNotIn((0, 0), ranks[0])
+
+    def assertStats(self):
+        players = list(Player.objects.filter(matchplayer__isnull=False).distinct())
+        for player in players:
+            # same stats as ScoreChange signal gives
+            changes = player.scorechange_set.aggregate(Sum('mmr_change'), Sum('score_change'))
+            self.assertEqual(player.ladder_mmr, changes['mmr_change__sum'])
+            self.assertEqual(player.score, changes['score_change__sum'])
+
+            # rank is 1 + amount of players with a better value
+            self.assertEqual(player.rank_ladder_mmr, 1 + sum(p.ladder_mmr > player.ladder_mmr for p in players))
+            self.assertEqual(player.rank_score, 1 + sum(p.score > player.score for p in players))
+
+        # season stats are the same as counted from matches
+        stats = PlayerSeasonStats.objects.filter(match_count__gt=0)
+        self.assertEqual(
+            {(s.player_id, s.season): (s.match_count, s.wins) for s in stats},
+            PlayerSeasonStats.objects.count_matches(),
+        )
+        for s in stats:
+            self.assertEqual(s.losses, s.match_count - s.wins)
+
+
+class ScoreTotalsTestCase(TestCase):
+    def assertTotals(self, player):
+        changes = player.scorechange_set.aggregate(Sum('mmr_change'), Sum('score_change'))
+        player.refresh_from_db()
+        self.assertEqual((player.ladder_mmr, player.score), (changes['mmr_change__sum'], changes['score_change__sum']))
+
+    def test_changes_are_counted(self):
+        player = Player.objects.create(name='Player', dota_mmr=3000, ladder_mmr=5000)
+        other = Player.objects.create(name='Other', dota_mmr=4000)
+        self.assertEqual(player.ladder_mmr, 3000)
+
+        change = ScoreChange.objects.create(player=player, mmr_change=100, score_change=2)
+        self.assertEqual((player.ladder_mmr, player.score), (3100, 27))
+        self.assertTotals(player)
+
+        # edits take old values back, even when change goes to another player
+        change.mmr_change = -50
+        change.save()
+        self.assertTotals(player)
+        change.player = other
+        change.save()
+        self.assertTotals(player)
+        self.assertTotals(other)
+
+        change.delete()
+        self.assertTotals(other)
+
+        # changes of other seasons don't count
+        ScoreChange.objects.create(player=player, mmr_change=100, season=0)
+        player.refresh_from_db()
+        self.assertEqual(player.ladder_mmr, 3000)
+
+    def test_negative_change_is_taken_back(self):
+        player = Player.objects.create(name='Player', dota_mmr=3000)
+        season = LadderSettings.get_solo().current_season
+        self.assertEqual(player.score, 25)
+
+        # score doesn't go below zero, but taking the change back gives what was there before it
+        change = ScoreChange.objects.create(player=player, score_change=-30)
+        self.assertEqual(player.score, 0)
+        change.score_change = -20
+        change.save()
+        self.assertEqual(player.score, 5)
+        change.delete()
+        player.refresh_from_db()
+        self.assertEqual(player.score, 25)
+        self.assertEqual(ScoreChange.objects.count_totals(season)[player.id], (3000, 25))
+
+
+class ReplayTestCase(TestCase):
+    def setUp(self):
+        rnd = random.Random(4)
+        players = create_players([rnd.randint(10, 40) * 100 for _ in range(20)])
+
+        for _ in range(15):
+            rnd.shuffle(players)
+            MatchManager.record_balance(custom_answer(players), rnd.randint(0, 1))
+
+        self.season = LadderSettings.get_solo().current_season
+
+    def test_same_rules(self):
+        # replay with current rules gives what was recorded
+        season = replay.load_season(self.season)
+        old, new = replay.recorded(season), replay.replay(season, MatchManager.rules())
+
+        for field in old._fields:
+            self.assertEqual(getattr(old, field).tolist(), getattr(new, field).tolist())
+        self.assertEqual(replay.apply(season, new), (0, 0))
+
+    def test_totals_not_below_zero(self):
+        player = Player.objects.filter(matchplayer__isnull=False).first()
+        ScoreChange.objects.create(player=player, mmr_change=-10000, score_change=-100)
+        ScoreChange.objects.create(player=player, mmr_change=10, score_change=1)
+
+        season = replay.load_season(self.season)
+        old = replay.recorded(season)
+        totals = ScoreChange.objects.count_totals(self.season)
+
+        self.assertEqual(
+            dict(zip(season.players.tolist(), zip(old.mmr.tolist(), old.score.tolist()))),
+            totals,
+        )
+        player.refresh_from_db()
+        self.assertEqual(totals[player.id], (0, 0))
+        self.assertEqual((player.ladder_mmr, player.score), (0, 0))
+        self.assertEqual(replay.apply(season, replay.replay(season, MatchManager.rules())), (0, 0))
+
+    def test_apply(self):
+        rules = MatchManager.rules()._replace(mmr_per_game=20, underdog_bonus=5, boundaries=True)
+        Player.objects.update(min_allowed_mmr=F('dota_mmr') - 30, max_allowed_mmr=F('dota_mmr') + 30)
+        season = replay.load_season(self.season)
+        result = replay.replay(season, rules)
+        replay.apply(season, result)
+
+        for player in Player.objects.filter(matchplayer__isnull=False).distinct():
+            changes = player.scorechange_set
+            totals = changes.aggregate(Sum('mmr_change'), Sum('score_change'))
+            self.assertEqual(player.ladder_mmr, totals['mmr_change__sum'])
+            self.assertEqual(player.score, totals['score_change__sum'])
+
+            # MMR never left boundaries after a match
+            mmr = 0
+            for change in changes.order_by('id'):
+                mmr += change.mmr_change
+                if change.match_id:
+                    self.assertTrue(player.min_allowed_mmr <= mmr <= player.max_allowed_mmr)
+
+        # replaying again changes nothing
+        self.assertEqual(replay.apply(replay.load_season(self.season), result), (0, 0))
+
+
+class MatchmakeTestCase(TestCase):
+    def test_players_move_to_new_queue(self):
+        players = create_players([1000] * 10 + [9000] * 2)
+        channels = [QueueChannel.objects.create(name='Channel %d' % i, discord_id=i) for i in range(2)]
+
+        # 4 players wait in one channel, 6 of the same MMR and 2 way stronger ones in another
+        queues = [LadderQueue.objects.create(channel=channel) for channel in channels]
+        for i, player in enumerate(players):
+            qp = QueuePlayer.objects.create(queue=queues[i >= 4], player=player)
+            QueuePlayer.objects.filter(id=qp.id).update(joined_date=timezone.now() - timedelta(minutes=30 - i))
+        joined = dict(QueuePlayer.objects.values_list('player_id', 'joined_date'))
+
+        queue, = QueueChannelManager.matchmake(channels[1])
+
+        self.assertEqual(queue.channel, channels[1])
+        self.assertEqual(set(queue.players.all()), set(players[:10]))
+        for qp in queue.queueplayer_set.all():
+            self.assertEqual(qp.joined_date, joined[qp.player_id])
+
+        # queue left empty is closed
+        self.assertFalse(LadderQueue.objects.filter(id=queues[0].id).exists())
+        self.assertEqual(set(queues[1].players.all()), set(players[10:]))
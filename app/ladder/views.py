@@ -5,12 +5,23 @@ from django.core.cache import cache
 import itertools
 from app.ladder.models import Player, MatchPlayer, Match, LadderSettings
 from dal import autocomplete
-from django.db.models import Max, Count, Prefetch, Case, When, F, ExpressionWrapper, FloatField, Avg
+from django.db.models import Max, Count, Prefetch, F, ExpressionWrapper, FloatField, Avg
 from django.utils.datetime_safe import datetime
 from django.views.generic import ListView, DetailView, TemplateView
 from pure_pagination import Paginator
 
 
+def with_season_stats(players, season):
+    # players who played in the season, with match_count, wins and losses from their stats
+    return players\
+        .filter(season_stats__season=season, season_stats__match_count__gt=0)\
+        .annotate(
+            match_count=F('season_stats__match_count'),
+            wins=F('season_stats__wins'),
+            losses=F('season_stats__losses'),
+        )
+
+
 class PlayerList(ListView):
     model = Player
 
@@ -18,7 +29,13 @@ class PlayerList(ListView):
         qs = super(PlayerList, self).get_queryset()
 
         season = LadderSettings.get_solo().current_season
-        qs = qs.filter(matchplayer__match__season=season).distinct()\
+        qs = with_season_stats(qs, season)\
+            .annotate(
+                winrate=ExpressionWrapper(
+                    F('wins') * Decimal('100') / F('match_count'),
+                    output_field=FloatField()
+                )
+            )\
             .prefetch_related(Prefetch(
                 'matchplayer_set',
                 queryset=MatchPlayer.objects.select_related('match'),
@@ -30,19 +47,6 @@ class PlayerList(ListView):
         context = super(PlayerList, self).get_context_data(**kwargs)
         players = context['player_list']
 
-        players = players.annotate(
-            match_count=Count('matchplayer'),
-            wins=Count(Case(
-                When(
-                    matchplayer__team=F('matchplayer__match__winner'), then=1)
-                )
-            ),
-            winrate=ExpressionWrapper(
-                F('wins') * Decimal('100') / F('match_count'),
-                output_field=FloatField()
-            )
-        )
-
         if not players:
             # no games this season yet, nothing to calc
             return context
@@ -76,7 +80,7 @@ class PlayersSuccessful(ListView):
         qs = super(PlayersSuccessful, self).get_queryset()
 
         season = LadderSettings.get_solo().current_season
-        qs = qs.filter(matchplayer__match__season=season).distinct()\
+        qs = with_season_stats(qs, season)\
             .prefetch_related(Prefetch(
                 'matchplayer_set',
                 queryset=MatchPlayer.objects.select_related('match'),
@@ -88,16 +92,6 @@ class PlayersSuccessful(ListView):
         context = super(PlayersSuccessful, self).get_context_data(**kwargs)
         players = context['player_list']
 
-        players = players.annotate(
-            match_count=Count('matchplayer'),
-            wins=Count(Case(
-                When(
-                    matchplayer__team=F('matchplayer__match__winner'), then=1)
-                )
-            ),
-            losses=F('match_count') - F('wins'),
-        )
-		
         if not players:
             # no games this season yet, nothing to calc
             return context